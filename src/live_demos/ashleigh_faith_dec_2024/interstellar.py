@@ -4,10 +4,11 @@ Create a graph in Kùzu
 import shutil
 
 import kuzu
+from demo_utils.ingest_report import InstrumentedConnection
 
 shutil.rmtree("movie_db", ignore_errors=True)
 db = kuzu.Database("movie_db")
-conn = kuzu.Connection(db)
+conn = InstrumentedConnection(kuzu.Connection(db))
 
 # Define schema
 conn.execute(
@@ -45,6 +46,7 @@ files = {
 for table, file in files.items():
     conn.execute(f"COPY {table} FROM '{base_path}/{file}';")
 print("Finished ingesting data")
+conn.write_report("interstellar")
 
 # Query the graph to check what we have
 response = conn.execute(
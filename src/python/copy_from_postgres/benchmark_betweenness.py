@@ -0,0 +1,67 @@
+"""
+Compare the time and accuracy of sampled betweenness centrality with the exact result.
+
+A synthetic transfer graph, with random source and target accounts as generated by
+`benchmark_insert_pg.py`, is built as a CSR adjacency. The exact centrality is computed with
+NetworkX, as `analyze.py` used to, and with `betweenness.py` from every source, and then estimated
+from each number of sampled sources, with the error of each estimate against the exact result.
+NetworkX takes minutes beyond a few thousand accounts, so keep the graph small.
+"""
+from __future__ import annotations
+
+import argparse
+import time
+
+import networkx as nx
+import numpy as np
+from betweenness import betweenness_centrality, compare_with_exact, undirected_csr
+
+
+def main(
+    num_accounts: int, num_transfers: int, samples: list[int], seed: int, workers: int | None
+) -> None:
+    rng = np.random.default_rng(seed)
+    sources = rng.integers(0, num_accounts, num_transfers)
+    targets = rng.integers(0, num_accounts, num_transfers)
+    csr = undirected_csr(sources, targets, num_accounts)
+
+    G = nx.Graph()
+    G.add_nodes_from(range(num_accounts))
+    G.add_edges_from(zip(sources.tolist(), targets.tolist()))
+    start = time.perf_counter()
+    bc = nx.betweenness_centrality(G, normalized=True)
+    nx_time = time.perf_counter() - start
+    exact = np.array([bc[node] for node in range(num_accounts)])
+
+    print(f"{num_accounts} accounts, {num_transfers} transfers\n")
+    print(f"{'sources':>10} {'time (s)':>10} {'max error':>10} {'mean error':>11} {'top-10':>7}")
+    print(f"{'NetworkX':>10} {nx_time:>10.3f}")
+    for k in [None, *samples]:
+        start = time.perf_counter()
+        estimate = betweenness_centrality(csr, k, seed, workers)
+        elapsed = time.perf_counter() - start
+        accuracy = compare_with_exact(estimate, exact)
+        print(
+            f"{'all' if k is None else k:>10} {elapsed:>10.3f} {accuracy['max_error']:>10.2e} "
+            f"{accuracy['mean_error']:>11.2e} {accuracy['top_10_recall']:>7.0%}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--num-accounts", type=int, default=2_000)
+    parser.add_argument("--num-transfers", type=int, default=20_000)
+    parser.add_argument(
+        "--samples",
+        type=int,
+        nargs="+",
+        default=[20, 100, 500],
+        help="Numbers of sampled sources to estimate the centrality from",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the graph and the samples")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Number of worker processes (default: CPUs)"
+    )
+    args = parser.parse_args()
+
+    main(args.num_accounts, args.num_transfers, args.samples, args.seed, args.workers)
@@ -0,0 +1,149 @@
+"""
+Compare the rows/s of the per-row INSERT path and the COPY path of `insert_data_pg.py`.
+
+Synthetic person, account and transfer tables are bulk loaded into Postgres with COPY, one table
+after the other, and then a sample of extra rows of each table (new ids that refer to existing
+rows) is inserted one row per INSERT statement, as `insert_data_pg.py --per-row` does. Both paths
+thus write to tables of the same size, with the same indexes and foreign keys to check.
+
+The tables are truncated first, so do not point this at a database whose data you want to keep.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+
+import asyncpg
+import numpy as np
+from insert_data_pg import (
+    PG_URI,
+    TABLE_COLUMNS,
+    copy_records,
+    create_account_table,
+    create_person_table,
+    create_transfer_table,
+    insert_records,
+    truncate_tables,
+)
+
+
+def generate_records(
+    num_persons: int,
+    num_accounts: int,
+    num_transfers: int,
+    offset: int = 0,
+    referenced: tuple[int, int] | None = None,
+    seed: int = 1,
+) -> dict[str, list[tuple]]:
+    """
+    Rows of each table, with ids starting after `offset`. Accounts and transfers refer to the
+    persons and accounts with ids 1 to `referenced`, by default those generated along with them
+    """
+    rng = np.random.default_rng(seed)
+    max_person_id, max_account_id = referenced or (num_persons, num_accounts)
+    person_ids = range(offset + 1, offset + num_persons + 1)
+    account_ids = range(offset + 1, offset + num_accounts + 1)
+    owners = rng.integers(1, max_person_id + 1, num_accounts).tolist()
+    balances = rng.integers(0, 20_000, num_accounts).astype(float).tolist()
+    sources = rng.integers(1, max_account_id + 1, num_transfers).tolist()
+    targets = rng.integers(1, max_account_id + 1, num_transfers).tolist()
+    amounts = rng.integers(1, 1000, num_transfers).astype(float).tolist()
+    return {
+        "person": [
+            (i, f"Person {i}", f"{i} Main Street, Springfield", f"person{i}@example.com")
+            for i in person_ids
+        ],
+        "account": [
+            (i, f"{i:09d}", owner, balance)
+            for i, owner, balance in zip(account_ids, owners, balances)
+        ],
+        "transfer": [
+            (source, target, amount, f"T{offset + i:011d}")
+            for i, (source, target, amount) in enumerate(zip(sources, targets, amounts), 1)
+        ],
+    }
+
+
+async def main(
+    uri: str,
+    num_persons: int,
+    num_accounts: int,
+    num_transfers: int,
+    per_row_sample: int,
+    batch_size: int,
+    max_in_flight: int,
+) -> None:
+    records = generate_records(num_persons, num_accounts, num_transfers)
+    # Extra rows for the per-row path, after the ids of the bulk loaded rows
+    offset = max(len(rows) for rows in records.values())
+    samples = generate_records(
+        per_row_sample,
+        per_row_sample,
+        per_row_sample,
+        offset,
+        referenced=(num_persons, num_accounts),
+        seed=2,
+    )
+
+    async with asyncpg.create_pool(uri, min_size=5, max_size=max(20, max_in_flight)) as pool:
+        await create_person_table(pool)
+        await create_account_table(pool)
+        await create_transfer_table(pool)
+        await truncate_tables(pool)
+
+        copy_rates = {}
+        for table, rows in records.items():
+            start = time.perf_counter()
+            await copy_records(pool, table, rows, batch_size, max_in_flight)
+            copy_rates[table] = len(rows) / (time.perf_counter() - start)
+
+        per_row_rates = {}
+        for table, rows in samples.items():
+            # The per-row functions take CSV records, keyed by column
+            sample = [dict(zip(TABLE_COLUMNS[table], row)) for row in rows]
+            start = time.perf_counter()
+            await insert_records(pool, table, sample)
+            per_row_rates[table] = len(sample) / (time.perf_counter() - start)
+
+    print(
+        f"COPY in batches of {batch_size} rows with {max_in_flight} in flight, "
+        f"per-row INSERT on {per_row_sample} rows per table\n"
+    )
+    print(f"{'table':<10} {'rows':>10} {'per-row rows/s':>16} {'COPY rows/s':>14} {'speedup':>8}")
+    for table, rows in records.items():
+        print(
+            f"{table:<10} {len(rows):>10} {per_row_rates[table]:>16,.0f} "
+            f"{copy_rates[table]:>14,.0f} {copy_rates[table] / per_row_rates[table]:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--uri", default=PG_URI, help="Postgres connection URI")
+    parser.add_argument("--num-persons", type=int, default=100_000)
+    parser.add_argument("--num-accounts", type=int, default=100_000)
+    parser.add_argument("--num-transfers", type=int, default=1_000_000)
+    parser.add_argument(
+        "--per-row-sample",
+        type=int,
+        default=10_000,
+        help="Number of rows of each table to time the per-row path on",
+    )
+    parser.add_argument("--batch-size", type=int, default=10_000, help="Rows per COPY batch")
+    parser.add_argument(
+        "--max-in-flight", type=int, default=4, help="Number of batches copied concurrently"
+    )
+    args = parser.parse_args()
+
+    asyncio.run(
+        main(
+            args.uri,
+            args.num_persons,
+            args.num_accounts,
+            args.num_transfers,
+            args.per_row_sample,
+            args.batch_size,
+            args.max_in_flight,
+        )
+    )
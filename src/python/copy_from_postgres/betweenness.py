@@ -0,0 +1,160 @@
+"""
+Betweenness centrality over a CSR adjacency of the undirected Transfer graph.
+
+Runs Brandes' algorithm: a BFS from each source counts the shortest paths from the source to every
+node, and a pass back over the BFS levels accumulates the dependency of the source on every node.
+The BFS and the accumulation are vectorized over each level, and the sources are spread across a
+process pool, each worker summing the dependencies of its own sources.
+
+From every node, the result matches `nx.betweenness_centrality(G, normalized=True)` on the simple
+undirected graph. With `k`, the BFS only runs from `k` sources sampled uniformly without
+replacement, and the sums are scaled by n / k (Brandes and Pich), as `nx.betweenness_centrality`
+does with `k`. This gives an unbiased estimate at k / n of the cost, whose error shrinks as
+1 / sqrt(k) whatever the size of the graph.
+"""
+from __future__ import annotations
+
+import os
+from multiprocessing import Pool
+
+import numpy as np
+from demo_utils.graph_projection import Projection, shareable, unshare
+
+# Adjacency shared with the worker processes, set once per worker by `init_worker`
+_csr: tuple[np.ndarray, np.ndarray] | None = None
+
+
+def undirected_csr(
+    sources: np.ndarray, targets: np.ndarray, num_nodes: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric CSR adjacency of the edges, without parallel edges or self-loops, which would
+    otherwise change the number of shortest paths, as in `nx.Graph`
+    """
+    src, dst = np.minimum(sources, targets), np.maximum(sources, targets)
+    pairs = np.unique(np.stack([src, dst])[:, src != dst].astype(np.int64), axis=1)
+    src, dst = np.concatenate([pairs[0], pairs[1]]), np.concatenate([pairs[1], pairs[0]])
+    order = np.argsort(src, kind="stable")
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=num_nodes), out=indptr[1:])
+    return indptr, dst[order]
+
+
+def from_projection(projection: Projection) -> tuple[np.ndarray, np.ndarray]:
+    return undirected_csr(projection.sources(), projection.targets, projection.num_nodes)
+
+
+def dependencies(
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    source: int,
+    dist: np.ndarray,
+    sigma: np.ndarray,
+    delta: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Dependency of `source` on each node that it reaches, as the reached nodes and their
+    dependencies. `dist`, `sigma` and `delta` are scratch space of length n, filled with -1, 0 and
+    0, which is restored before returning, so that each BFS only costs as much as the part of the
+    graph it reaches
+    """
+    dist[source] = 0
+    sigma[source] = 1
+    frontier = np.array([source], dtype=np.int64)
+    reached = [frontier]
+    # Edges of the shortest-path DAG out of each level, from a node to a node one level further
+    dag = []
+    level = 0
+    while frontier.size:
+        level += 1
+        starts, lengths = indptr[frontier], indptr[frontier + 1] - indptr[frontier]
+        total = lengths.sum()
+        if total == 0:
+            break
+        # Positions in `indices` of all the edges out of the frontier
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        parents, children = np.repeat(frontier, lengths), indices[offsets]
+        # Sorting and dropping repeats is faster than np.unique, which hashes in numpy 2
+        frontier = np.sort(children[dist[children] < 0])
+        frontier = frontier[np.diff(frontier, prepend=-1) != 0]
+        dist[frontier] = level
+        on_path = dist[children] == level
+        parents, children = parents[on_path], children[on_path]
+        # Every shortest path to a parent extends to its children
+        np.add.at(sigma, children, sigma[parents])
+        dag.append((parents, children))
+        reached.append(frontier)
+    for parents, children in reversed(dag):
+        np.add.at(delta, parents, sigma[parents] / sigma[children] * (1 + delta[children]))
+    nodes = np.concatenate(reached)
+    values = delta[nodes].copy()
+    # The source does not lie on the paths that start from it
+    values[0] = 0
+    dist[nodes], sigma[nodes], delta[nodes] = -1, 0, 0
+    return nodes, values
+
+
+def init_worker(indptr: np.ndarray | str, indices: np.ndarray | str) -> None:
+    global _csr
+    _csr = (unshare(indptr), unshare(indices))
+
+
+def dependency_sums(sources: np.ndarray) -> np.ndarray:
+    "Sum of the dependencies of the sources on every node"
+    indptr, indices = _csr
+    num_nodes = len(indptr) - 1
+    dist = np.full(num_nodes, -1, dtype=np.int64)
+    sigma, delta, sums = np.zeros(num_nodes), np.zeros(num_nodes), np.zeros(num_nodes)
+    for source in sources:
+        nodes, values = dependencies(indptr, indices, source, dist, sigma, delta)
+        sums[nodes] += values
+    return sums
+
+
+def betweenness_centrality(
+    csr: tuple[np.ndarray, np.ndarray],
+    k: int | None = None,
+    seed: int = 1,
+    workers: int | None = None,
+) -> np.ndarray:
+    """
+    Normalized betweenness centrality of every node of an undirected CSR adjacency, from a BFS out
+    of every node, or out of `k` sources sampled with `seed`, across a pool of `workers` processes
+    (all CPUs by default)
+    """
+    num_nodes = len(csr[0]) - 1
+    if k is None or k >= num_nodes:
+        k = num_nodes
+        sources = np.arange(num_nodes)
+    else:
+        sources = np.random.default_rng(seed).choice(num_nodes, size=k, replace=False)
+    workers = workers or os.cpu_count() or 1
+    chunks = np.array_split(sources, max(1, min(len(sources), workers * 8)))
+    if workers <= 1:
+        init_worker(*csr)
+        sums = sum(dependency_sums(chunk) for chunk in chunks)
+    else:
+        initargs = tuple(shareable(array) for array in csr)
+        with Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+            sums = sum(pool.imap_unordered(dependency_sums, chunks))
+    if num_nodes <= 2:
+        return np.zeros(num_nodes)
+    # Each pair of nodes is counted from both ends, which the normalization by the number of
+    # ordered pairs of the other nodes accounts for
+    return sums * (num_nodes / k) / ((num_nodes - 1) * (num_nodes - 2))
+
+
+def compare_with_exact(estimate: np.ndarray, exact: np.ndarray, top: int = 10) -> dict[str, float]:
+    """
+    Accuracy of an estimate: the largest and mean absolute errors, and the fraction of the `top`
+    nodes of the exact result that are also among the `top` nodes of the estimate
+    """
+    errors = np.abs(estimate - exact)
+    top = min(top, len(exact))
+    top_exact = set(np.argsort(-exact, kind="stable")[:top].tolist())
+    top_estimate = set(np.argsort(-estimate, kind="stable")[:top].tolist())
+    return {
+        "max_error": float(errors.max(initial=0.0)),
+        "mean_error": float(errors.mean()) if len(errors) else 0.0,
+        f"top_{top}_recall": len(top_exact & top_estimate) / top if top else 1.0,
+    }
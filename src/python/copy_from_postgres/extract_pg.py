@@ -0,0 +1,162 @@
+"""
+Extract Postgres tables into Arrow, over several connections at once.
+
+Each table is split into ranges of its primary key, with about the same number of rows each, from
+the histogram of the key that Postgres keeps in `pg_stats`. The ranges are pulled concurrently, one
+`COPY (SELECT ... WHERE <key range>) TO STDOUT` per range over its own pool connection, and each
+range is parsed into an Arrow table in a worker thread while the others are still being read, so
+that both the Postgres backends and the parser run on all the cores. The ranges of a table are
+contiguous and open-ended at both ends, so they cover every row whatever the age of the statistics.
+
+The ranges are yielded one at a time, as they arrive, so that the caller can copy each of them into
+Kùzu while the next ones are read. Only a bounded number of ranges is read ahead of the caller, and
+no range holds more than about `MAX_RANGE_ROWS` rows, so memory use does not grow with the size of
+the tables.
+
+All of the ranges are read in the same snapshot, exported by a transaction that stays open until
+they are done, so the tables are extracted as of a single point in time, as `pg_dump --jobs` does.
+"""
+import asyncio
+import io
+import math
+from collections import deque
+from collections.abc import AsyncIterator
+from typing import Any
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from asyncpg import Connection
+from asyncpg.pool import Pool
+from insert_data_pg import TABLE_COLUMNS
+
+# Arrow types of the converters in TABLE_COLUMNS, matching the Kùzu columns they are copied to
+ARROW_TYPES = {int: pa.int32(), float: pa.float32(), str: pa.string()}
+# Tables with fewer rows are not worth splitting
+MIN_RANGE_ROWS = 100_000
+# Larger tables are split into more ranges than there are connections, to bound memory use
+MAX_RANGE_ROWS = 1_000_000
+
+KeyRange = tuple[Any, Any]
+
+
+async def get_key_statistics(
+    conn: Connection, table: str, key: str
+) -> tuple[int, list[str] | None]:
+    "Estimated number of rows of a table, and the histogram bounds of its key, as text"
+    num_rows = await conn.fetchval(
+        "SELECT reltuples::BIGINT FROM pg_class WHERE oid = $1::REGCLASS;", table
+    )
+    bounds = await conn.fetchval(
+        """
+        SELECT histogram_bounds::TEXT::TEXT[] FROM pg_stats
+        WHERE schemaname = current_schema() AND tablename = $1 AND attname = $2;
+        """,
+        table,
+        key,
+    )
+    return num_rows, bounds
+
+
+async def get_key_ranges(pool: Pool, table: str, key: str, num_ranges: int) -> list[KeyRange]:
+    """
+    Split the key of a table into at least `num_ranges` [start, end) ranges, or more if they would
+    hold over `MAX_RANGE_ROWS` rows, with None for an open end, at bounds taken from the histogram
+    of the key. The table is analyzed if it has no statistics yet
+    """
+    async with pool.acquire() as conn:
+        num_rows, bounds = await get_key_statistics(conn, table, key)
+        if bounds is None:
+            await conn.execute(f"ANALYZE {table};")
+            num_rows, bounds = await get_key_statistics(conn, table, key)
+    num_ranges = max(num_ranges, math.ceil(num_rows / MAX_RANGE_ROWS))
+    num_ranges = max(1, min(num_ranges, math.ceil(num_rows / MIN_RANGE_ROWS)))
+    if not bounds or num_ranges == 1:
+        return [(None, None)]
+    convert = TABLE_COLUMNS[table][key]
+    # Every bucket of the histogram holds about the same number of rows. The bounds are in the
+    # order of the key in Postgres, which for text keys follows the collation of the column rather
+    # than that of Python, so repeated bounds are dropped without sorting them again
+    cuts = list(
+        dict.fromkeys(
+            convert(bounds[round(i * (len(bounds) - 1) / num_ranges)]) for i in range(1, num_ranges)
+        )
+    )
+    return list(zip([None, *cuts], [*cuts, None]))
+
+
+async def extract_range(
+    pool: Pool, snapshot: str, table: str, key: str, key_range: KeyRange
+) -> pa.Table:
+    "Read the rows of a key range, in the given snapshot, as an Arrow table"
+    columns = TABLE_COLUMNS[table]
+    schema = pa.schema([(column, ARROW_TYPES[convert]) for column, convert in columns.items()])
+    conditions, args = [], []
+    for operator, bound in zip([">=", "<"], key_range):
+        if bound is not None:
+            args.append(bound)
+            conditions.append(f"{key} {operator} ${len(args)}")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    output = io.BytesIO()
+    async with pool.acquire() as conn:
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            await conn.execute(f"SET TRANSACTION SNAPSHOT '{snapshot}';")
+            await conn.copy_from_query(
+                f"SELECT {', '.join(columns)} FROM {table} {where}",
+                *args,
+                output=output,
+                format="csv",
+            )
+    if output.tell() == 0:
+        return schema.empty_table()
+    output.seek(0)
+    return await asyncio.to_thread(
+        pa_csv.read_csv,
+        output,
+        read_options=pa_csv.ReadOptions(column_names=schema.names),
+        convert_options=pa_csv.ConvertOptions(column_types=schema),
+    )
+
+
+async def stream_tables(
+    pool: Pool, keys: dict[str, str], num_ranges: int, max_pending: int
+) -> AsyncIterator[tuple[str, pa.Table]]:
+    """
+    Extract the tables, given with the name of their primary key, each split into at least
+    `num_ranges` ranges, and yield each range with the name of its table. The tables are yielded
+    one after the other, in the order of `keys`, and the ranges of a table in the order in which
+    they arrive. Up to `max_pending` ranges are read ahead of the caller, as far as the pool has
+    connections for them besides the one that holds the snapshot, and those of the next table start
+    while the last ranges of a table are read
+    """
+    ranges = deque(
+        [
+            (table, key_range)
+            for table, key in keys.items()
+            for key_range in await get_key_ranges(pool, table, key, num_ranges)
+        ]
+    )
+    async with pool.acquire() as conn:
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            snapshot = await conn.fetchval("SELECT pg_export_snapshot();")
+            pending: dict[asyncio.Task, str] = {}
+            try:
+                for table in keys:
+                    while True:
+                        while ranges and len(pending) < max_pending:
+                            name, key_range = ranges.popleft()
+                            task = asyncio.create_task(
+                                extract_range(pool, snapshot, name, keys[name], key_range)
+                            )
+                            pending[task] = name
+                        current = [task for task, name in pending.items() if name == table]
+                        if not current:
+                            break
+                        done, _ = await asyncio.wait(current, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            del pending[task]
+                            yield table, task.result()
+            finally:
+                # A failed range, or a caller that stops early, cancels the others
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
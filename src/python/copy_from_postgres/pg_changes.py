@@ -0,0 +1,334 @@
+"""
+Incremental sync of the Kùzu copy from a log of the changes to the Postgres tables.
+
+`install_change_capture` creates a `kuzu_changes` table in Postgres, along with triggers that append
+the rows inserted, updated or deleted in `person`, `account` and `transfer` to it, under an
+increasing `change_id`. The triggers run once per statement, over its transition tables, so a bulk
+load with COPY logs all of its rows in a single INSERT. An update is only logged when it changes a
+column that is copied to Kùzu, so that writing the betweenness centrality back to `account` does not
+show up as a change, and a truncate is logged as a single change of its table. The triggers are only
+installed by a sync, since every write to the tables is logged until the next sync consumes it, and
+`remove_change_capture` drops them along with the log.
+
+`sync_changes` reads the logged changes, reduces them to the net change of each row, and applies it
+with MERGE, CREATE and DELETE statements that look up nodes by primary key, so that the cost of a
+sync scales with the number of changed rows rather than with the size of the tables. The
+statements are committed in one Kùzu transaction, and the changes are then deleted from the log.
+The log is thus consumed rather than read from a stored `change_id`, which would skip the changes
+of transactions that commit after a later `change_id` has been synced. A sync that fails before
+the changes are deleted applies them again, so every change leaves the same graph when it is
+applied twice.
+"""
+import json
+from typing import Any
+
+import asyncpg
+import kuzu
+from asyncpg.pool import Pool
+from demo_utils.query_cache import bump_table_versions
+from insert_data_pg import TABLE_COLUMNS
+
+Row = dict[str, Any]
+# All of the versions of a changed row in the log, and its final version, or None if it was deleted
+RowChanges = tuple[list[Row], Row | None]
+
+# Primary key of each Postgres table, which identifies the rows of the log
+TABLE_KEYS = {"person": "id", "account": "id", "transfer": "transaction_id"}
+# Kùzu tables that the rows of each Postgres table are copied to
+KUZU_TABLES = {
+    "person": ["Person", "Address", "LivesIn"],
+    "account": ["Account", "Owns"],
+    "transfer": ["Transfer"],
+}
+
+
+async def install_change_capture(pool: Pool) -> None:
+    "Create the change log and the triggers that fill it, or replace the triggers if they exist"
+    triggers = []
+    for table, key in TABLE_KEYS.items():
+        arguments = ", ".join(f"'{column}'" for column in [key, *TABLE_COLUMNS[table]])
+        triggers.append(
+            f"""
+            CREATE OR REPLACE TRIGGER {table}_log_inserts AFTER INSERT ON {table}
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION log_kuzu_changes({arguments});
+            CREATE OR REPLACE TRIGGER {table}_log_updates AFTER UPDATE ON {table}
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION log_kuzu_changes({arguments});
+            CREATE OR REPLACE TRIGGER {table}_log_deletes AFTER DELETE ON {table}
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION log_kuzu_changes({arguments});
+            CREATE OR REPLACE TRIGGER {table}_log_truncates AFTER TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION log_kuzu_changes({arguments});
+            """
+        )
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS kuzu_changes (
+                    change_id BIGSERIAL PRIMARY KEY,
+                    table_name VARCHAR(64) NOT NULL,
+                    -- I(nsert), U(pdate), D(elete) or T(runcate)
+                    op CHAR(1) NOT NULL,
+                    old_row JSONB,
+                    new_row JSONB
+                );
+
+                -- The copied columns of a row
+                CREATE OR REPLACE FUNCTION kuzu_row(row_json JSONB, columns TEXT[])
+                RETURNS JSONB LANGUAGE SQL IMMUTABLE AS $$
+                    SELECT jsonb_object_agg(key, value) FROM jsonb_each(row_json)
+                    WHERE key = ANY(columns)
+                $$;
+
+                -- Trigger arguments: the primary key of the table, then its copied columns
+                CREATE OR REPLACE FUNCTION log_kuzu_changes() RETURNS TRIGGER
+                LANGUAGE plpgsql AS $$
+                DECLARE
+                    key_column TEXT := TG_ARGV[0];
+                    columns TEXT[] := TG_ARGV[1:TG_NARGS - 1];
+                BEGIN
+                    IF TG_OP = 'TRUNCATE' THEN
+                        INSERT INTO kuzu_changes (table_name, op) VALUES (TG_TABLE_NAME, 'T');
+                    ELSIF TG_OP = 'INSERT' THEN
+                        INSERT INTO kuzu_changes (table_name, op, new_row)
+                        SELECT TG_TABLE_NAME, 'I', to_jsonb(r) FROM new_rows r;
+                    ELSIF TG_OP = 'DELETE' THEN
+                        INSERT INTO kuzu_changes (table_name, op, old_row)
+                        SELECT TG_TABLE_NAME, 'D', to_jsonb(r) FROM old_rows r;
+                    ELSE
+                        -- Old and new rows are paired by key, so that an update of the key is
+                        -- logged as a delete followed by an insert. Only the copied columns are
+                        -- compared and logged
+                        INSERT INTO kuzu_changes (table_name, op, old_row, new_row)
+                        SELECT
+                            TG_TABLE_NAME,
+                            CASE WHEN n IS NULL THEN 'D' WHEN o IS NULL THEN 'I' ELSE 'U' END,
+                            o,
+                            n
+                        FROM (SELECT kuzu_row(to_jsonb(r), columns) AS o FROM old_rows r) old
+                        FULL JOIN (SELECT kuzu_row(to_jsonb(r), columns) AS n FROM new_rows r) new
+                            ON o -> key_column = n -> key_column
+                        WHERE o IS DISTINCT FROM n
+                        ORDER BY o IS NULL, n IS NOT NULL;
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$;
+                """
+            )
+            await conn.execute("".join(triggers))
+
+
+async def has_change_capture(pool: Pool) -> bool:
+    "Whether the change log exists, i.e. whether changes are logged since it was installed"
+    async with pool.acquire() as conn:
+        return await conn.fetchval("SELECT to_regclass('kuzu_changes') IS NOT NULL;")
+
+
+async def remove_change_capture(pool: Pool) -> None:
+    "Drop the triggers, their functions and the change log"
+    triggers = [
+        f"DROP TRIGGER IF EXISTS {table}_log_{op} ON {table};"
+        for table in TABLE_KEYS
+        for op in ["inserts", "updates", "deletes", "truncates"]
+    ]
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                "".join(triggers)
+                + """
+                DROP FUNCTION IF EXISTS log_kuzu_changes();
+                DROP FUNCTION IF EXISTS kuzu_row(JSONB, TEXT[]);
+                DROP TABLE IF EXISTS kuzu_changes;
+                """
+            )
+
+
+async def get_changes(pool: Pool, limit: int) -> list[asyncpg.Record]:
+    async with pool.acquire() as conn:
+        return await conn.fetch(
+            """
+            SELECT change_id, table_name, op, old_row, new_row
+            FROM kuzu_changes
+            ORDER BY change_id
+            LIMIT $1
+            """,
+            limit,
+        )
+
+
+async def delete_changes(pool: Pool, change_ids: list[int] | None = None) -> None:
+    """
+    Delete the given changes from the log, or all of the committed changes, e.g. before a full
+    copy. Changes that are committed later are kept, and synced after the copy
+    """
+    async with pool.acquire() as conn:
+        if change_ids is None:
+            await conn.execute("DELETE FROM kuzu_changes;")
+        else:
+            await conn.execute(
+                "DELETE FROM kuzu_changes WHERE change_id = ANY($1::BIGINT[]);", change_ids
+            )
+
+
+def reduce_changes(changes: list[asyncpg.Record]) -> dict[str, dict[Any, RowChanges]]:
+    """
+    The net change of each changed row, by table and key. The earlier versions of a row are needed
+    to delete the Transfer rels of a transfer whose accounts were updated, as the copy may hold any
+    of them when the log overlaps with a full copy
+    """
+    net: dict[str, dict[Any, RowChanges]] = {table: {} for table in TABLE_KEYS}
+    for change in changes:
+        old = json.loads(change["old_row"]) if change["old_row"] is not None else None
+        new = json.loads(change["new_row"]) if change["new_row"] is not None else None
+        key = (new or old)[TABLE_KEYS[change["table_name"]]]
+        versions, _ = net[change["table_name"]].get(key, ([], None))
+        versions.extend(row for row in (old, new) if row is not None)
+        net[change["table_name"]][key] = versions, new
+    return net
+
+
+def key(value: int) -> str:
+    """
+    An INT32 primary key as a literal. Kùzu only plans a primary key lookup when the key is a
+    literal of the type of the key, so ids are inlined rather than passed as parameters
+    """
+    return f"CAST({int(value)} AS INT32)"
+
+
+def apply_person_change(conn: kuzu.Connection, versions: list[Row], row: Row | None) -> None:
+    person_id = key(versions[-1]["id"])
+    response = conn.execute(
+        f"MATCH (p:Person {{id: {person_id}}})-[:LivesIn]->(a:Address) RETURN a.address"
+    )
+    addresses = [address for (address,) in response.get_all()]
+    if row is None:
+        conn.execute(f"MATCH (p:Person {{id: {person_id}}}) DETACH DELETE p")
+    else:
+        conn.execute(
+            f"MERGE (p:Person {{id: {person_id}}}) SET p.name = $name, p.email = $email",
+            parameters={"name": row["name"], "email": row["email"]},
+        )
+        if row["address"] not in addresses:
+            conn.execute(
+                f"""
+                MATCH (p:Person {{id: {person_id}}})
+                MERGE (a:Address {{address: $address}})
+                CREATE (p)-[:LivesIn]->(a)
+                """,
+                parameters={"address": row["address"]},
+            )
+    # Unlink the person from its earlier addresses, and delete those that nobody else lives in
+    for address in addresses:
+        if row is not None and address == row["address"]:
+            continue
+        conn.execute(
+            f"""
+            MATCH (p:Person {{id: {person_id}}})-[l:LivesIn]->(a:Address {{address: $address}})
+            DELETE l
+            """,
+            parameters={"address": address},
+        )
+        conn.execute(
+            """
+            MATCH (a:Address {address: $address})
+            WHERE NOT EXISTS { MATCH (a)<-[:LivesIn]-(:Person) }
+            DELETE a
+            """,
+            parameters={"address": address},
+        )
+
+
+def apply_account_change(conn: kuzu.Connection, versions: list[Row], row: Row | None) -> None:
+    account_id = key(versions[-1]["id"])
+    if row is None:
+        conn.execute(f"MATCH (a:Account {{id: {account_id}}}) DETACH DELETE a")
+        return
+    conn.execute(
+        f"""
+        MERGE (a:Account {{id: {account_id}}})
+        SET a.account_id = $account_id, a.balance = $balance
+        """,
+        parameters={"account_id": row["account_id"], "balance": row["balance"]},
+    )
+    response = conn.execute(
+        f"MATCH (a:Account {{id: {account_id}}})<-[:Owns]-(p:Person) RETURN p.id"
+    )
+    owners = [owner for (owner,) in response.get_all()]
+    for owner in owners:
+        if owner != row["owner"]:
+            conn.execute(
+                f"""
+                MATCH (p:Person {{id: {key(owner)}}})-[o:Owns]->(a:Account {{id: {account_id}}})
+                DELETE o
+                """
+            )
+    if row["owner"] not in owners:
+        conn.execute(
+            f"""
+            MATCH (p:Person {{id: {key(row["owner"])}}}), (a:Account {{id: {account_id}}})
+            CREATE (p)-[:Owns]->(a)
+            """
+        )
+
+
+def apply_transfer_change(conn: kuzu.Connection, versions: list[Row], row: Row | None) -> None:
+    # The rel of the transfer is deleted from the source account of any of its versions, and
+    # created again from its final version
+    transaction_id = versions[-1]["transaction_id"]
+    for source in {version["source"] for version in versions}:
+        conn.execute(
+            f"""
+            MATCH (a:Account {{id: {key(source)}}})-[t:Transfer]->(:Account)
+            WHERE t.transaction_id = $transaction_id
+            DELETE t
+            """,
+            parameters={"transaction_id": transaction_id},
+        )
+    if row is not None:
+        conn.execute(
+            f"""
+            MATCH (a:Account {{id: {key(row["source"])}}}), (b:Account {{id: {key(row["target"])}}})
+            CREATE (a)-[:Transfer {{amount: $amount, transaction_id: $transaction_id}}]->(b)
+            """,
+            parameters={"amount": row["amount"], "transaction_id": transaction_id},
+        )
+
+
+APPLY_CHANGE = {
+    "person": apply_person_change,
+    "account": apply_account_change,
+    "transfer": apply_transfer_change,
+}
+
+
+async def sync_changes(
+    pool: Pool, conn: kuzu.Connection, max_changes: int = 10_000
+) -> int | None:
+    """
+    Apply the logged changes to the Kùzu copy, and delete them from the log. Returns the number of
+    changes applied, or None if a table was truncated or more than `max_changes` were logged, in
+    which case nothing is applied, and the tables are better copied in full
+    """
+    changes = await get_changes(pool, max_changes + 1)
+    if len(changes) > max_changes or any(change["op"] == "T" for change in changes):
+        return None
+    if not changes:
+        return 0
+    net = reduce_changes(changes)
+    conn.execute("BEGIN TRANSACTION;")
+    try:
+        # Tables are synced in load order, so that rels are created after their endpoints
+        for table, rows in net.items():
+            for versions, row in rows.values():
+                APPLY_CHANGE[table](conn, versions, row)
+        changed = [name for table, rows in net.items() if rows for name in KUZU_TABLES[table]]
+        bump_table_versions(conn, changed)
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+    conn.execute("COMMIT;")
+    await delete_changes(pool, [change["change_id"] for change in changes])
+    return len(changes)
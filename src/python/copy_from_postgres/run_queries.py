@@ -0,0 +1,47 @@
+"""
+Run the Cypher queries in `./queries` on the Kùzu database created by `copy_pg_to_kuzu.py`.
+"""
+import argparse
+from pathlib import Path
+
+import kuzu
+from demo_utils.query_profile import ProfiledConnection
+
+
+def read_query(file_path: Path) -> str:
+    "Read a query file, dropping its `//` comment lines"
+    with open(file_path) as file:
+        lines = [line for line in file if not line.lstrip().startswith("//")]
+    return "".join(lines).strip()
+
+
+def main(conn: kuzu.Connection, query_files: list[Path]) -> None:
+    for file_path in query_files:
+        query = read_query(file_path)
+        print(f"\n--- {file_path.name} ---\n{query}")
+        print(conn.execute(query).get_as_df())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "queries",
+        type=Path,
+        nargs="*",
+        help="Query files to run (defaults to all files in ./queries)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Also run each query under PROFILE and write its operator tree to ./query_profiles",
+    )
+    args = parser.parse_args()
+
+    db = kuzu.Database("./ex_db_kuzu")
+    conn = kuzu.Connection(db)
+    if args.profile:
+        conn = ProfiledConnection(conn)
+
+    main(conn, args.queries or sorted(Path("./queries").glob("*.cypher")))
+    if args.profile:
+        conn.write_profiles("queries")
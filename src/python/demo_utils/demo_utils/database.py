@@ -0,0 +1,19 @@
+"""
+Helpers for managing the Kùzu database files of the demos.
+"""
+from __future__ import annotations
+
+import shutil
+from pathlib import Path
+
+
+def remove_database(db_path: str | Path) -> None:
+    """
+    Delete a database along with its write-ahead log. Kùzu stores a database as a
+    single file, but older versions used a directory, so both are handled
+    """
+    for path in [Path(db_path), Path(f"{db_path}.wal")]:
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
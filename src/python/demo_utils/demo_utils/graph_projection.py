@@ -0,0 +1,264 @@
+"""
+Persistent CSR projections of rel tables, for analytics that would otherwise re-read the graph
+from Kùzu on every run.
+
+A projection numbers the nodes that take part in a rel table 0..n-1, one node table after the
+other, and stores its edges in compressed sparse row (CSR) form in both directions, along with any
+rel properties requested as weights (e.g. `amount_usd`). Parallel edges are kept, one per rel.
+
+The arrays are saved as `.npy` files under `graph_projections/<rel table>/<version>/`, where the
+version is the one recorded for the rel table by `query_cache.bump_table_versions`. Later runs
+memory-map the files instead of querying Kùzu, so they start in milliseconds, and processes that
+map the same projection share its pages through the OS page cache. Any write to the rel table bumps
+its version, so the next run exports a fresh projection and removes the stale one.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import mmap
+import shutil
+import tempfile
+import time
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import kuzu
+import numpy as np
+import pyarrow as pa
+
+from demo_utils.query_cache import get_table_versions
+
+PROJECTION_PATH = Path("./graph_projections")
+CSR_ARRAYS = ("offsets", "targets", "in_offsets", "in_sources", "in_edges")
+
+
+@dataclass
+class Projection:
+    """
+    Out-edges of node i are `targets[offsets[i]:offsets[i + 1]]`, and its in-edges are
+    `in_sources[in_offsets[i]:in_offsets[i + 1]]`. `in_edges` holds the position of each in-edge
+    in the out-edge arrays, so that the weights, which follow the order of `targets`, can be read
+    for either direction
+    """
+
+    rel_table: str
+    version: int | None
+    node_tables: list[str]
+    node_ids: dict[str, np.ndarray]
+    offsets: np.ndarray
+    targets: np.ndarray
+    in_offsets: np.ndarray
+    in_sources: np.ndarray
+    in_edges: np.ndarray
+    weights: dict[str, np.ndarray] = field(default_factory=dict)
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.targets)
+
+    def node_range(self, table: str) -> range:
+        "Node numbers of the nodes of a node table"
+        start = 0
+        for name in self.node_tables:
+            if name == table:
+                return range(start, start + len(self.node_ids[name]))
+            start += len(self.node_ids[name])
+        raise KeyError(table)
+
+    def node_index(self, table: str, ids: Sequence | np.ndarray) -> np.ndarray:
+        "Node numbers of the given primary keys of a node table"
+        keys = self.node_ids[table]
+        positions = np.searchsorted(keys, ids)
+        found = positions < len(keys)
+        found[found] = keys[positions[found]] == np.asarray(ids)[found]
+        if not found.all():
+            missing = np.asarray(ids)[~found]
+            raise KeyError(f"{table} nodes without {self.rel_table} edges: {missing}")
+        return self.node_range(table).start + positions
+
+    def sources(self) -> np.ndarray:
+        "Source node of every edge, in the order of `targets`"
+        return np.repeat(np.arange(self.num_nodes), np.diff(self.offsets))
+
+
+def get_rel_endpoints(conn: kuzu.Connection, rel_table: str) -> tuple[str, str, str, str]:
+    "Source table, destination table and their primary keys"
+    response = conn.execute(f"CALL show_connection('{rel_table}') RETURN *;")
+    src_table, dst_table, src_key, dst_key = response.get_next()
+    return src_table, dst_table, src_key, dst_key
+
+
+def to_numpy(column: pa.ChunkedArray) -> np.ndarray:
+    values = column.to_numpy()
+    # Strings come back as Python objects, which cannot be memory-mapped
+    return values.astype(str) if values.dtype == object else values
+
+
+def build_projection(
+    conn: kuzu.Connection, rel_table: str, weights: Sequence[str] = (), version: int | None = None
+) -> Projection:
+    src_table, dst_table, src_key, dst_key = get_rel_endpoints(conn, rel_table)
+    columns = "".join(f", r.{weight} AS {weight}" for weight in weights)
+    edges = conn.execute(
+        f"""
+        MATCH (a:{src_table})-[r:{rel_table}]->(b:{dst_table})
+        RETURN a.{src_key} AS source, b.{dst_key} AS target{columns};
+        """
+    ).get_as_arrow()
+    sources, targets = to_numpy(edges["source"]), to_numpy(edges["target"])
+
+    if src_table == dst_table:
+        ids, nodes = np.unique(np.concatenate([sources, targets]), return_inverse=True)
+        node_ids = {src_table: ids}
+        src, dst = nodes[: len(sources)], nodes[len(sources) :]
+    else:
+        src_ids, src = np.unique(sources, return_inverse=True)
+        dst_ids, dst = np.unique(targets, return_inverse=True)
+        dst = dst + len(src_ids)
+        node_ids = {src_table: src_ids, dst_table: dst_ids}
+    num_nodes = sum(len(ids) for ids in node_ids.values())
+    index_type = np.int32 if num_nodes < 2**31 else np.int64
+
+    order = np.argsort(src, kind="stable")
+    dst = dst[order]
+    in_edges = np.argsort(dst, kind="stable").astype(index_type)
+    return Projection(
+        rel_table=rel_table,
+        version=version,
+        node_tables=list(node_ids),
+        node_ids=node_ids,
+        offsets=get_offsets(src, num_nodes),
+        targets=dst.astype(index_type),
+        in_offsets=get_offsets(dst, num_nodes),
+        in_sources=src[order][in_edges].astype(index_type),
+        in_edges=in_edges,
+        weights={weight: to_numpy(edges[weight])[order] for weight in weights},
+    )
+
+
+def get_offsets(nodes: np.ndarray, num_nodes: int) -> np.ndarray:
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(nodes, minlength=num_nodes), out=offsets[1:])
+    return offsets
+
+
+def save_projection(projection: Projection, path: Path = PROJECTION_PATH) -> Path:
+    """
+    Save a projection under `path`, and remove the projections of older versions. The files are
+    written to a temporary directory that is renamed into place, so that readers never see a
+    partial projection, and processes that still map a removed projection keep their pages
+    """
+    rel_path = path / projection.rel_table
+    rel_path.mkdir(parents=True, exist_ok=True)
+    directory = rel_path / str(projection.version)
+    tmp = Path(tempfile.mkdtemp(prefix=".tmp-", dir=rel_path))
+    tmp.chmod(0o755)
+    for name in CSR_ARRAYS:
+        np.save(tmp / f"{name}.npy", getattr(projection, name))
+    for table, ids in projection.node_ids.items():
+        np.save(tmp / f"nodes_{table}.npy", ids)
+    for weight, values in projection.weights.items():
+        np.save(tmp / f"weight_{weight}.npy", values)
+    meta = {
+        "rel_table": projection.rel_table,
+        "version": projection.version,
+        "node_tables": projection.node_tables,
+        "weights": list(projection.weights),
+        "num_nodes": projection.num_nodes,
+        "num_edges": projection.num_edges,
+    }
+    (tmp / "meta.json").write_text(json.dumps(meta, indent=2))
+
+    if directory.exists():
+        # A projection of the same version with fewer weights
+        directory.rename(tempfile.mkdtemp(prefix=".stale-", dir=rel_path))
+    try:
+        tmp.rename(directory)
+    except OSError:
+        # Another process saved the same version first
+        shutil.rmtree(tmp)
+    for entry in rel_path.iterdir():
+        # Temporary directories may belong to exports in progress in other processes
+        if entry != directory and not entry.name.startswith(".tmp-"):
+            shutil.rmtree(entry, ignore_errors=True)
+    return directory
+
+
+def load_projection(directory: Path) -> Projection:
+    "Memory-map a saved projection"
+    meta = json.loads((directory / "meta.json").read_text())
+
+    def load(name: str) -> np.ndarray:
+        return np.load(directory / f"{name}.npy", mmap_mode="r")
+
+    return Projection(
+        rel_table=meta["rel_table"],
+        version=meta["version"],
+        node_tables=meta["node_tables"],
+        node_ids={table: load(f"nodes_{table}") for table in meta["node_tables"]},
+        **{name: load(name) for name in CSR_ARRAYS},
+        weights={weight: load(f"weight_{weight}") for weight in meta["weights"]},
+    )
+
+
+def get_projection(
+    conn: kuzu.Connection,
+    rel_table: str,
+    weights: Sequence[str] = (),
+    path: Path = PROJECTION_PATH,
+) -> Projection:
+    """
+    Memory-map the projection of the current version of a rel table, exporting it from Kùzu first
+    if it has not been saved yet, or was saved without some of the requested weights
+    """
+    version = get_table_versions(conn).get(rel_table)
+    if version is None:
+        # With no version recorded, a saved projection cannot be told apart from a stale one
+        return build_projection(conn, rel_table, weights)
+    directory = path / rel_table / str(version)
+    if (directory / "meta.json").exists():
+        projection = load_projection(directory)
+        if set(weights) <= set(projection.weights):
+            return projection
+        weights = [*projection.weights, *(w for w in weights if w not in projection.weights)]
+    projection = build_projection(conn, rel_table, weights, version)
+    return load_projection(save_projection(projection, path))
+
+
+def shareable(array: np.ndarray) -> np.ndarray | str:
+    """
+    A memory-mapped `.npy` file is passed to worker processes by name, so that each worker maps
+    the same pages rather than receiving a pickled copy. Slices of a mapped array are passed as is
+    """
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap):
+        return str(array.filename)
+    return array
+
+
+def unshare(array: np.ndarray | str) -> np.ndarray:
+    return np.load(array, mmap_mode="r") if isinstance(array, str) else array
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("db", help="Path of the Kùzu database")
+    parser.add_argument("rel_table")
+    parser.add_argument("--weight", action="append", default=[], help="Rel property to store")
+    args = parser.parse_args()
+
+    db = kuzu.Database(args.db)
+    conn = kuzu.Connection(db)
+    for attempt in ["first", "second"]:
+        start = time.perf_counter()
+        projection = get_projection(conn, args.rel_table, args.weight)
+        print(
+            f"{attempt} load: {projection.num_nodes} nodes and {projection.num_edges} edges of "
+            f"{args.rel_table} (version {projection.version}) in "
+            f"{time.perf_counter() - start:.3f}s"
+        )
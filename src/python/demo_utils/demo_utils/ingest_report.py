@@ -0,0 +1,134 @@
+"""
+Instrumentation for the COPY and DDL statements run by the loader scripts.
+
+Wrap a connection with `InstrumentedConnection` and call `write_report()` at the end of a run to
+emit a JSON report with the wall time, rows loaded, input bytes and rows/sec of each statement.
+Other statements are passed through to the connection untouched.
+
+Each statement also records `process_peak_rss_bytes`, the peak RSS of the process up to the end of
+the statement (`ru_maxrss`). It is a high-water mark that never decreases, so it is not the peak of
+the statement itself: a statement only shows up in it when it raises the peak above that of every
+earlier statement.
+"""
+from __future__ import annotations
+
+import glob
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+import kuzu
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+DDL_KEYWORDS = ("CREATE", "ALTER", "DROP")
+WRITE_CLAUSE = re.compile(r"\b(MERGE|CREATE|SET)\b", re.IGNORECASE)
+ROWS_COPIED = re.compile(r"(\d+)[^.]*copied")
+FILE_PATH = re.compile(r"FROM\s+'([^']+)'", re.IGNORECASE)
+
+
+def get_peak_rss_bytes() -> int | None:
+    "Peak RSS of the process since it started"
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_input_bytes(query: str) -> int | None:
+    paths = [path for pattern in FILE_PATH.findall(query) for path in glob.glob(pattern)]
+    if not paths:
+        return None
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def is_ingest_statement(statement: str) -> bool:
+    """
+    COPY and DDL statements, as well as `LOAD FROM ... MERGE/CREATE` upserts
+    """
+    keyword = statement.split(" ", 1)[0].upper()
+    if keyword == "LOAD":
+        return WRITE_CLAUSE.search(statement) is not None
+    return keyword == "COPY" or keyword in DDL_KEYWORDS
+
+
+def get_rows_loaded(result: kuzu.QueryResult) -> int | None:
+    """
+    Parse the number of copied tuples from the message returned by COPY
+    """
+    if not result.has_next():
+        return None
+    match = ROWS_COPIED.search(str(result.get_next()[0]))
+    result.reset_iterator()
+    return int(match.group(1)) if match else None
+
+
+class InstrumentedConnection:
+    """
+    Drop-in wrapper around `kuzu.Connection` that records statistics for ingest statements
+    """
+
+    def __init__(self, conn: kuzu.Connection):
+        self._conn = conn
+        self.statements: list[dict[str, Any]] = []
+        self.started_at = datetime.now()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+    def execute(self, query: str, parameters: dict[str, Any] | None = None) -> Any:
+        statement = " ".join(query.split())
+        if not is_ingest_statement(statement):
+            return self._conn.execute(query, parameters or {})
+
+        start = time.perf_counter()
+        result = self._conn.execute(query, parameters or {})
+        wall_time = time.perf_counter() - start
+
+        rows_loaded = None
+        if statement.upper().startswith("COPY"):
+            results = result if isinstance(result, list) else [result]
+            rows = [n for n in map(get_rows_loaded, results) if n is not None]
+            rows_loaded = sum(rows) if rows else None
+        self.statements.append(
+            {
+                "statement": statement,
+                "wall_time_s": round(wall_time, 6),
+                "rows_loaded": rows_loaded,
+                "input_bytes": get_input_bytes(query),
+                "rows_per_s": round(rows_loaded / wall_time, 1) if rows_loaded else None,
+                "process_peak_rss_bytes": get_peak_rss_bytes(),
+            }
+        )
+        return result
+
+    def write_report(self, name: str, directory: str | Path = "ingest_reports") -> Path:
+        """
+        Write the report for this run to `<directory>/<name>_<timestamp>.json`
+        """
+        total_time = sum(s["wall_time_s"] for s in self.statements)
+        total_rows = sum(s["rows_loaded"] or 0 for s in self.statements)
+        report = {
+            "name": name,
+            "started_at": self.started_at.isoformat(),
+            "kuzu_version": kuzu.__version__,
+            "total_wall_time_s": round(total_time, 6),
+            "total_rows_loaded": total_rows,
+            "process_peak_rss_bytes": get_peak_rss_bytes(),
+            "statements": self.statements,
+        }
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        path = Path(directory) / f"{name}_{self.started_at:%Y%m%d_%H%M%S}.json"
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote ingest report for {len(self.statements)} statements to {path}")
+        return path
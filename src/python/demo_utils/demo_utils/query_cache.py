@@ -0,0 +1,169 @@
+"""
+Result cache for repeated read queries, invalidated by table-level write versions.
+
+Writers (the loaders and the dispute marker) call `bump_table_versions` with the tables they
+modified. Cached results are keyed by the normalized Cypher text and parameters, and are stamped
+with the versions of the tables that the query reads, so a write to any of those tables makes the
+entry stale. Least recently used entries are evicted once the cache exceeds its size limits.
+
+The versions themselves are kept in process: each call to `bump_table_versions` also advances a
+write counter, and the cache only reads the versions back from Kùzu when the counter has moved
+since it last read them, so a cache hit does not run any query. Only one process at a time can open
+a database for writing, so the writes of other processes are picked up when the database is opened
+again, which is seen as a new database.
+"""
+from __future__ import annotations
+
+import itertools
+import re
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import TYPE_CHECKING, Any
+
+import kuzu
+
+if TYPE_CHECKING:
+    # Only the cache itself handles DataFrames, so the writers do not need pandas
+    import pandas as pd
+
+VERSION_TABLE = "TableVersion"
+# A label, or an alternation of labels such as `[t:TransactedWith_2024_01|TransactedWith_2024_02]`
+LABEL = re.compile(r":\s*(\w+(?:\s*\|\s*\w+)*)")
+# A relationship pattern without a label, e.g. `-[]->` or `-[*1..2]->`, can match any rel table
+UNLABELED_REL = re.compile(r"\[\s*\w*\s*(\*[^\]]*)?\]")
+
+_writes = itertools.count(1)
+# Number of calls to `bump_table_versions` in this process
+_write_count = 0
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.split()).rstrip(";")
+
+
+def get_referenced_tables(query: str) -> frozenset[str] | None:
+    """
+    Return the node and rel tables that a query reads, or None if it may read any table
+    """
+    if UNLABELED_REL.search(query):
+        return None
+    return frozenset(
+        label.strip() for labels in LABEL.findall(query) for label in labels.split("|")
+    )
+
+
+def create_table_versions(conn: kuzu.Connection) -> None:
+    conn.execute(
+        f"""
+        CREATE NODE TABLE IF NOT EXISTS
+            {VERSION_TABLE}(
+                name STRING,
+                version INT64,
+                PRIMARY KEY (name)
+            )
+        """
+    )
+
+
+def bump_table_versions(conn: kuzu.Connection, tables: list[str]) -> int:
+    """
+    Mark the given tables as modified, and return the write count of the process. Versions are
+    nanosecond timestamps rather than counters, so that they never repeat, even when the database
+    is rebuilt from scratch
+    """
+    global _write_count
+    create_table_versions(conn)
+    conn.execute(
+        f"""
+        UNWIND $tables AS name
+        MERGE (v:{VERSION_TABLE} {{name: name}})
+        SET v.version = $version
+        """,
+        parameters={"tables": tables, "version": time.time_ns()},
+    )
+    # Advanced after the write, so that versions read at the previous count are re-read
+    _write_count = next(_writes)
+    return _write_count
+
+
+def get_table_versions(conn: kuzu.Connection) -> dict[str, int]:
+    try:
+        response = conn.execute(f"MATCH (v:{VERSION_TABLE}) RETURN v.name, v.version")
+    except RuntimeError:
+        # No writer has recorded a version yet
+        return {}
+    return dict(response.get_all())
+
+
+class QueryCache:
+    """
+    LRU cache of query results as pandas DataFrames, bounded by the number of entries and by
+    their total memory footprint. Cached DataFrames are shared, so callers should not modify them
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 256 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[tuple, pd.DataFrame, int]] = OrderedDict()
+        self._bytes = 0
+        # Table versions of each open database, with the write count they were read at
+        self._versions: weakref.WeakKeyDictionary[kuzu.Database, tuple[int, dict[str, int]]] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def get_or_execute(
+        self,
+        conn: kuzu.Connection,
+        query: str,
+        parameters: dict[str, Any],
+        execute: Callable[[], pd.DataFrame],
+    ) -> pd.DataFrame:
+        key = (id(conn.database), normalize_query(query), tuple(sorted(parameters.items())))
+        stamp = self._get_stamp(conn, query)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        result = execute()
+        self._put(key, stamp, result)
+        return result
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+        self._versions.clear()
+
+    def _get_versions(self, conn: kuzu.Connection) -> dict[str, int]:
+        write_count = _write_count
+        cached = self._versions.get(conn.database)
+        if cached is not None and cached[0] == write_count:
+            return cached[1]
+        versions = get_table_versions(conn)
+        self._versions[conn.database] = (write_count, versions)
+        return versions
+
+    def _get_stamp(self, conn: kuzu.Connection, query: str) -> tuple:
+        versions = self._get_versions(conn)
+        tables = get_referenced_tables(query)
+        if tables is None:
+            return tuple(sorted(versions.items()))
+        return tuple(sorted((name, versions.get(name, 0)) for name in tables))
+
+    def _put(self, key: tuple, stamp: tuple, result: pd.DataFrame) -> None:
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[2]
+        size = int(result.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (stamp, result, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
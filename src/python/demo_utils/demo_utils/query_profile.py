@@ -0,0 +1,273 @@
+"""
+Capture Kùzu `PROFILE` plans for the read queries run through a connection.
+
+Wrap a connection with `ProfiledConnection` and call `write_profiles()` at the end of a run to emit
+a JSON file with the text, parameters and operator tree of each query, including the time and
+number of output tuples of every operator. Two such files (for example, from runs on different
+data sizes) can be compared with:
+
+    python -m demo_utils.query_profile before.json after.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import re
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+import kuzu
+
+OPERATOR = re.compile(r"^(\w+)\[(\d+)\]$")
+METRIC = re.compile(r"^(NumOutputTuples|ExecutionTime):\s*([\d.]+)$")
+WRITE_CLAUSE = re.compile(
+    r"\b(COPY|CREATE|MERGE|SET|DELETE|DETACH|REMOVE|DROP|ALTER|INSTALL|LOAD EXTENSION|ATTACH)\b",
+    re.IGNORECASE,
+)
+
+
+def is_read_query(query: str) -> bool:
+    """
+    PROFILE executes the statement, so only queries without side effects are profiled
+    """
+    return WRITE_CLAUSE.search(query) is None and not query.lstrip().upper().startswith(
+        ("PROFILE", "EXPLAIN", "CALL")
+    )
+
+
+def parse_boxes(plan: str) -> list[dict[str, Any]]:
+    """
+    Find the boxes in the drawing printed by PROFILE, with their position and text lines, and link
+    each one to the box that its incoming connector leads to. Connectors run straight up to the
+    parent, or up and then left along a horizontal line to the parent's right border. In wide
+    plans, the horizontal line of a HASH_JOIN_BUILD can stop short of the border of its
+    HASH_JOIN_PROBE, so a connector that leads nowhere is linked to the box to its left in the row
+    above, which is where the probe is drawn
+    """
+    lines = plan.splitlines()
+
+    def char_at(y: int, x: int) -> str:
+        return lines[y][x] if 0 <= y < len(lines) and x < len(lines[y]) else " "
+
+    boxes = []
+    for top, line in enumerate(lines):
+        for left in [m.start() for m in re.finditer("┌", line)]:
+            right = line.index("┐", left)
+            bottom = next(y for y in range(top + 1, len(lines)) if char_at(y, left) == "└")
+            content = [
+                text
+                for text in (lines[y][left + 1 : right].strip(" │") for y in range(top + 1, bottom))
+                if text and not text.startswith("---")
+            ]
+            boxes.append(
+                {"top": top, "bottom": bottom, "left": left, "right": right, "lines": content}
+            )
+
+    def box_at(y: int, x: int) -> int | None:
+        for i, box in enumerate(boxes):
+            if box["top"] <= y <= box["bottom"] and box["left"] <= x <= box["right"]:
+                return i
+        return None
+
+    for box in boxes:
+        box["parent"] = None
+        x = lines[box["top"]].find("┴", box["left"], box["right"])
+        if x < 0:
+            continue
+        y = box["top"] - 1
+        while char_at(y, x) == "│" and box_at(y, x) is None:
+            y -= 1
+        if box_at(y, x) is None:
+            # A horizontal connector from the right border of the parent
+            while char_at(y, x) in "─┬┐":
+                x -= 1
+        box["parent"] = box_at(y, x)
+        if box["parent"] is None:
+            tops = [other["top"] for other in boxes if other["top"] < box["top"]]
+            above = max(tops, default=None)
+            box["parent"] = max(
+                (
+                    i
+                    for i, other in enumerate(boxes)
+                    if other["top"] == above and other["right"] < box["left"]
+                ),
+                key=lambda i: boxes[i]["left"],
+                default=None,
+            )
+    return boxes
+
+
+def parse_profile(plan: str) -> list[dict[str, Any]]:
+    """
+    Parse the operator tree printed by PROFILE into a list of operators, from the root down.
+    Each operator records its parent, its output tuples and time (in ms), and its fanout: the
+    ratio of its output tuples to those of its children, which shows where cardinality blows up
+    """
+    boxes = parse_boxes(plan)
+    operators: list[dict[str, Any]] = []
+    ids: dict[int, int] = {}
+    for i, box in enumerate(boxes):
+        match = OPERATOR.match(box["lines"][0]) if box["lines"] else None
+        if match is None:
+            # The "Physical Plan" header
+            continue
+        ids[i] = int(match.group(2))
+        operator = {
+            "id": ids[i],
+            "name": match.group(1),
+            "parent_id": box["parent"],
+            "details": [],
+            "num_output_tuples": None,
+            "execution_time_ms": None,
+        }
+        for line in box["lines"][1:]:
+            metric = METRIC.match(line)
+            if metric is None:
+                operator["details"].append(line)
+            elif metric.group(1) == "NumOutputTuples":
+                operator["num_output_tuples"] = int(metric.group(2))
+            else:
+                operator["execution_time_ms"] = float(metric.group(2))
+        operators.append(operator)
+
+    for operator in operators:
+        operator["parent_id"] = ids.get(operator["parent_id"])
+    for operator in operators:
+        child_tuples = [
+            child["num_output_tuples"] or 0
+            for child in operators
+            if child["parent_id"] == operator["id"]
+        ]
+        operator["fanout"] = (
+            round(operator["num_output_tuples"] / sum(child_tuples), 3)
+            if sum(child_tuples) and operator["num_output_tuples"] is not None
+            else None
+        )
+    return operators
+
+
+def profile_query(
+    conn: kuzu.Connection, query: str, parameters: dict[str, Any] | None = None
+) -> dict[str, Any]:
+    response = conn.execute(f"PROFILE {query}", parameters or {})
+    plan = "\n".join(str(row[0]) for row in response.get_all())
+    return {
+        "query": " ".join(query.split()),
+        "parameters": parameters or {},
+        "compiling_time_ms": response.get_compiling_time(),
+        "execution_time_ms": response.get_execution_time(),
+        "operators": parse_profile(plan),
+    }
+
+
+class ProfiledConnection:
+    """
+    Drop-in wrapper around `kuzu.Connection` that also runs each read query under PROFILE.
+    Statements prepared through the wrapper are profiled when they are executed
+    """
+
+    def __init__(self, conn: kuzu.Connection):
+        self._conn = conn
+        self._prepared: dict[int, tuple[kuzu.PreparedStatement, str]] = {}
+        self.profiles: list[dict[str, Any]] = []
+        self.started_at = datetime.now()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+    def prepare(self, query: str) -> kuzu.PreparedStatement:
+        prepared = self._conn.prepare(query)
+        self._prepared[id(prepared)] = (prepared, query)
+        return prepared
+
+    def execute(self, query: Any, parameters: dict[str, Any] | None = None) -> Any:
+        result = self._conn.execute(query, parameters or {})
+        if id(query) in self._prepared:
+            query = self._prepared[id(query)][1]
+        if isinstance(query, str) and is_read_query(query):
+            self.profiles.append(profile_query(self._conn, query, parameters))
+        return result
+
+    def write_profiles(self, name: str, directory: str | Path = "query_profiles") -> Path:
+        """
+        Write the profiles for this run to `<directory>/<name>_<timestamp>.json`
+        """
+        report = {
+            "name": name,
+            "started_at": self.started_at.isoformat(),
+            "kuzu_version": kuzu.__version__,
+            "profiles": self.profiles,
+        }
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        path = Path(directory) / f"{name}_{self.started_at:%Y%m%d_%H%M%S}.json"
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote profiles for {len(self.profiles)} queries to {path}")
+        return path
+
+
+def compare_profiles(before: dict[str, Any], after: dict[str, Any]) -> list[dict[str, Any]]:
+    """
+    Pair up the operators of the queries found in both reports and compute the growth of their
+    output tuples and time. Operators that are missing on either side indicate a plan change
+    """
+    after_profiles = {(p["query"], json.dumps(p["parameters"])): p for p in after["profiles"]}
+    rows = []
+    for profile in before["profiles"]:
+        other = after_profiles.get((profile["query"], json.dumps(profile["parameters"])))
+        if other is None:
+            continue
+        before_ops = {(op["id"], op["name"]): op for op in profile["operators"]}
+        after_ops = {(op["id"], op["name"]): op for op in other["operators"]}
+        for key in sorted(before_ops.keys() | after_ops.keys()):
+            old, new = before_ops.get(key, {}), after_ops.get(key, {})
+            old_tuples, new_tuples = old.get("num_output_tuples"), new.get("num_output_tuples")
+            rows.append(
+                {
+                    "query": profile["query"],
+                    "operator": f"{key[1]}[{key[0]}]",
+                    "tuples_before": old_tuples,
+                    "tuples_after": new_tuples,
+                    "tuples_growth": round(new_tuples / old_tuples, 3)
+                    if old_tuples and new_tuples is not None
+                    else None,
+                    "time_ms_before": old.get("execution_time_ms"),
+                    "time_ms_after": new.get("execution_time_ms"),
+                }
+            )
+    return rows
+
+
+def print_comparison(rows: list[dict[str, Any]]) -> None:
+    query = None
+    for row in rows:
+        if row["query"] != query:
+            query = row["query"]
+            print(f"\n{query}")
+            print(
+                f"{'operator':<28} {'tuples before':>14} {'tuples after':>14} {'growth':>8} "
+                f"{'ms before':>10} {'ms after':>10}"
+            )
+        print(
+            f"{row['operator']:<28} {str(row['tuples_before']):>14} {str(row['tuples_after']):>14} "
+            f"{str(row['tuples_growth']):>8} {str(row['time_ms_before']):>10} "
+            f"{str(row['time_ms_after']):>10}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the query profiles of two runs")
+    parser.add_argument("before", type=Path)
+    parser.add_argument("after", type=Path)
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    rows = compare_profiles(before, after)
+    if not rows:
+        sys.exit("No queries in common between the two profiles")
+    print_comparison(rows)
@@ -0,0 +1,192 @@
+"""
+Monthly partitions of TransactedWith, for analytics over a time window.
+
+Every month of transactions is also stored in a rel table of its own, `TransactedWith_<YYYY>_<MM>`,
+with the same endpoints and properties as TransactedWith. A query over a window only matches the
+partitions that overlap it, with a label alternation such as
+`[t:TransactedWith_2024_05|TransactedWith_2024_06]`, and filters them on the timestamp, so that its
+cost scales with the window rather than with the full history. TransactedWith still holds the full
+history, so that queries over all of it, and the writers that update it, are unchanged.
+
+Every transaction is thus stored twice, so the partitions double the disk space taken by
+TransactedWith. The loaders fill the partitions in a single pass over the file that TransactedWith
+is copied from, which is split by month into one Parquet file per partition, and writers that add
+transactions also insert them into their partitions. Each partition has its own entry in the table
+versions (see `demo_utils.query_cache`), so writes to one month do not invalidate results computed
+over the others.
+"""
+from __future__ import annotations
+
+import datetime
+import re
+import tempfile
+from collections.abc import Iterable, Iterator
+
+import kuzu
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+PARTITIONED_TABLE = "TransactedWith"
+PARTITION_NAME = re.compile(rf"^{PARTITIONED_TABLE}_(\d{{4}})_(\d{{2}})$")
+
+Window = tuple[datetime.datetime, datetime.datetime]
+
+
+def partition_name(month: datetime.date) -> str:
+    return f"{PARTITIONED_TABLE}_{month.year:04d}_{month.month:02d}"
+
+
+def get_partitions(conn: kuzu.Connection) -> dict[datetime.date, str]:
+    "Partition tables by the first day of their month, in order"
+    response = conn.execute("CALL show_tables() RETURN name;")
+    partitions = {}
+    for (name,) in response.get_all():
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions[datetime.date(int(match[1]), int(match[2]), 1)] = name
+    return dict(sorted(partitions.items()))
+
+
+def get_window_partitions(conn: kuzu.Connection, window: Window) -> list[str]:
+    "Partitions with a month that overlaps the window [start, end)"
+    start, end = window
+    first_month = datetime.date(start.year, start.month, 1)
+    return [
+        name
+        for month, name in get_partitions(conn).items()
+        if first_month <= month and datetime.datetime(month.year, month.month, 1) < end
+    ]
+
+
+def get_partition_label(conn: kuzu.Connection, window: Window) -> str:
+    """
+    Label alternation that matches the partitions of a window, for use in a rel pattern in place
+    of TransactedWith
+    """
+    partitions = get_window_partitions(conn, window)
+    if not partitions:
+        raise ValueError(f"No {PARTITIONED_TABLE} partitions overlap {window[0]} to {window[1]}")
+    return "|".join(partitions)
+
+
+def get_window(
+    conn: kuzu.Connection,
+    days: int | None = None,
+    start: datetime.datetime | None = None,
+    end: datetime.datetime | None = None,
+) -> Window | None:
+    """
+    Resolve the window of an analysis: the last `days` calendar days up to the most recent
+    transaction, or the dates given, with a missing start or end left open. Returns None when no
+    window is requested, i.e. for the full history
+    """
+    if days is None and start is None and end is None:
+        return None
+    partitions = get_partitions(conn)
+    if not partitions:
+        raise ValueError(f"{PARTITIONED_TABLE} has not been partitioned by month")
+    if end is None:
+        latest = get_latest_timestamp(conn, list(partitions.values()))
+        end = datetime.datetime.combine(latest.date() + datetime.timedelta(days=1), datetime.time())
+    if days is not None:
+        start = end - datetime.timedelta(days=days)
+    elif start is None:
+        first_month = next(iter(partitions))
+        start = datetime.datetime(first_month.year, first_month.month, 1)
+    return start, end
+
+
+def get_latest_timestamp(conn: kuzu.Connection, partitions: list[str]) -> datetime.datetime:
+    "Most recent transaction, found in the most recent non-empty partition"
+    for name in reversed(partitions):
+        response = conn.execute(f"MATCH ()-[t:{name}]->() RETURN max(t.timestamp);")
+        latest = response.get_next()[0]
+        if latest is not None:
+            return latest
+    raise ValueError(f"No transactions in the {PARTITIONED_TABLE} partitions")
+
+
+def create_partition_table(conn: kuzu.Connection, name: str) -> None:
+    "Create a partition with the endpoints and properties of TransactedWith, unless it exists"
+    response = conn.execute(f"CALL show_connection('{PARTITIONED_TABLE}') RETURN *;")
+    src_table, dst_table = response.get_next()[:2]
+    response = conn.execute(f"CALL table_info('{PARTITIONED_TABLE}') RETURN name, type;")
+    properties = "".join(f", {prop} {dtype}" for prop, dtype in response.get_all())
+    conn.execute(
+        f"CREATE REL TABLE IF NOT EXISTS {name}(FROM {src_table} TO {dst_table}{properties});"
+    )
+
+
+def split_by_month(rows: pa.Table) -> Iterator[tuple[str, pa.Table]]:
+    "The rows of each month of the `timestamp` column, with the name of the month's partition"
+    if rows.num_rows == 0:
+        return
+    months = rows["timestamp"].to_numpy().astype("datetime64[M]")
+    unique_months, month_index = np.unique(months, return_inverse=True)
+    order = np.argsort(month_index, kind="stable")
+    bounds = np.searchsorted(month_index[order], np.arange(len(unique_months) + 1))
+    for i, month in enumerate(unique_months):
+        name = partition_name(month.astype("datetime64[D]").item())
+        yield name, rows.take(order[bounds[i] : bounds[i + 1]])
+
+
+def insert_into_partitions(conn: kuzu.Connection, rows: pa.Table, copy: bool = True) -> list[str]:
+    """
+    Insert transactions into the partitions of their months, creating partitions as needed. `rows`
+    has the columns of a COPY into TransactedWith: the primary keys of the source and destination,
+    then the rel properties in order. COPY has a fixed cost of about 100 ms, so small batches are
+    better inserted with `copy=False`, which creates the rels one by one instead. The same goes for
+    partitions that already hold transactions, as rolling back a failed COPY into a non-empty rel
+    table also drops the rows that were already there. Returns the partitions written to
+    """
+    if not copy:
+        response = conn.execute(f"CALL show_connection('{PARTITIONED_TABLE}') RETURN *;")
+        src_table, dst_table, src_key, dst_key = response.get_next()
+        source, target, *properties = rows.column_names
+        values = ", ".join(f"{prop}: {prop}" for prop in properties)
+    names = []
+    for name, month_rows in split_by_month(rows):
+        create_partition_table(conn, name)
+        if copy:
+            conn.execute(f"COPY {name} FROM $rows;", {"rows": month_rows})
+        else:
+            conn.execute(
+                f"""
+                LOAD FROM $rows
+                MATCH (a:{src_table} {{{src_key}: {source}}}), (b:{dst_table} {{{dst_key}: {target}}})
+                CREATE (a)-[:{name} {{{values}}}]->(b);
+                """,
+                parameters={"rows": month_rows},
+            )
+        names.append(name)
+    return names
+
+
+def copy_to_partitions(conn: kuzu.Connection, batches: Iterable[pa.RecordBatch]) -> list[str]:
+    """
+    Copy transactions into empty monthly partitions, e.g. after a full load. The batches have the
+    columns of a COPY into TransactedWith, as in `insert_into_partitions`, and are typically read
+    from the file that TransactedWith was copied from. They are read once: the rows of each month
+    are appended to a Parquet file of their own, and each partition is then filled by a single COPY
+    from its file. Returns the partitions written to
+    """
+    with tempfile.TemporaryDirectory() as staging:
+        writers: dict[str, pq.ParquetWriter] = {}
+        try:
+            for batch in batches:
+                rows = pa.Table.from_batches([batch])
+                rows = rows.filter(pc.is_valid(rows["timestamp"]))
+                for name, month_rows in split_by_month(rows):
+                    if name not in writers:
+                        writers[name] = pq.ParquetWriter(f"{staging}/{name}.parquet", rows.schema)
+                    writers[name].write_table(month_rows)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        names = sorted(writers)
+        for name in names:
+            create_partition_table(conn, name)
+            conn.execute(f"COPY {name} FROM '{staging}/{name}.parquet';")
+    return names
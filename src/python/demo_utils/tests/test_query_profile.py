@@ -0,0 +1,25 @@
+from pathlib import Path
+
+from demo_utils.query_profile import parse_profile
+
+# PROFILE of copy_from_postgres/queries/q3.cypher on Kùzu 0.11, with trailing spaces stripped. The
+# plan is wide enough that the connectors of its outer HASH_JOIN_BUILDs stop short of their probes
+Q3_PROFILE = (Path(__file__).parent / "q3_profile.txt").read_text()
+
+
+def test_every_operator_below_the_root_has_a_parent():
+    operators = parse_profile(Q3_PROFILE)
+    assert [op["id"] for op in operators if op["parent_id"] is None] == [24]
+    ids = {op["id"] for op in operators}
+    assert all(op["parent_id"] in ids for op in operators if op["id"] != 24)
+
+
+def test_hash_join_builds_are_children_of_their_probes():
+    operators = {op["id"]: op for op in parse_profile(Q3_PROFILE)}
+    parents = {
+        op["id"]: op["parent_id"] for op in operators.values() if op["name"] == "HASH_JOIN_BUILD"
+    }
+    assert parents == {20: 21, 15: 16, 1: 11, 5: 11}
+    # The build sides of the outer joins key on the nodes that their probes join on
+    assert operators[21]["details"][0] == operators[20]["details"][0] == "Keys: p2._ID"
+    assert operators[16]["details"][0] == operators[15]["details"][0] == "Keys: p1._ID"
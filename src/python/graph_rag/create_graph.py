@@ -2,11 +2,13 @@
 Create a graph in Kùzu
 """
 import shutil
+
 import kuzu
+from demo_utils.ingest_report import InstrumentedConnection
 
 shutil.rmtree("ex_kuzu_db", ignore_errors=True)
 db = kuzu.Database("ex_kuzu_db")
-conn = kuzu.Connection(db)
+conn = InstrumentedConnection(kuzu.Connection(db))
 
 # Define schema
 conn.execute("CREATE NODE TABLE Actor(name STRING, age INT64, PRIMARY KEY(name))")
@@ -36,6 +38,7 @@ files = {
 for table, file in files.items():
     conn.execute(f"COPY {table} FROM '{base_path}/{file}';")
 print("Finished ingesting data")
+conn.write_report("create_graph")
 
 # Query
 res = conn.execute(
@@ -0,0 +1,129 @@
+"""
+Compare the ways of loading the TransactedWith edges in `load_data.py`:
+
+- csv: write `transacted_with.csv` with `COPY (LOAD FROM ...) TO`, then `COPY ... FROM` that file
+- parquet: write a typed `transacted_with.parquet` with pyarrow, then `COPY ... FROM` that file
+- streaming: `COPY ... FROM (LOAD FROM ...)`, which feeds the projected columns straight into the rel table
+
+A large synthetic `transaction.csv` is generated from the node files in `./data`, and each path is
+timed on a fresh database.
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import kuzu
+from demo_utils.database import remove_database
+from load_data import (
+    copy_edges_from_source,
+    copy_edges_from_staged_files,
+    create_edge_tables,
+    create_location_in_edge_file,
+    create_merchant_edge_file,
+    create_node_tables,
+    create_parquet_edge_files,
+    create_transaction_edge_file,
+)
+
+
+def read_ids(file_path: Path, column: str) -> list[int]:
+    with open(file_path) as file:
+        return [int(row[column]) for row in csv.DictReader(file)]
+
+
+def write_transaction_csv(DATA_PATH: Path, n: int, seed: int = 1) -> None:
+    rng = random.Random(seed)
+    client_ids = read_ids(DATA_PATH / "client.csv", "client_id")
+    merchant_ids = read_ids(DATA_PATH / "merchant.csv", "merchant_id")
+    start = datetime(2024, 1, 1)
+    with open(DATA_PATH / "transaction.csv", "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["transaction_id", "client_id", "merchant_id", "amount_usd", "timestamp"])
+        for i in range(1, n + 1):
+            timestamp = start + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+            writer.writerow(
+                [
+                    i,
+                    rng.choice(client_ids),
+                    rng.choice(merchant_ids),
+                    round(rng.uniform(5.0, 2500.0), 2),
+                    timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+                ]
+            )
+
+
+def load_nodes(conn: kuzu.Connection, DATA_PATH: Path) -> None:
+    create_node_tables(conn)
+    conn.execute(f"COPY Client FROM '{DATA_PATH}/client.csv' (header=true);")
+    conn.execute(f"COPY City FROM '{DATA_PATH}/city.csv' (header=true);")
+    conn.execute(f"COPY Company FROM '{DATA_PATH}/company.csv' (header=true);")
+    conn.execute(f"COPY Merchant FROM '{DATA_PATH}/merchant.csv' (header=true);")
+    create_edge_tables(conn)
+
+
+def load_edges_staged(conn: kuzu.Connection, DATA_PATH: Path, file_format: str) -> None:
+    if file_format == "parquet":
+        create_parquet_edge_files(DATA_PATH)
+    else:
+        create_transaction_edge_file(conn, DATA_PATH)
+        create_merchant_edge_file(conn, DATA_PATH)
+        create_location_in_edge_file(conn, DATA_PATH)
+    copy_edges_from_staged_files(conn, DATA_PATH, file_format=file_format)
+
+
+def time_edge_load(work_dir: Path, DATA_PATH: Path, mode: str) -> float:
+    db_path = work_dir / f"{mode}_db"
+    remove_database(db_path)
+    db = kuzu.Database(str(db_path))
+    conn = kuzu.Connection(db)
+    load_nodes(conn, DATA_PATH)
+
+    start = time.perf_counter()
+    if mode == "streaming":
+        copy_edges_from_source(conn, DATA_PATH)
+    else:
+        load_edges_staged(conn, DATA_PATH, file_format=mode)
+    elapsed = time.perf_counter() - start
+
+    count = conn.execute("MATCH ()-[t:TransactedWith]->() RETURN count(*)").get_next()[0]
+    print(f"{mode:<10} {elapsed:.3f}s ({count} edges)")
+    return elapsed
+
+
+def main(num_transactions: int, trials: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(tmp)
+        DATA_PATH = work_dir / "data"
+        DATA_PATH.mkdir()
+        for name in ["client.csv", "city.csv", "company.csv", "merchant.csv"]:
+            shutil.copy(Path("./data") / name, DATA_PATH / name)
+        write_transaction_csv(DATA_PATH, num_transactions)
+        size_mb = (DATA_PATH / "transaction.csv").stat().st_size / 1e6
+        print(f"Generated {num_transactions} transactions ({size_mb:.1f} MB)")
+
+        timings = {
+            mode: min(time_edge_load(work_dir, DATA_PATH, mode) for _ in range(trials))
+            for mode in ["csv", "parquet", "streaming"]
+        }
+        print(f"\nBest of {trials}:")
+        for mode, elapsed in timings.items():
+            print(f"{mode:<10} {elapsed:.3f}s ({timings['csv'] / elapsed:.2f}x vs csv)")
+        for file_format in ["csv", "parquet"]:
+            size_mb = (DATA_PATH / f"transacted_with.{file_format}").stat().st_size / 1e6
+            print(f"transacted_with.{file_format}: {size_mb:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--num-transactions", type=int, default=1_000_000)
+    parser.add_argument("--trials", type=int, default=3)
+    args = parser.parse_args()
+
+    main(args.num_transactions, args.trials)
@@ -0,0 +1,175 @@
+"""
+Benchmark the queries in `query.py` as the transaction graph grows.
+
+For each scale factor (the number of TransactedWith edges), a synthetic dataset is generated with
+the cities and companies from `./data`, loaded through `load_data.main`, and each query is run with
+warm-up and repeated trials. Each scale factor runs in its own process so that the reported peak
+memory belongs to that scale factor alone.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+import kuzu
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pv
+from demo_utils.ingest_report import get_peak_rss_bytes
+from load_data import main as load_data
+from query import query_1, query_2, query_3, query_4, query_4_indexed
+
+QUERY_FUNCTIONS = {
+    "query_1": query_1,
+    "query_2": query_2,
+    "query_3": query_3,
+    "query_4": query_4,
+    "query_4_indexed": query_4_indexed,
+}
+
+
+def write_dataset(DATA_PATH: Path, num_transactions: int, seed: int = 1) -> None:
+    """
+    Write client, merchant and transaction files that scale with `num_transactions`
+    (about 10 transactions per client and 100 per merchant)
+    """
+    rng = np.random.default_rng(seed)
+    for name in ["city.csv", "company.csv"]:
+        shutil.copy(Path("./data") / name, DATA_PATH / name)
+    city_ids = pv.read_csv(DATA_PATH / "city.csv")["city_id"].to_numpy()
+    company_ids = pv.read_csv(DATA_PATH / "company.csv")["company_id"].to_numpy()
+
+    num_clients = max(10, num_transactions // 10)
+    client_ids = np.arange(1, num_clients + 1)
+    clients = pa.table(
+        {
+            "client_id": client_ids,
+            "name": pa.array([f"Client {i}" for i in client_ids]),
+            "age": rng.integers(18, 66, num_clients),
+        }
+    )
+    pv.write_csv(clients, DATA_PATH / "client.csv")
+
+    num_merchants = max(2 * len(city_ids), num_transactions // 100)
+    merchants = pa.table(
+        {
+            "merchant_id": np.arange(1, num_merchants + 1),
+            "company_id": rng.choice(company_ids, num_merchants),
+            "city_id": rng.choice(city_ids, num_merchants),
+        }
+    )
+    pv.write_csv(merchants, DATA_PATH / "merchant.csv")
+
+    start = np.datetime64("2024-01-01T00:00:00", "s")
+    seconds = rng.integers(0, 365 * 24 * 3600, num_transactions)
+    transactions = pa.table(
+        {
+            "transaction_id": np.arange(1, num_transactions + 1),
+            "client_id": rng.integers(1, num_clients + 1, num_transactions),
+            "merchant_id": rng.integers(1, num_merchants + 1, num_transactions),
+            "amount_usd": np.round(rng.uniform(5.0, 2500.0, num_transactions), 2),
+            "timestamp": start + seconds.astype("timedelta64[s]"),
+        }
+    )
+    pv.write_csv(transactions, DATA_PATH / "transaction.csv")
+
+
+def run_query(conn: kuzu.Connection, name: str, warmup: int, trials: int) -> dict[str, Any]:
+    query = QUERY_FUNCTIONS[name]
+    try:
+        for _ in range(warmup):
+            query(conn)
+        latencies = []
+        for _ in range(trials):
+            start = time.perf_counter()
+            result = query(conn)
+            latencies.append((time.perf_counter() - start) * 1000)
+    except RuntimeError as e:
+        # Most likely the query timeout, which query_4's variable-length pattern can hit
+        return {"error": str(e)}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(p95, 3),
+        "p99_ms": round(p99, 3),
+        "rows": len(result),
+    }
+
+
+def run_scale_factor(
+    num_transactions: int, warmup: int, trials: int, timeout_ms: int
+) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory() as tmp:
+        DATA_PATH = Path(tmp) / "data"
+        DATA_PATH.mkdir()
+        write_dataset(DATA_PATH, num_transactions)
+
+        db = kuzu.Database(str(Path(tmp) / "transaction_db"))
+        conn = kuzu.Connection(db)
+        start = time.perf_counter()
+        load_data(conn, DATA_PATH)
+        load_time = time.perf_counter() - start
+        peak_rss_after_load = get_peak_rss_bytes()
+
+        conn.set_query_timeout(timeout_ms)
+        queries = {name: run_query(conn, name, warmup, trials) for name in QUERY_FUNCTIONS}
+    return {
+        "num_transactions": num_transactions,
+        "load_time_s": round(load_time, 3),
+        "peak_rss_after_load_bytes": peak_rss_after_load,
+        "peak_rss_bytes": get_peak_rss_bytes(),
+        "queries": queries,
+    }
+
+
+def print_table(results: list[dict[str, Any]]) -> None:
+    print(f"\n{'edges':>10} {'query':<16} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'peak RSS MB':>12}")
+    for result in results:
+        peak_mb = (result["peak_rss_bytes"] or 0) / 1e6
+        for name, stats in result["queries"].items():
+            if "error" in stats:
+                print(f"{result['num_transactions']:>10} {name:<16} {stats['error']}")
+                continue
+            print(
+                f"{result['num_transactions']:>10} {name:<16} {stats['p50_ms']:>10.2f} "
+                f"{stats['p95_ms']:>10.2f} {stats['p99_ms']:>10.2f} {peak_mb:>12.1f}"
+            )
+
+
+def main(scale_factors: list[int], warmup: int, trials: int, timeout_ms: int, output: Path) -> None:
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for num_transactions in scale_factors:
+        print(f"Running scale factor {num_transactions} transactions")
+        with context.Pool(1) as pool:
+            results.append(
+                pool.apply(run_scale_factor, (num_transactions, warmup, trials, timeout_ms))
+            )
+    print_table(results)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nWrote results to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--scale-factors",
+        type=int,
+        nargs="+",
+        default=[1_000, 10_000, 100_000, 1_000_000, 10_000_000],
+        help="Number of TransactedWith edges for each run",
+    )
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--trials", type=int, default=20)
+    parser.add_argument("--timeout-ms", type=int, default=60_000, help="Timeout for each query")
+    parser.add_argument("--output", type=Path, default=Path("query_benchmark.json"))
+    args = parser.parse_args()
+
+    main(args.scale_factors, args.warmup, args.trials, args.timeout_ms, args.output)
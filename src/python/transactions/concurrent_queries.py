@@ -0,0 +1,109 @@
+"""
+Run a mixed workload of the queries in `query.py` from a thread pool, with one connection per worker
+on a shared `kuzu.Database`, and report throughput and latency as the concurrency grows.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import kuzu
+import numpy as np
+from query import query_1, query_2, query_3, query_4
+
+QUERY_FUNCTIONS = [query_1, query_2, query_3, query_4]
+
+
+class ConnectionPerThread:
+    """
+    Hands each worker thread its own connection to the database. The prepared statements
+    in `query.py` are cached per connection, so each worker prepares a query only once
+    """
+
+    def __init__(self, db: kuzu.Database, threads_per_connection: int | None = None):
+        self.db = db
+        self.threads_per_connection = threads_per_connection
+        self._local = threading.local()
+
+    def get(self) -> kuzu.Connection:
+        if not hasattr(self._local, "conn"):
+            conn = kuzu.Connection(self.db)
+            if self.threads_per_connection:
+                conn.set_max_threads_for_exec(self.threads_per_connection)
+            self._local.conn = conn
+        return self._local.conn
+
+
+def run_workload(
+    db: kuzu.Database,
+    concurrency: int,
+    num_queries: int,
+    threads_per_connection: int | None = None,
+    seed: int = 1,
+) -> dict[str, Any]:
+    rng = random.Random(seed)
+    workload = [rng.choice(QUERY_FUNCTIONS) for _ in range(num_queries)]
+    connections = ConnectionPerThread(db, threads_per_connection)
+
+    def timed(query) -> float:
+        conn = connections.get()
+        start = time.perf_counter()
+        query(conn)
+        return (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # Warm up every worker so that connection setup and preparation are not timed
+        list(pool.map(timed, QUERY_FUNCTIONS * concurrency))
+        start = time.perf_counter()
+        latencies = list(pool.map(timed, workload))
+        elapsed = time.perf_counter() - start
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "concurrency": concurrency,
+        "queries_per_s": round(num_queries / elapsed, 1),
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(p95, 3),
+        "p99_ms": round(p99, 3),
+    }
+
+
+def main(
+    db: kuzu.Database,
+    max_concurrency: int,
+    num_queries: int,
+    threads_per_connection: int | None = None,
+) -> list[dict[str, Any]]:
+    results = []
+    print(f"{'workers':>8} {'queries/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for concurrency in range(1, max_concurrency + 1):
+        result = run_workload(db, concurrency, num_queries, threads_per_connection)
+        print(
+            f"{concurrency:>8} {result['queries_per_s']:>10.1f} {result['p50_ms']:>10.2f} "
+            f"{result['p95_ms']:>10.2f} {result['p99_ms']:>10.2f}"
+        )
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--max-concurrency", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--num-queries", type=int, default=1000)
+    parser.add_argument(
+        "--threads-per-connection",
+        type=int,
+        default=None,
+        help="Limit the threads Kùzu uses for each query (defaults to all cores)",
+    )
+    args = parser.parse_args()
+
+    DB_NAME = "transaction_db"
+    db = kuzu.Database(f"./{DB_NAME}", read_only=True)
+
+    main(db, args.max_concurrency, args.num_queries, args.threads_per_connection)
@@ -1,10 +1,47 @@
 from __future__ import annotations
 
+import argparse
 import os
-import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
 
 import kuzu
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from demo_utils.database import remove_database
+from demo_utils.ingest_report import InstrumentedConnection
+from demo_utils.query_cache import bump_table_versions
+from demo_utils.transaction_partitions import copy_to_partitions, insert_into_partitions
+
+NODE_TABLES = ["Client", "City", "Company", "Merchant"]
+
+# Typed schemas for the Parquet edge files, keyed by the source file that they are projected from
+PARQUET_EDGE_FILES = {
+    "transacted_with": (
+        "transaction.csv",
+        pa.schema(
+            [
+                ("client_id", pa.int64()),
+                ("merchant_id", pa.int64()),
+                ("transaction_id", pa.int64()),
+                ("amount_usd", pa.float32()),
+                ("timestamp", pa.timestamp("us")),
+            ]
+        ),
+    ),
+    "belongs_to": (
+        "merchant.csv",
+        pa.schema([("merchant_id", pa.int64()), ("company_id", pa.int64())]),
+    ),
+    "located_in": (
+        "merchant.csv",
+        pa.schema([("merchant_id", pa.int64()), ("city_id", pa.int64())]),
+    ),
+}
 
 
 def create_client_node_table(conn: kuzu.Connection) -> None:
@@ -62,7 +99,7 @@ def create_merchant_node_table(conn: kuzu.Connection) -> None:
     )
 
 
-def create_transaction_edge_file(conn: kuzu.Connection) -> None:
+def create_transaction_edge_file(conn: kuzu.Connection, DATA_PATH: Path) -> None:
     """
     Create a new file `transacted_with.csv` that stores the
     edges between clients and merchants, with metadata.
@@ -75,6 +112,7 @@ def create_transaction_edge_file(conn: kuzu.Connection) -> None:
         RETURN
             client_id,
             merchant_id,
+            transaction_id,
             amount_usd,
             timestamp
     )
@@ -83,7 +121,7 @@ def create_transaction_edge_file(conn: kuzu.Connection) -> None:
     )
 
 
-def create_merchant_edge_file(conn: kuzu.Connection) -> None:
+def create_merchant_edge_file(conn: kuzu.Connection, DATA_PATH: Path) -> None:
     """
     Create a new file `belongs_to.csv` that stores the
     edges between merchants and their parent companies
@@ -102,7 +140,7 @@ def create_merchant_edge_file(conn: kuzu.Connection) -> None:
     )
 
 
-def create_location_in_edge_file(conn: kuzu.Connection) -> None:
+def create_location_in_edge_file(conn: kuzu.Connection, DATA_PATH: Path) -> None:
     """
     Create a new file `located_in.csv` that stores the
     edges between merchants and cities
@@ -134,6 +172,7 @@ def create_edge_tables(conn: kuzu.Connection) -> None:
         CREATE REL TABLE 
             TransactedWith(
                 FROM Client TO Merchant,
+                transaction_id INT64,
                 amount_usd FLOAT,
                 timestamp TIMESTAMP
             )
@@ -143,36 +182,495 @@ def create_edge_tables(conn: kuzu.Connection) -> None:
     conn.execute("CREATE REL TABLE BelongsTo(FROM Merchant TO Company)")
 
 
-def main(conn: kuzu.Connection, DATA_PATH: Path) -> None:
-    # Create edge table files from existing data
-    create_transaction_edge_file(conn)
-    create_merchant_edge_file(conn)
-    create_location_in_edge_file(conn)
+def create_parquet_edge_files(DATA_PATH: Path, row_group_size: int = 1_000_000) -> None:
+    """
+    Create `transacted_with.parquet`, `belongs_to.parquet` and `located_in.parquet`
+    with explicit column types, so that COPY can do columnar reads without
+    re-inferring types. The source CSVs are streamed in blocks to bound memory use
+    """
+    for name, (_, schema) in PARQUET_EDGE_FILES.items():
+        with pq.ParquetWriter(f"{DATA_PATH}/{name}.parquet", schema) as writer:
+            for batch in read_edge_batches(DATA_PATH, name):
+                writer.write_table(pa.Table.from_batches([batch]), row_group_size=row_group_size)
+
+
+def read_edge_batches(DATA_PATH: Path, name: str) -> pv.CSVStreamingReader:
+    "Stream the columns of an edge file from its source CSV, in blocks, with explicit types"
+    source, schema = PARQUET_EDGE_FILES[name]
+    return pv.open_csv(
+        f"{DATA_PATH}/{source}",
+        read_options=pv.ReadOptions(block_size=64 << 20),
+        convert_options=pv.ConvertOptions(
+            column_types=dict(zip(schema.names, schema.types)),
+            include_columns=schema.names,
+        ),
+    )
+
+
+def copy_edges_from_staged_files(
+    conn: kuzu.Connection, DATA_PATH: Path, file_format: str = "csv"
+) -> None:
+    conn.execute(f"COPY TransactedWith FROM '{DATA_PATH}/transacted_with.{file_format}';")
+    conn.execute(f"COPY BelongsTo FROM '{DATA_PATH}/belongs_to.{file_format}';")
+    conn.execute(f"COPY LocatedIn FROM '{DATA_PATH}/located_in.{file_format}';")
+
+
+def copy_edges_from_source(conn: kuzu.Connection, DATA_PATH: Path) -> None:
+    """
+    Copy the edge tables straight from the source files by projecting the
+    required columns in a subquery, so that no intermediate edge file is written
+    to disk and parsed a second time
+    """
+    conn.execute(
+        f"""
+        COPY TransactedWith FROM (
+            LOAD FROM '{DATA_PATH}/transaction.csv' (header=true)
+            RETURN
+                CAST(client_id AS INT64),
+                CAST(merchant_id AS INT64),
+                CAST(transaction_id AS INT64),
+                CAST(amount_usd AS FLOAT),
+                CAST(timestamp AS TIMESTAMP)
+        );
+        """
+    )
+    conn.execute(
+        f"""
+        COPY BelongsTo FROM (
+            LOAD FROM '{DATA_PATH}/merchant.csv' (header=true)
+            RETURN
+                merchant_id,
+                company_id
+        );
+        """
+    )
+    conn.execute(
+        f"""
+        COPY LocatedIn FROM (
+            LOAD FROM '{DATA_PATH}/merchant.csv' (header=true)
+            RETURN
+                merchant_id,
+                city_id
+        );
+        """
+    )
+
+
+def create_watermark_table(conn: kuzu.Connection) -> None:
+    """
+    Create a small bookkeeping table that stores the most recent transaction
+    timestamp loaded into the graph, so that incremental runs know where to resume
+    """
+    conn.execute(
+        """
+        CREATE NODE TABLE
+            LoadWatermark(
+                name STRING,
+                timestamp TIMESTAMP,
+                PRIMARY KEY (name)
+            )
+        """
+    )
 
-    # Ingest nodes
-    create_node_tables(conn)
-    conn.execute(f"COPY Client FROM '{DATA_PATH}/client.csv' (header=true);")
-    conn.execute(f"COPY City FROM '{DATA_PATH}/city.csv' (header=true);")
-    conn.execute(f"COPY Company FROM '{DATA_PATH}/company.csv' (header=true);")
-    conn.execute(f"COPY Merchant FROM '{DATA_PATH}/merchant.csv' (header=true);")
-    print("Loaded nodes into KùzuDB")
+
+def get_watermark(conn: kuzu.Connection) -> datetime | None:
+    """
+    Return the stored watermark. Databases built before the watermark table existed
+    fall back to a one-off scan of the edge table
+    """
+    try:
+        response = conn.execute(
+            """
+            MATCH (w:LoadWatermark {name: "TransactedWith"})
+            RETURN w.timestamp
+            """
+        )
+        if response.has_next():
+            return response.get_next()[0]
+    except RuntimeError:
+        create_watermark_table(conn)
+    response = conn.execute("MATCH ()-[t:TransactedWith]->() RETURN max(t.timestamp)")
+    return response.get_next()[0]
+
+
+def update_watermark(conn: kuzu.Connection, timestamp: datetime | None) -> None:
+    if timestamp is None:
+        return
+    conn.execute(
+        """
+        MERGE (w:LoadWatermark {name: "TransactedWith"})
+        SET w.timestamp = $timestamp
+        """,
+        parameters={"timestamp": timestamp},
+    )
+
+
+def get_max_transaction_timestamp(conn: kuzu.Connection, DATA_PATH: Path) -> datetime | None:
+    """
+    Scan the input file (not the graph) for the latest transaction timestamp
+    """
+    response = conn.execute(
+        f"""
+        LOAD FROM '{DATA_PATH}/transaction.csv' (header=true)
+        RETURN max(CAST(timestamp AS TIMESTAMP))
+        """
+    )
+    return response.get_next()[0]
+
+
+def merge_nodes(conn: kuzu.Connection, DATA_PATH: Path) -> None:
+    """
+    Upsert node rows by primary key: new rows are created, existing rows
+    have their properties updated in place
+    """
+    conn.execute(
+        f"""
+        LOAD FROM '{DATA_PATH}/client.csv' (header=true)
+        MERGE (c:Client {{client_id: CAST(client_id AS INT64)}})
+        SET c.name = name, c.age = CAST(age AS INT64)
+        """
+    )
+    conn.execute(
+        f"""
+        LOAD FROM '{DATA_PATH}/city.csv' (header=true)
+        MERGE (ci:City {{city_id: CAST(city_id AS INT64)}})
+        SET ci.city = city
+        """
+    )
+    conn.execute(
+        f"""
+        LOAD FROM '{DATA_PATH}/company.csv' (header=true)
+        MERGE (co:Company {{company_id: CAST(company_id AS INT64)}})
+        SET co.type = type, co.company = company
+        """
+    )
+    conn.execute(
+        f"""
+        LOAD FROM '{DATA_PATH}/merchant.csv' (header=true)
+        MERGE (m:Merchant {{merchant_id: CAST(merchant_id AS INT64)}})
+        SET m.company_id = CAST(company_id AS INT64), m.city_id = CAST(city_id AS INT64)
+        """
+    )
+
+
+def merge_merchant_edges(conn: kuzu.Connection, DATA_PATH: Path) -> None:
+    """
+    Attach any new merchants to their parent company and city. A merchant that moved to another
+    company or city first has its old edge deleted, then MERGE creates the new one, so that
+    merchants that were already linked are left untouched
+    """
+    conn.execute(
+        f"""
+        LOAD FROM '{DATA_PATH}/merchant.csv' (header=true)
+        MATCH (m:Merchant {{merchant_id: CAST(merchant_id AS INT64)}})-[b:BelongsTo]->(co:Company)
+        WHERE co.company_id <> CAST(company_id AS INT64)
+        DELETE b
+        """
+    )
+    conn.execute(
+        f"""
+        LOAD FROM '{DATA_PATH}/merchant.csv' (header=true)
+        MATCH (m:Merchant {{merchant_id: CAST(merchant_id AS INT64)}}),
+              (co:Company {{company_id: CAST(company_id AS INT64)}})
+        MERGE (m)-[:BelongsTo]->(co)
+        """
+    )
+    conn.execute(
+        f"""
+        LOAD FROM '{DATA_PATH}/merchant.csv' (header=true)
+        MATCH (m:Merchant {{merchant_id: CAST(merchant_id AS INT64)}})-[l:LocatedIn]->(ci:City)
+        WHERE ci.city_id <> CAST(city_id AS INT64)
+        DELETE l
+        """
+    )
+    conn.execute(
+        f"""
+        LOAD FROM '{DATA_PATH}/merchant.csv' (header=true)
+        MATCH (m:Merchant {{merchant_id: CAST(merchant_id AS INT64)}}),
+              (ci:City {{city_id: CAST(city_id AS INT64)}})
+        MERGE (m)-[:LocatedIn]->(ci)
+        """
+    )
+
+
+# Transactions of the input file whose id is not in TransactedWith yet, with the columns of a COPY
+# into TransactedWith. The anti-join is planned as a hash join on the loaded ids
+NEW_TRANSACTIONS_QUERY = """
+    LOAD FROM '{path}' (header=true)
+    WITH
+        CAST(client_id AS INT64) AS client_id,
+        CAST(merchant_id AS INT64) AS merchant_id,
+        CAST(transaction_id AS INT64) AS transaction_id,
+        CAST(amount_usd AS FLOAT) AS amount_usd,
+        CAST(timestamp AS TIMESTAMP) AS timestamp
+    WHERE NOT EXISTS {{
+        MATCH ()-[t:TransactedWith]->() WHERE t.transaction_id = transaction_id
+    }}
+    RETURN client_id, merchant_id, transaction_id, amount_usd, timestamp
+"""
+
+
+def append_transaction_edges(
+    conn: kuzu.Connection, DATA_PATH: Path, watermark: datetime | None
+) -> pa.Table:
+    """
+    Bulk-append the transactions whose `transaction_id` is not in TransactedWith yet, and return
+    them. New transactions are found by id rather than by timestamp, so that late-arriving or
+    backdated transactions, and those at the same timestamp as the watermark, are not missed.
+    The rows that are skipped, because their id is already loaded or repeated within the new
+    rows (the first one is kept), are reported
+    """
+    path = f"{DATA_PATH}/transaction.csv"
+    num_rows = conn.execute(f"LOAD FROM '{path}' (header=true) RETURN count(*)").get_next()[0]
+    rows = conn.execute(NEW_TRANSACTIONS_QUERY.format(path=path)).get_as_arrow()
+    _, first = np.unique(rows["transaction_id"].to_numpy(), return_index=True)
+    new_rows = rows.take(np.sort(first))
+
+    if num_rows > rows.num_rows:
+        print(f"Skipped {num_rows - rows.num_rows} transactions whose transaction_id is loaded")
+    if rows.num_rows > new_rows.num_rows:
+        ids = pc.unique(rows["transaction_id"].take(np.setdiff1d(np.arange(rows.num_rows), first)))
+        print(
+            f"Skipped {rows.num_rows - new_rows.num_rows} transactions with a repeated "
+            f"transaction_id: {ids.to_pylist()}"
+        )
+    if watermark is not None and new_rows.num_rows:
+        late = int((new_rows["timestamp"].to_numpy() <= np.datetime64(watermark)).sum())
+        if late:
+            print(f"Appending {late} transactions at or before the watermark ({watermark})")
+    if new_rows.num_rows:
+        conn.execute("COPY TransactedWith FROM $rows;", parameters={"rows": new_rows})
+    return new_rows
+
+
+# Distinct merchants, companies and cities that each client reaches within 2 hops
+CLIENT_CONNECTIONS_QUERY = """
+    MATCH (c:Client)-[:TransactedWith]->(m:Merchant)-[:BelongsTo]->(co:Company),
+          (m)-[:LocatedIn]->(ci:City)
+    {where}
+    WITH
+        c.client_id AS client_id,
+        collect(DISTINCT m.merchant_id) AS merchant_ids,
+        collect(DISTINCT co.company_id) AS company_ids,
+        collect(DISTINCT ci.city_id) AS city_ids
+"""
+
+
+def create_client_connections_table(conn: kuzu.Connection) -> None:
+    """
+    Create a node table that stores the 2-hop reachability summary of each client, so that
+    common connections between two clients are a set intersection over two primary key
+    lookups instead of a variable-length path expansion
+    """
+    conn.execute(
+        """
+        CREATE NODE TABLE
+            ClientConnections(
+                client_id INT64,
+                merchant_ids INT64[],
+                company_ids INT64[],
+                city_ids INT64[],
+                PRIMARY KEY (client_id)
+            )
+        """
+    )
+
+
+def build_client_connections(conn: kuzu.Connection) -> None:
+    conn.execute(
+        f"""
+        COPY ClientConnections FROM (
+            {CLIENT_CONNECTIONS_QUERY.format(where="")}
+            RETURN client_id, merchant_ids, company_ids, city_ids
+        );
+        """
+    )
+
+
+def refresh_client_connections(conn: kuzu.Connection, client_ids: list[int]) -> None:
+    """
+    Rebuild the summary for the given clients only, e.g. those with new transactions. Their rows
+    are deleted and copied again from the aggregation: updating the lists in place with
+    `MERGE ... SET` gave new rows the wrong lists once the database was reopened
+    """
+    conn.execute(
+        "MATCH (r:ClientConnections) WHERE r.client_id IN $client_ids DELETE r",
+        parameters={"client_ids": client_ids},
+    )
+    conn.execute(
+        f"""
+        COPY ClientConnections FROM (
+            {CLIENT_CONNECTIONS_QUERY.format(where="WHERE c.client_id IN $client_ids")}
+            RETURN client_id, merchant_ids, company_ids, city_ids
+        );
+        """,
+        parameters={"client_ids": client_ids},
+    )
+
+
+def check_client_connections(conn: kuzu.Connection) -> list[int]:
+    """
+    Compare the ClientConnections table with the summary recomputed from the graph, ignoring the
+    order of the lists, and return the clients whose rows differ or are missing
+    """
+    summaries = {}
+    for query in [
+        "MATCH (r:ClientConnections) RETURN r.client_id, r.merchant_ids, r.company_ids, r.city_ids",
+        f"""
+        {CLIENT_CONNECTIONS_QUERY.format(where="")}
+        RETURN client_id, merchant_ids, company_ids, city_ids
+        """,
+    ]:
+        response = conn.execute(query)
+        summaries[query] = {
+            client_id: tuple(sorted(ids) for ids in lists)
+            for client_id, *lists in response.get_all()
+        }
+    stored, expected = summaries.values()
+    return sorted(
+        client_id
+        for client_id in stored.keys() | expected.keys()
+        if stored.get(client_id) != expected.get(client_id)
+    )
+
+
+def has_table(conn: kuzu.Connection, name: str) -> bool:
+    response = conn.execute("CALL show_tables() RETURN name")
+    return any(row[0] == name for row in response.get_all())
+
+
+def main(conn: kuzu.Connection, DATA_PATH: Path, staging: str | None = None) -> None:
+    """
+    Load the full dataset. Kùzu runs one write transaction at a time, so the COPY statements run
+    one after another on a single connection. The only work that overlaps them is the parsing of
+    the source CSVs into Parquet edge files, which pyarrow does in a worker thread, outside of Kùzu,
+    while the node tables are copied
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        staged = None
+        # Create edge table files from existing data. The CSV files are exported by Kùzu itself,
+        # whose read transaction would hold up the checkpoints of the node COPYs, so they are not
+        # written in the background
+        if staging == "csv":
+            create_transaction_edge_file(conn, DATA_PATH)
+            create_merchant_edge_file(conn, DATA_PATH)
+            create_location_in_edge_file(conn, DATA_PATH)
+        elif staging == "parquet":
+            staged = executor.submit(create_parquet_edge_files, DATA_PATH)
+
+        # Ingest nodes
+        create_node_tables(conn)
+        conn.execute(f"COPY Client FROM '{DATA_PATH}/client.csv' (header=true);")
+        conn.execute(f"COPY City FROM '{DATA_PATH}/city.csv' (header=true);")
+        conn.execute(f"COPY Company FROM '{DATA_PATH}/company.csv' (header=true);")
+        conn.execute(f"COPY Merchant FROM '{DATA_PATH}/merchant.csv' (header=true);")
+        print("Loaded nodes into KùzuDB")
+        if staged is not None:
+            staged.result()
 
     # Ingest edges
     create_edge_tables(conn)
-    conn.execute(f"COPY TransactedWith FROM '{DATA_PATH}/transacted_with.csv';")
-    conn.execute(f"COPY BelongsTo FROM '{DATA_PATH}/belongs_to.csv';")
-    conn.execute(f"COPY LocatedIn FROM '{DATA_PATH}/located_in.csv';")
+    if staging is not None:
+        copy_edges_from_staged_files(conn, DATA_PATH, file_format=staging)
+    else:
+        copy_edges_from_source(conn, DATA_PATH)
     print("Loaded edges into KùzuDB")
 
+    partitions = copy_to_partitions(conn, read_edge_batches(DATA_PATH, "transacted_with"))
+    print(f"Partitioned transactions into {len(partitions)} monthly rel tables")
+
+    create_client_connections_table(conn)
+    build_client_connections(conn)
+    print("Built client connections summary")
+
+    # Record the most recent transaction loaded
+    create_watermark_table(conn)
+    update_watermark(conn, get_max_transaction_timestamp(conn, DATA_PATH))
+    # Invalidate cached query results
+    bump_table_versions(
+        conn,
+        NODE_TABLES
+        + ["TransactedWith", "BelongsTo", "LocatedIn", "ClientConnections"]
+        + partitions,
+    )
+
+
+def main_incremental(conn: kuzu.Connection, DATA_PATH: Path) -> None:
+    """
+    Apply a new batch of data on top of an existing database: nodes are upserted by
+    primary key and only transactions with an id that is not loaded yet are appended,
+    so the writes scale with the size of the delta rather than the full history
+    """
+    watermark = get_watermark(conn)
+    print(f"Current watermark for TransactedWith: {watermark}")
+
+    merge_nodes(conn, DATA_PATH)
+    merge_merchant_edges(conn, DATA_PATH)
+    bump_table_versions(conn, NODE_TABLES + ["BelongsTo", "LocatedIn"])
+    print("Merged nodes into KùzuDB")
+
+    rows = append_transaction_edges(conn, DATA_PATH, watermark)
+    if rows.num_rows == 0:
+        print("No new transactions to load")
+        return
+    latest = pc.max(rows["timestamp"]).as_py()
+    new_watermark = latest if watermark is None else max(watermark, latest)
+    update_watermark(conn, new_watermark)
+    print(f"Appended {rows.num_rows} transactions into KùzuDB, watermark at {new_watermark}")
+    # Only the partitions of the months with new transactions are written to
+    partitions = insert_into_partitions(conn, rows, copy=False)
+    client_ids = pc.unique(rows["client_id"]).to_pylist()
+
+    if has_table(conn, "ClientConnections"):
+        refresh_client_connections(conn, client_ids)
+        print(f"Refreshed client connections summary for {len(client_ids)} clients")
+    else:
+        create_client_connections_table(conn)
+        build_client_connections(conn)
+        print("Built client connections summary")
+    bump_table_versions(conn, ["TransactedWith", "ClientConnections"] + partitions)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the transactions dataset into KùzuDB")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Merge new data into an existing database instead of rebuilding it",
+    )
+    parser.add_argument(
+        "--stage-edge-files",
+        choices=["csv", "parquet"],
+        help="Write the edge files to disk in this format before copying them, instead of streaming from the source",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Reopen the database after the load and check ClientConnections against the graph",
+    )
+    args = parser.parse_args()
+
     DB_NAME = "transaction_db"
-    # Delete directory each time till we have MERGE FROM available in kuzu
-    if os.path.exists(DB_NAME):
-        shutil.rmtree(DB_NAME)
+    DATA_PATH = "./data"
+    incremental = args.incremental and os.path.exists(DB_NAME)
+    # Without --incremental, the database is rebuilt from scratch on each run
+    if not incremental:
+        remove_database(DB_NAME)
     # Create database
     db = kuzu.Database(f"./{DB_NAME}")
-    conn = kuzu.Connection(db)
+    conn = InstrumentedConnection(kuzu.Connection(db))
 
-    DATA_PATH = "./data"
+    if incremental:
+        main_incremental(conn, DATA_PATH)
+    else:
+        main(conn, DATA_PATH, staging=args.stage_edge_files)
+    conn.write_report("load_data_incremental" if incremental else "load_data")
 
-    main(conn, DATA_PATH)
+    if args.check:
+        # Reopen the database, so that the check reads back what was written to disk
+        db.close()
+        db = kuzu.Database(f"./{DB_NAME}")
+        mismatches = check_client_connections(kuzu.Connection(db))
+        if mismatches:
+            raise SystemExit(f"ClientConnections differs from the graph for clients {mismatches}")
+        print("ClientConnections matches the graph")
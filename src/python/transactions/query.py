@@ -1,75 +1,317 @@
-import kuzu
+import argparse
+import datetime
+import warnings
+import weakref
+from collections.abc import Iterator
 
+import kuzu
+import pandas as pd
+import pyarrow as pa
+from demo_utils.query_cache import QueryCache
+from demo_utils.query_profile import ProfiledConnection
+from demo_utils.transaction_partitions import Window, get_partition_label, get_window
 
-def query_1(conn: kuzu.Connection) -> None:
-    "Q1. Who are the clients that transacted with the merchants of 'Starbucks'?"
-    query = """
+# Parameterized query shapes; the literals used in the demo are the defaults of the query functions
+QUERIES = {
+    # Q1. Who are the clients that transacted with the merchants of a given company?
+    "query_1": """
         MATCH (c:Client)-[:TransactedWith]->(:Merchant)-[:BelongsTo]->(co:Company)
-        WHERE co.company = "Starbucks"
+        WHERE co.company = $company
         RETURN DISTINCT c.client_id AS id, c.name AS name;
-    """
-    print(f"\nQuery 1:\n {query}")
-    response = conn.execute(query)
-    result = response.get_as_df()
-    print(result)
-    return result
-
-
-def query_2(conn: kuzu.Connection) -> None:
-    "Q2. Who are the clients who transacted with at least 2 separate merchants operating in Los Angeles?"
-    query = """
+    """,
+    # Q2. Who are the clients who transacted with at least 2 separate merchants operating in a given city?
+    "query_2": """
         MATCH (c:Client)-[:TransactedWith]->(m1:Merchant)-[:LocatedIn]->(ci:City),
             (c)-[:TransactedWith]->(m2:Merchant)-[:LocatedIn]->(ci)
-        WHERE ci.city = "Los Angeles" AND m1.merchant_id <> m2.merchant_id
+        WHERE ci.city = $city AND m1.merchant_id <> m2.merchant_id
+        RETURN DISTINCT c.client_id AS id, c.name as name;
+    """,
+    # Q3. Which companies have merchants in all three of the given cities?
+    "query_3": """
+        MATCH (:City {city: $city_1})<-[]-(m1:Merchant)-[]->(co:Company),
+            (:City {city: $city_2})<-[]-(m2)-[]->(co),
+            (:City {city: $city_3})<-[]-(m3)-[]->(co)
+        RETURN DISTINCT co.company AS company
+    """,
+    # Q4. How many common connections (cities, merchants, companies) exist between two clients?
+    # The rel tables are listed, as the monthly partitions of TransactedWith would match too
+    "query_4": """
+        MATCH (c1:Client)-[:TransactedWith|BelongsTo|LocatedIn*1..2]->(common)
+            <-[:TransactedWith|BelongsTo|LocatedIn*1..2]-(c2:Client)
+        WHERE c1.client_id = $client_id_1 AND c2.client_id = $client_id_2
+        RETURN label(common) AS connectionType, COUNT(label(common)) AS count;
+    """,
+}
+
+# Q4 (indexed). Reachability summaries of two clients, from the ClientConnections table. The client
+# ids are inlined as integer literals, as Kùzu only plans a primary key lookup for a literal key, and
+# scans the table for a parameter
+CLIENT_CONNECTIONS_QUERY = """
+    MATCH (a:ClientConnections {{client_id: {client_id_1}}}),
+        (b:ClientConnections {{client_id: {client_id_2}}})
+    RETURN
+        a.merchant_ids, b.merchant_ids,
+        a.company_ids, b.company_ids,
+        a.city_ids, b.city_ids;
+"""
+
+# The queries that read transactions, over the partitions of TransactedWith that overlap a window
+# [start, end). `{transactions}` is replaced with the labels of the partitions, and
+# the bounds with timestamp literals, as Kùzu cannot bind parameters in the predicates of recursive
+# patterns in a prepared statement
+WINDOWED_QUERIES = {
+    "query_1": """
+        MATCH (c:Client)-[t:{transactions}]->(:Merchant)-[:BelongsTo]->(co:Company)
+        WHERE co.company = $company AND t.timestamp >= {window_start} AND t.timestamp < {window_end}
+        RETURN DISTINCT c.client_id AS id, c.name AS name;
+    """,
+    "query_2": """
+        MATCH (c:Client)-[t1:{transactions}]->(m1:Merchant)-[:LocatedIn]->(ci:City),
+            (c)-[t2:{transactions}]->(m2:Merchant)-[:LocatedIn]->(ci)
+        WHERE ci.city = $city AND m1.merchant_id <> m2.merchant_id
+            AND t1.timestamp >= {window_start} AND t1.timestamp < {window_end}
+            AND t2.timestamp >= {window_start} AND t2.timestamp < {window_end}
         RETURN DISTINCT c.client_id AS id, c.name as name;
+    """,
+    # Only the transaction hops have a timestamp; the BelongsTo and LocatedIn hops pass the filter
+    "query_4": """
+        MATCH (c1:Client)-[:{transactions}|BelongsTo|LocatedIn*1..2 (r, _ | WHERE r.timestamp IS NULL
+                OR (r.timestamp >= {window_start} AND r.timestamp < {window_end}))]->(common)
+            <-[:{transactions}|BelongsTo|LocatedIn*1..2 (r, _ | WHERE r.timestamp IS NULL
+                OR (r.timestamp >= {window_start} AND r.timestamp < {window_end}))]-(c2:Client)
+        WHERE c1.client_id = $client_id_1 AND c2.client_id = $client_id_2
+        RETURN label(common) AS connectionType, COUNT(label(common)) AS count;
+    """,
+}
+
+
+# Arrow types for the Kùzu column types returned by the queries; others are inferred from the values
+ARROW_TYPES = {
+    "INT64": pa.int64(),
+    "INT32": pa.int32(),
+    "DOUBLE": pa.float64(),
+    "FLOAT": pa.float32(),
+    "BOOL": pa.bool_(),
+    "STRING": pa.string(),
+    "TIMESTAMP": pa.timestamp("us"),
+}
+
+
+class QueryRegistry:
+    """
+    Prepares each registered query once for a connection, so that repeated calls with new
+    parameters skip parsing and planning
     """
-    print(f"\nQuery 2:\n {query}")
-    response = conn.execute(query)
-    result = response.get_as_df()
-    print(result)
-    return result
 
+    def __init__(self, conn: kuzu.Connection, queries: dict[str, str] = QUERIES):
+        self.conn = conn
+        self.queries = queries
+        self._prepared: dict[str, kuzu.PreparedStatement] = {}
 
-def query_3(conn: kuzu.Connection) -> None:
-    "Q3. Which companies have merchants in New York City, Boston **and** Los Angeles?"
-    query = """
-        MATCH (:City {city: "New York City"})<-[]-(m1:Merchant)-[]->(co:Company),
-            (:City {city: "Boston"})<-[]-(m2)-[]->(co),
-            (:City {city: "Los Angeles"})<-[]-(m3)-[]->(co)
-        RETURN DISTINCT co.company AS company
+    def register(self, name: str, query: str) -> None:
+        "Add a query generated at runtime, replacing any earlier query of the same name"
+        if self.queries.get(name) != query:
+            self.queries = {**self.queries, name: query}
+            self._prepared.pop(name, None)
+
+    def prepare(self, name: str) -> kuzu.PreparedStatement:
+        if name not in self._prepared:
+            with warnings.catch_warnings():
+                # Newer versions of Kùzu recommend a single execute() call, but that re-plans every time
+                warnings.simplefilter("ignore", DeprecationWarning)
+                self._prepared[name] = self.conn.prepare(self.queries[name])
+        return self._prepared[name]
+
+    def execute(self, name: str, parameters: dict) -> kuzu.QueryResult:
+        return self.conn.execute(self.prepare(name), parameters)
+
+
+_registries: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_registry(conn: kuzu.Connection) -> QueryRegistry:
+    "Return the registry of prepared statements for this connection, creating it on first use"
+    if conn not in _registries:
+        _registries[conn] = QueryRegistry(conn)
+    return _registries[conn]
+
+
+def iter_record_batches(
+    response: kuzu.QueryResult, batch_size: int = 100_000
+) -> Iterator[pa.RecordBatch]:
+    """
+    Yield the result as Arrow record batches of at most `batch_size` rows, fetching only one batch
+    of rows from Kùzu at a time, so that large results can be written to a sink or aggregated
+    without materializing them as a single DataFrame
+    """
+    names = response.get_column_names()
+    schema = pa.schema(
+        [
+            (name, ARROW_TYPES.get(dtype, pa.null()))
+            for name, dtype in zip(names, response.get_column_data_types())
+        ]
+    )
+    while response.has_next():
+        columns = list(zip(*response.get_n(batch_size)))
+        arrays = [
+            pa.array(column, type=None if field.type == pa.null() else field.type)
+            for column, field in zip(columns, schema)
+        ]
+        yield pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def register_window_query(registry: QueryRegistry, name: str, window: Window | None) -> str:
     """
-    print(f"\nQuery 3:\n {query}")
-    response = conn.execute(query)
-    result = response.get_as_df()
-    print(result)
-    return result
+    Register the variant of a query over the partitions of a window, if it reads transactions, and
+    return the name of the query to run
+    """
+    if window is None or name not in WINDOWED_QUERIES:
+        return name
+    # Prepared once per window, as the partitions and bounds are part of the query text
+    query = WINDOWED_QUERIES[name].format(
+        transactions=get_partition_label(registry.conn, window),
+        window_start=f"timestamp('{window[0]}')",
+        window_end=f"timestamp('{window[1]}')",
+    )
+    registry.register(f"{name}_windowed", query)
+    return f"{name}_windowed"
+
+
+# Shared by all connections; entries are keyed by database, query text and parameters
+RESULT_CACHE = QueryCache()
+
+
+def run_query(
+    conn: kuzu.Connection,
+    name: str,
+    parameters: dict,
+    batch_size: int | None = None,
+    use_cache: bool = False,
+    window: Window | None = None,
+) -> pd.DataFrame | Iterator[pa.RecordBatch]:
+    registry = get_registry(conn)
+    name = register_window_query(registry, name, window)
+    if batch_size is not None:
+        return iter_record_batches(registry.execute(name, parameters), batch_size)
+    if use_cache:
+        return RESULT_CACHE.get_or_execute(
+            conn,
+            registry.queries[name],
+            parameters,
+            lambda: registry.execute(name, parameters).get_as_df(),
+        )
+    return registry.execute(name, parameters).get_as_df()
+
 
+def query_1(
+    conn: kuzu.Connection,
+    company: str = "Starbucks",
+    batch_size: int | None = None,
+    use_cache: bool = False,
+    window: Window | None = None,
+) -> pd.DataFrame | Iterator[pa.RecordBatch]:
+    "Q1. Who are the clients that transacted with the merchants of 'Starbucks'?"
+    return run_query(conn, "query_1", {"company": company}, batch_size, use_cache, window)
+
+
+def query_2(
+    conn: kuzu.Connection,
+    city: str = "Los Angeles",
+    batch_size: int | None = None,
+    use_cache: bool = False,
+    window: Window | None = None,
+) -> pd.DataFrame | Iterator[pa.RecordBatch]:
+    "Q2. Who are the clients who transacted with at least 2 separate merchants operating in Los Angeles?"
+    return run_query(conn, "query_2", {"city": city}, batch_size, use_cache, window)
+
+
+def query_3(
+    conn: kuzu.Connection,
+    cities: tuple[str, str, str] = ("New York City", "Boston", "Los Angeles"),
+    batch_size: int | None = None,
+    use_cache: bool = False,
+    window: Window | None = None,
+) -> pd.DataFrame | Iterator[pa.RecordBatch]:
+    "Q3. Which companies have merchants in New York City, Boston **and** Los Angeles?"
+    parameters = {f"city_{i}": city for i, city in enumerate(cities, 1)}
+    return run_query(conn, "query_3", parameters, batch_size, use_cache, window)
 
-def query_4(conn: kuzu.Connection) -> None:
+
+def query_4(
+    conn: kuzu.Connection,
+    client_ids: tuple[int, int] = (4, 5),
+    batch_size: int | None = None,
+    use_cache: bool = False,
+    window: Window | None = None,
+) -> pd.DataFrame | Iterator[pa.RecordBatch]:
     "Q4. How many common connections (cities, merchants, companies) exist between Client IDs 4 and 5?"
-    query = """
-        MATCH (c1:Client)-[*1..2]->(common)<-[*1..2]-(c2:Client)
-        WHERE c1.client_id = 4 AND c2.client_id = 5
-        RETURN label(common) AS connectionType, COUNT(label(common)) AS count;
+    parameters = {"client_id_1": client_ids[0], "client_id_2": client_ids[1]}
+    return run_query(conn, "query_4", parameters, batch_size, use_cache, window)
+
+
+def query_4_indexed(conn: kuzu.Connection, client_ids: tuple[int, int] = (4, 5)) -> pd.DataFrame:
+    """
+    Q4, answered from the materialized ClientConnections summary built by `load_data.py`.
+    Counts the distinct common merchants, companies and cities of two clients (query_4
+    counts paths, so it also counts a common node once for every path that reaches it)
     """
-    print(f"\nQuery 4:\n {query}")
-    response = conn.execute(query)
-    result = response.get_as_df()
-    print(result)
-    return result
+    response = conn.execute(
+        CLIENT_CONNECTIONS_QUERY.format(
+            client_id_1=int(client_ids[0]), client_id_2=int(client_ids[1])
+        )
+    )
+    if not response.has_next():
+        return pd.DataFrame(columns=["connectionType", "count"])
+    row = response.get_next()
+    counts = [
+        (label, len(set(row[i]) & set(row[i + 1])))
+        for label, i in [("Merchant", 0), ("Company", 2), ("City", 4)]
+    ]
+    return pd.DataFrame(
+        [(label, count) for label, count in counts if count > 0],
+        columns=["connectionType", "count"],
+    )
 
 
-def main(conn: kuzu.Connection) -> None:
-    query_1(conn)
-    query_2(conn)
-    query_3(conn)
-    query_4(conn)
+def main(conn: kuzu.Connection, window: Window | None = None) -> None:
+    if window is not None:
+        print(f"Transactions from {window[0]} to {window[1]}")
+    registry = get_registry(conn)
+    for i, query in enumerate([query_1, query_2, query_3, query_4], 1):
+        name = register_window_query(registry, query.__name__, window)
+        print(f"\nQuery {i}:\n {registry.queries[name]}")
+        print(query(conn, window=window))
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the example queries on the transactions graph")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Also run each query under PROFILE and write its operator tree to ./query_profiles",
+    )
+    parser.add_argument(
+        "--days", type=int, help="Only use the transactions of the last DAYS days of the data"
+    )
+    parser.add_argument(
+        "--start",
+        type=datetime.datetime.fromisoformat,
+        help="Only use the transactions from this date on",
+    )
+    parser.add_argument(
+        "--end",
+        type=datetime.datetime.fromisoformat,
+        help="Only use the transactions before this date",
+    )
+    args = parser.parse_args()
+
     DB_NAME = "transaction_db"
     # Create database
     db = kuzu.Database(f"./{DB_NAME}")
     conn = kuzu.Connection(db)
+    if args.profile:
+        conn = ProfiledConnection(conn)
 
-    main(conn)
+    main(conn, get_window(conn, days=args.days, start=args.start, end=args.end))
+    if args.profile:
+        conn.write_profiles("query")
@@ -1,61 +1,147 @@
+import argparse
+import datetime
 from typing import Any
 
 import kuzu
 import networkx as nx
 import pandas as pd
+from centrality import Graph, closeness_centrality, sampled_closeness_centrality
+from demo_utils.graph_projection import get_projection
+from demo_utils.transaction_partitions import (
+    Window,
+    get_partition_label,
+    get_window,
+    get_window_partitions,
+)
+from dispute_components import get_components
 
 
-def get_closeness_centrality(conn: kuzu.Connection) -> pd.DataFrame:
+def get_closeness_centrality(
+    conn: kuzu.Connection,
+    workers: int | None = None,
+    epsilon: float | None = None,
+    delta: float = 0.05,
+    window: Window | None = None,
+) -> pd.DataFrame:
     """
-    Get closeness centrality for merchant nodes
+    Get closeness centrality for merchant nodes. Runs a BFS from each merchant only, across a
+    pool of `workers` processes, or with `epsilon`, estimates the centrality from sampled pivots,
+    with bounds that hold for all merchants with probability 1 - `delta`. With a `window`, only
+    the transactions in the window, and the merchants and clients that took part in them, are used
     """
-    clients_and_merchants = conn.execute(
-        """
-        MATCH (c:Client)-[t:TransactedWith]->(m:Merchant)
-        RETURN *;
-        """
-    )
-    # Convert to networkx DiGraph
-    G = clients_and_merchants.get_as_networkx(directed=True)
-    # Get closeness centrality for merchants
-    closeness_centrality = nx.closeness_centrality(G).items()
-    df = pd.DataFrame(closeness_centrality, columns=["node_id", "closeness_centrality"])
-    df = df[df["node_id"].str.startswith("Merchant_")]
-    df["node_id"] = df["node_id"].str.replace("Merchant_", "").astype(int)
-    df = df.sort_values(by="closeness_centrality", ascending=False).reset_index(drop=True)
+    # The edges are memory-mapped from the projections saved by an earlier run, unless
+    # TransactedWith, or the partitions of the window, have been written to since
+    if window is None:
+        G = Graph.from_projection(get_projection(conn, "TransactedWith"), directed=True)
+    else:
+        projections = [
+            get_projection(conn, partition, ["timestamp"])
+            for partition in get_window_partitions(conn, window)
+        ]
+        G = Graph.from_projections(projections, *window, directed=True)
+    if epsilon is None:
+        df = pd.DataFrame({"closeness_centrality": closeness_centrality(G, workers=workers)})
+    else:
+        df = sampled_closeness_centrality(G, epsilon=epsilon, delta=delta, workers=workers)
+    df.insert(0, "node_id", G.merchant_ids)
+    df = df.sort_values(by="closeness_centrality", ascending=False, kind="stable")
+    df = df.reset_index(drop=True)
     print(f"\n---\nTop 5 merchants by closeness centrality for node type Merchant:\n{df.head()}")
     return df
 
 
-def get_weakly_connected_components(conn: kuzu.Connection) -> list[set[Any]]:
+def get_weakly_connected_components(
+    conn: kuzu.Connection, window: Window | None = None
+) -> list[set[Any]]:
     """
     Get weakly connected components for the vicinity of disputed transactions -- includes a combination
-    of client and merchant nodes
+    of client and merchant nodes. The components are maintained by `mark_disputed_transactions.py`
+    as transactions are flagged, so they are read from the DisputeComponent table rather than
+    recomputed. The components of the vicinity within a `window` are computed from the partitions
+    of the window instead
     """
-    disputed_vicinity = conn.execute(
-        """
-        MATCH (c1:Client)-[t1:TransactedWith]->(m:Merchant)<-[t2:TransactedWith]-(c2:Client)
-        WHERE t1.is_disputed = true
-        RETURN *;
-        """
-    )
-    # Convert to networkx DiGraph
-    G = disputed_vicinity.get_as_networkx(directed=True)
-    # Get weakly connected components
-    weakly_connected_components = list(nx.weakly_connected_components(G))
+    if window is None:
+        weakly_connected_components = get_components(conn)
+    else:
+        weakly_connected_components = compute_weakly_connected_components(conn, window)
     print(f"\n---\nNumber of weakly connected components: {len(weakly_connected_components)}")
     for i, component in enumerate(weakly_connected_components, 1):
         print(f"Number of nodes in component {i}: {len(component)}")
     return weakly_connected_components
 
 
-def main(conn: kuzu.Connection):
-    _ = get_weakly_connected_components(conn)
-    _ = get_closeness_centrality(conn)
+def compute_weakly_connected_components(
+    conn: kuzu.Connection, window: Window | None = None
+) -> list[set[Any]]:
+    """
+    Recompute the components of the disputed vicinity from scratch with NetworkX, from the
+    transactions in a `window` only if one is given
+    """
+    if window is None:
+        disputed_vicinity = conn.execute(
+            """
+            MATCH (c1:Client)-[t1:TransactedWith]->(m:Merchant)<-[t2:TransactedWith]-(c2:Client)
+            WHERE t1.is_disputed = true
+            RETURN *;
+            """
+        )
+    else:
+        label = get_partition_label(conn, window)
+        disputed_vicinity = conn.execute(
+            f"""
+            MATCH (c1:Client)-[t1:{label}]->(m:Merchant)<-[t2:{label}]-(c2:Client)
+            WHERE t1.is_disputed = true
+                AND t1.timestamp >= $window_start AND t1.timestamp < $window_end
+                AND t2.timestamp >= $window_start AND t2.timestamp < $window_end
+            RETURN *;
+            """,
+            parameters={"window_start": window[0], "window_end": window[1]},
+        )
+    # Convert to networkx DiGraph
+    G = disputed_vicinity.get_as_networkx(directed=True)
+    return list(nx.weakly_connected_components(G))
+
+
+def main(
+    conn: kuzu.Connection,
+    workers: int | None = None,
+    epsilon: float | None = None,
+    window: Window | None = None,
+):
+    if window is not None:
+        print(f"Transactions from {window[0]} to {window[1]}")
+    _ = get_weakly_connected_components(conn, window=window)
+    _ = get_closeness_centrality(conn, workers=workers, epsilon=epsilon, window=window)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run graph algorithms on the transactions graph")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Processes for closeness centrality"
+    )
+    parser.add_argument(
+        "--epsilon",
+        type=float,
+        default=None,
+        help="Estimate closeness centrality from sampled pivots, within this additive error",
+    )
+    parser.add_argument(
+        "--days", type=int, help="Only use the transactions of the last DAYS days of the data"
+    )
+    parser.add_argument(
+        "--start",
+        type=datetime.datetime.fromisoformat,
+        help="Only use the transactions from this date on",
+    )
+    parser.add_argument(
+        "--end",
+        type=datetime.datetime.fromisoformat,
+        help="Only use the transactions before this date",
+    )
+    args = parser.parse_args()
+
     db = kuzu.Database("./transaction_db")
     conn = kuzu.Connection(db)
 
-    main(conn)
+    window = get_window(conn, days=args.days, start=args.start, end=args.end)
+    main(conn, workers=args.workers, epsilon=args.epsilon, window=window)
@@ -0,0 +1,165 @@
+"""
+Compare ways of marking disputed transactions:
+
+- per-row scan: one statement per id that filters the whole TransactedWith table on the id
+- per-row index: one lookup per id through the TransactionIndex built by `load_data.py`
+- bulk: a single statement that joins all the ids with one scan of TransactedWith
+
+A synthetic transaction graph is generated and loaded into a fresh database for each mode. The
+per-row modes run on a sample of the disputes by default, and their time for the full set is
+extrapolated from the per-id rate.
+"""
+from __future__ import annotations
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import kuzu
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+from load_data import create_edge_tables, create_node_tables, create_transaction_index
+from mark_disputed_transactions import (
+    get_transaction_endpoints,
+    mark_disputed_transactions_bulk,
+    match_transaction,
+)
+
+MARK_DISPUTED = """
+    MATCH (c:Client)-[t:TransactedWith]->(m:Merchant)
+    WHERE t.transaction_id = $transaction_id
+    SET t.is_disputed = TRUE
+    RETURN *;
+"""
+
+
+def write_dataset(DATA_PATH: Path, num_transactions: int, seed: int = 1) -> None:
+    """
+    Write client, merchant and transaction files with about 10 transactions per client and 100
+    per merchant
+    """
+    rng = np.random.default_rng(seed)
+    num_clients = max(10, num_transactions // 10)
+    num_merchants = max(10, num_transactions // 100)
+    clients = pa.table(
+        {
+            "client_id": np.arange(1, num_clients + 1),
+            "name": pa.array([f"Client {i}" for i in range(1, num_clients + 1)]),
+            "age": rng.integers(18, 66, num_clients),
+        }
+    )
+    pv.write_csv(clients, DATA_PATH / "client.csv")
+    merchants = pa.table(
+        {
+            "merchant_id": np.arange(1, num_merchants + 1),
+            "company_id": rng.integers(1, 16, num_merchants),
+            "city_id": rng.integers(1, 15, num_merchants),
+        }
+    )
+    pv.write_csv(merchants, DATA_PATH / "merchant.csv")
+
+    start = np.datetime64("2023-01-01T00:00:00", "s")
+    seconds = rng.integers(0, 365 * 24 * 3600, num_transactions)
+    transactions = pa.table(
+        {
+            "client_id": rng.integers(1, num_clients + 1, num_transactions),
+            "merchant_id": rng.integers(1, num_merchants + 1, num_transactions),
+            "transaction_id": np.arange(1, num_transactions + 1),
+            "amount_usd": np.round(rng.uniform(5.0, 2500.0, num_transactions), 2),
+            "timestamp": start + seconds.astype("timedelta64[s]"),
+            "is_disputed": np.zeros(num_transactions, dtype=bool),
+        }
+    )
+    # Same layout as the edge files written by data/main.py
+    pv.write_csv(
+        transactions,
+        DATA_PATH / "transacted_with.csv",
+        write_options=pv.WriteOptions(include_header=False),
+    )
+
+
+def load_graph(db_path: Path, DATA_PATH: Path) -> kuzu.Connection:
+    db = kuzu.Database(str(db_path))
+    conn = kuzu.Connection(db)
+    create_node_tables(conn)
+    create_edge_tables(conn)
+    conn.execute(f"COPY Client FROM '{DATA_PATH}/client.csv' (header=true);")
+    conn.execute(f"COPY Merchant FROM '{DATA_PATH}/merchant.csv' (header=true);")
+    conn.execute(f"COPY TransactedWith FROM '{DATA_PATH}/transacted_with.csv';")
+    create_transaction_index(conn)
+    return conn
+
+
+def count_disputed(conn: kuzu.Connection) -> int:
+    response = conn.execute("MATCH ()-[t:TransactedWith]->() WHERE t.is_disputed RETURN count(t)")
+    return response.get_next()[0]
+
+
+def time_per_row_scan(conn: kuzu.Connection, transaction_ids: np.ndarray) -> float:
+    start = time.perf_counter()
+    for transaction_id in transaction_ids:
+        conn.execute(MARK_DISPUTED, parameters={"transaction_id": int(transaction_id)})
+    return time.perf_counter() - start
+
+
+def time_per_row_index(conn: kuzu.Connection, transaction_ids: np.ndarray) -> float:
+    start = time.perf_counter()
+    for transaction_id in transaction_ids:
+        endpoints = get_transaction_endpoints(conn, transaction_id)
+        conn.execute(match_transaction(transaction_id, *endpoints) + "SET t.is_disputed = TRUE;")
+    return time.perf_counter() - start
+
+
+def time_bulk(conn: kuzu.Connection, transaction_ids: np.ndarray) -> float:
+    start = time.perf_counter()
+    mark_disputed_transactions_bulk(conn, pd.DataFrame({"transaction_id": transaction_ids}))
+    return time.perf_counter() - start
+
+
+def main(num_transactions: int, num_disputes: int, per_row_sample: int | None) -> None:
+    rng = np.random.default_rng(2)
+    transaction_ids = rng.choice(np.arange(1, num_transactions + 1), num_disputes, replace=False)
+    sample = transaction_ids[:per_row_sample] if per_row_sample else transaction_ids
+
+    with tempfile.TemporaryDirectory() as tmp:
+        DATA_PATH = Path(tmp) / "data"
+        DATA_PATH.mkdir()
+        write_dataset(DATA_PATH, num_transactions)
+        print(f"Marking {num_disputes} disputes among {num_transactions} transactions")
+
+        per_row_modes = {"per-row scan": time_per_row_scan, "per-row index": time_per_row_index}
+        estimates = {}
+        for mode, time_mode in per_row_modes.items():
+            conn = load_graph(Path(tmp) / mode.replace(" ", "_"), DATA_PATH)
+            elapsed = time_mode(conn, sample)
+            estimates[mode] = elapsed * num_disputes / len(sample)
+            print(
+                f"{mode:<14} {elapsed:.3f}s for {len(sample)} ids ({count_disputed(conn)} marked), "
+                f"{estimates[mode]:.3f}s estimated for {num_disputes}"
+            )
+
+        conn = load_graph(Path(tmp) / "bulk", DATA_PATH)
+        bulk_time = time_bulk(conn, transaction_ids)
+        print(
+            f"{'bulk':<14} {bulk_time:.3f}s for {num_disputes} ids ({count_disputed(conn)} marked)\n"
+        )
+        for mode, estimate in estimates.items():
+            print(f"Bulk marking is {estimate / bulk_time:.1f}x faster than {mode}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--num-transactions", type=int, default=1_000_000)
+    parser.add_argument("--num-disputes", type=int, default=100_000)
+    parser.add_argument(
+        "--per-row-sample",
+        type=int,
+        default=1000,
+        help="Number of ids to time the per-row modes on (0 runs them on all disputes)",
+    )
+    args = parser.parse_args()
+
+    main(args.num_transactions, args.num_disputes, args.per_row_sample)
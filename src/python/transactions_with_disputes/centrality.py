@@ -0,0 +1,284 @@
+"""
+Closeness centrality of merchants over a CSR adjacency of the Client -> Merchant graph.
+
+Matches `nx.closeness_centrality` on the graph returned by `get_as_networkx(directed=True)`,
+including the Wasserman-Faust scaling for graphs that are not strongly connected, but only runs
+a BFS from the nodes whose centrality is needed, and spreads the BFS sources across a process pool.
+On a directed graph, closeness uses the distances *to* a node, so the BFS runs over the reversed
+edges.
+
+For very large graphs, `sampled_closeness_centrality` estimates the centrality from BFS runs out of
+a uniform sample of pivot nodes instead (Eppstein and Wang), with a Hoeffding bound on the error.
+"""
+from __future__ import annotations
+
+import datetime
+import math
+import os
+from multiprocessing import Pool
+
+import kuzu
+import numpy as np
+import pandas as pd
+from demo_utils.graph_projection import Projection, shareable, unshare
+
+# Adjacency shared with the worker processes, set once per worker by `init_worker`
+_csr: tuple[np.ndarray, np.ndarray] | None = None
+
+
+class Graph:
+    """
+    Client and merchant nodes numbered 0..n-1 (clients first), with CSR adjacency in both
+    directions. Only nodes with at least one transaction are included, as in `get_as_networkx`
+    """
+
+    def __init__(
+        self,
+        client_ids: np.ndarray,
+        merchant_ids: np.ndarray,
+        forward: tuple[np.ndarray, np.ndarray],
+        reverse: tuple[np.ndarray, np.ndarray],
+    ):
+        self.client_ids = client_ids
+        self.merchant_ids = merchant_ids
+        self.num_nodes = len(client_ids) + len(merchant_ids)
+        self.forward = forward
+        self.reverse = reverse
+
+    @classmethod
+    def from_edges(
+        cls, client_ids: np.ndarray, merchant_ids: np.ndarray, directed: bool = True
+    ) -> Graph:
+        clients, src = np.unique(client_ids, return_inverse=True)
+        merchants, dst = np.unique(merchant_ids, return_inverse=True)
+        dst = dst + len(clients)
+        num_nodes = len(clients) + len(merchants)
+        if not directed:
+            src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+        return cls(clients, merchants, to_csr(src, dst, num_nodes), to_csr(dst, src, num_nodes))
+
+    @classmethod
+    def from_kuzu(cls, conn: kuzu.Connection, directed: bool = True) -> Graph:
+        edges = conn.execute(
+            """
+            MATCH (c:Client)-[:TransactedWith]->(m:Merchant)
+            RETURN DISTINCT c.client_id AS client_id, m.merchant_id AS merchant_id;
+            """
+        ).get_as_arrow()
+        return cls.from_edges(
+            edges["client_id"].to_numpy(), edges["merchant_id"].to_numpy(), directed=directed
+        )
+
+    @classmethod
+    def from_projection(cls, projection: Projection, directed: bool = True) -> Graph:
+        """
+        Use the memory-mapped arrays of a TransactedWith projection as they are. Parallel edges
+        do not change the BFS distances, so they are not removed
+        """
+        client_ids, merchant_ids = projection.node_ids["Client"], projection.node_ids["Merchant"]
+        forward = (projection.offsets, projection.targets)
+        reverse = (projection.in_offsets, projection.in_sources)
+        if not directed:
+            src, dst = projection.sources(), projection.targets
+            src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+            forward = reverse = to_csr(src, dst, projection.num_nodes)
+        return cls(client_ids, merchant_ids, forward, reverse)
+
+    @classmethod
+    def from_projections(
+        cls,
+        projections: list[Projection],
+        start: datetime.datetime,
+        end: datetime.datetime,
+        directed: bool = True,
+    ) -> Graph:
+        """
+        Combine the projections of the monthly partitions of TransactedWith, saved with their
+        `timestamp`, into the graph of the transactions in [start, end)
+        """
+        client_ids, merchant_ids = [], []
+        for projection in projections:
+            timestamps = projection.weights["timestamp"]
+            in_window = (timestamps >= np.datetime64(start)) & (timestamps < np.datetime64(end))
+            clients = projection.node_ids["Client"]
+            client_ids.append(clients[projection.sources()[in_window]])
+            merchant_ids.append(
+                projection.node_ids["Merchant"][projection.targets[in_window] - len(clients)]
+            )
+        return cls.from_edges(
+            np.concatenate(client_ids), np.concatenate(merchant_ids), directed=directed
+        )
+
+    @property
+    def merchant_nodes(self) -> np.ndarray:
+        return np.arange(len(self.client_ids), self.num_nodes)
+
+
+def to_csr(src: np.ndarray, dst: np.ndarray, num_nodes: int) -> tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(src, kind="stable")
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=num_nodes), out=indptr[1:])
+    return indptr, dst[order].astype(np.int64)
+
+
+def bfs(
+    indptr: np.ndarray, indices: np.ndarray, source: int, dist: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Level-synchronous BFS from `source`. Returns the reached nodes and their distances. `dist` is
+    scratch space of length n filled with -1, which is restored before returning, so that each
+    BFS only costs as much as the part of the graph it reaches
+    """
+    dist[source] = 0
+    frontier = np.array([source], dtype=np.int64)
+    reached = [frontier]
+    level = 0
+    while frontier.size:
+        level += 1
+        starts, lengths = indptr[frontier], indptr[frontier + 1] - indptr[frontier]
+        total = lengths.sum()
+        if total == 0:
+            break
+        # Positions in `indices` of all the edges out of the frontier
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        neighbors = indices[offsets]
+        frontier = pd.unique(neighbors[dist[neighbors] < 0])
+        dist[frontier] = level
+        reached.append(frontier)
+    nodes = np.concatenate(reached)
+    distances = dist[nodes].copy()
+    dist[nodes] = -1
+    return nodes, distances
+
+
+def init_worker(indptr: np.ndarray | str, indices: np.ndarray | str) -> None:
+    global _csr
+    _csr = (unshare(indptr), unshare(indices))
+
+
+def closeness_sums(sources: np.ndarray) -> np.ndarray:
+    "Number of nodes reached and sum of distances of a BFS from each source"
+    indptr, indices = _csr
+    dist = np.full(len(indptr) - 1, -1, dtype=np.int64)
+    sums = np.zeros((len(sources), 2), dtype=np.int64)
+    for i, source in enumerate(sources):
+        _, distances = bfs(indptr, indices, source, dist)
+        sums[i] = len(distances), distances.sum()
+    return sums
+
+
+def pivot_sums(pivots: np.ndarray) -> tuple[np.ndarray, int]:
+    """
+    For every node, the number of pivots that reach it and the sum of their distances to it, along
+    with the largest distance seen
+    """
+    indptr, indices = _csr
+    num_nodes = len(indptr) - 1
+    dist = np.full(num_nodes, -1, dtype=np.int64)
+    sums = np.zeros((2, num_nodes), dtype=np.int64)
+    max_distance = 0
+    for pivot in pivots:
+        nodes, distances = bfs(indptr, indices, pivot, dist)
+        # The pivot itself is excluded, like the source in nx.closeness_centrality
+        sums[0, nodes[1:]] += 1
+        sums[1, nodes] += distances
+        max_distance = max(max_distance, int(distances[-1]))
+    return sums, max_distance
+
+
+def map_chunks(func, csr: tuple[np.ndarray, np.ndarray], items: np.ndarray, workers: int) -> list:
+    chunks = np.array_split(items, max(1, min(len(items), workers * 8)))
+    if workers <= 1:
+        init_worker(*csr)
+        return [func(chunk) for chunk in chunks]
+    initargs = tuple(shareable(array) for array in csr)
+    with Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+        return pool.map(func, chunks)
+
+
+def closeness_from_sums(
+    reached: np.ndarray, total_distance: np.ndarray, num_nodes: int
+) -> np.ndarray:
+    "nx.closeness_centrality with wf_improved=True, from the reach and distance sums"
+    reached = reached.astype(float)
+    closeness = np.zeros(len(reached))
+    mask = (total_distance > 0) & (num_nodes > 1)
+    closeness[mask] = (reached[mask] - 1) / total_distance[mask]
+    closeness[mask] *= (reached[mask] - 1) / (num_nodes - 1)
+    return closeness
+
+
+def closeness_centrality(
+    graph: Graph, nodes: np.ndarray | None = None, workers: int | None = None
+) -> np.ndarray:
+    """
+    Exact closeness centrality of `nodes` (the merchants by default), in the order given
+    """
+    nodes = graph.merchant_nodes if nodes is None else nodes
+    sums = np.concatenate(
+        map_chunks(closeness_sums, graph.reverse, nodes, workers or os.cpu_count() or 1)
+    )
+    return closeness_from_sums(sums[:, 0], sums[:, 1], graph.num_nodes)
+
+
+def required_samples(epsilon: float, delta: float, num_nodes: int) -> int:
+    """
+    Number of pivots for which, by Hoeffding's inequality and a union bound over the nodes, the
+    estimated fraction of nodes that reach each node, and its estimated mean distance (relative to
+    the largest distance), are all within `epsilon` of the truth with probability 1 - `delta`
+    """
+    return math.ceil(math.log(4 * num_nodes / delta) / (2 * epsilon**2))
+
+
+def sampled_closeness_centrality(
+    graph: Graph,
+    epsilon: float = 0.01,
+    delta: float = 0.05,
+    nodes: np.ndarray | None = None,
+    workers: int | None = None,
+    num_pivots: int | None = None,
+    seed: int = 1,
+) -> pd.DataFrame:
+    """
+    Estimate the closeness centrality of `nodes` (the merchants by default) from BFS runs out of
+    uniformly sampled pivots. Each pivot's BFS yields its distance to every node at once, so the
+    cost depends on the number of pivots rather than on the number of nodes of interest.
+
+    Returns the estimates with lower and upper bounds that hold for all nodes simultaneously with
+    probability 1 - `delta`. The bounds scale the distance error by the largest distance seen from
+    the pivots, which is only a lower bound on the true diameter
+    """
+    nodes = graph.merchant_nodes if nodes is None else nodes
+    n = graph.num_nodes
+    if num_pivots is None:
+        num_pivots = required_samples(epsilon, delta, len(nodes))
+    else:
+        # The error that a fixed number of pivots guarantees
+        epsilon = math.sqrt(math.log(4 * len(nodes) / delta) / (2 * num_pivots))
+    pivots = np.random.default_rng(seed).integers(0, n, num_pivots)
+    results = map_chunks(pivot_sums, graph.forward, pivots, workers or os.cpu_count() or 1)
+    sums = sum(result[0] for result in results)
+    max_distance = max(1, *(result[1] for result in results))
+
+    # Fraction of all nodes that reach each node, and sum of their distances per node of the graph
+    reach = sums[0, nodes] / num_pivots
+    mean_distance = sums[1, nodes] / num_pivots
+
+    def closeness(reach: np.ndarray, mean_distance: np.ndarray) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = n * reach**2 / ((n - 1) * mean_distance)
+        return np.clip(np.where(mean_distance > 0, values, 0.0), 0.0, 1.0)
+
+    # Every node that reaches a node is at distance 1 or more, so the mean distance is at least the
+    # reach, and the closeness grows with the reach even then
+    distance_error = epsilon * max_distance
+    min_distance = np.maximum(mean_distance - distance_error, reach + epsilon)
+    return pd.DataFrame(
+        {
+            "closeness_centrality": closeness(reach, mean_distance),
+            "lower_bound": closeness(
+                np.maximum(reach - epsilon, 0), mean_distance + distance_error
+            ),
+            "upper_bound": closeness(reach + epsilon, min_distance),
+        }
+    )
@@ -1,6 +1,17 @@
 """
 Generate node and edge data files for example study.
 
+Clients, merchants and transactions are generated with NumPy in chunks of CHUNK_SIZE rows that are
+streamed to disk, so memory use does not grow with the size of the dataset. Each chunk draws from
+its own random stream, derived from the seed and the chunk number, so the output only depends on
+the seed, the sizes and the end date.
+
+With `--shards N`, the chunks of each file are split into N contiguous shards that are generated
+by a pool of processes, and each shard is written to its own part file, e.g.
+`rel/transacted_with/part-00003.parquet`, which `load_data.py` copies with a glob. Since the
+random streams belong to chunks rather than to processes, the rows do not depend on the number of
+workers, or even on the number of shards.
+
 Assumes the following files pre-exist:
 - node/city.csv
 - node/company.csv
@@ -12,141 +23,384 @@ Once the data is generated, some manual modifications are done to create realist
 Manually create a file node/dispute.csv with some sample transaction IDs (from the generated data)
 that we will analyze as disputed transactions.
 """
-import random
+import argparse
+import datetime
+import itertools
+import math
+import os
+import shutil
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing import get_context
 from pathlib import Path
-from typing import Any
 
+import numpy as np
 import polars as pl
-from faker import Faker
+import pyarrow.parquet as pq
+from faker.providers.person.en_US import Provider as PersonProvider
+
+SEED = 1
+NODE_PATH = "./node"
+REL_PATH = "./rel"
+ROW_GROUP_SIZE = 1_000_000
+CHUNK_SIZE = 1_000_000
+
+# Column types for the edge files when they are staged as Parquet
+EDGE_SCHEMAS = {
+    "belongs_to": {"merchant_id": pl.Int64, "company_id": pl.Int64},
+    "located_in": {"merchant_id": pl.Int64, "city_id": pl.Int64},
+    "transacted_with": {
+        "client_id": pl.Int64,
+        "merchant_id": pl.Int64,
+        "transaction_id": pl.Int64,
+        "amount_usd": pl.Float32,
+        "timestamp": pl.Datetime("us"),
+        "is_disputed": pl.Boolean,
+    },
+}
+# Company types whose transactions are larger
+HIGH_VALUE_TYPES = ["hotel", "telecom"]
+# Random streams, combined with the seed (and the chunk number)
+(
+    CLIENT_STREAM,
+    MERCHANT_STREAM,
+    TRANSACTION_STREAM,
+    PROLIFIC_STREAM,
+    PROLIFIC_SAMPLE_STREAM,
+) = range(5)
+
+
+def get_rng(*stream: int) -> np.random.Generator:
+    return np.random.default_rng([SEED, *stream])
+
 
-Record = dict[str, Any]
+def get_num_chunks(n: int) -> int:
+    return math.ceil(n / CHUNK_SIZE)
 
 
-def get_random_amount_usd(company_type: str) -> float:
-    if company_type.lower() in ["hotel", "telecom"]:
-        return round(random.uniform(100.0, 2500.0), 2)
-    return round(random.uniform(5.0, 500.0), 2)
+def get_shards(num_chunks: int, num_shards: int) -> list[range]:
+    """
+    Split chunk numbers 0..num_chunks-1 into at most `num_shards` contiguous, non-empty ranges
+    """
+    num_shards = max(1, min(num_shards, num_chunks))
+    return [
+        range(num_chunks * shard // num_shards, num_chunks * (shard + 1) // num_shards)
+        for shard in range(num_shards)
+    ]
+
+
+def get_chunk_ids(chunk: int, n: int, offset: int = 0) -> np.ndarray:
+    "Ids (from 1) of the rows of a chunk, of n rows in total"
+    start, end = chunk * CHUNK_SIZE, min((chunk + 1) * CHUNK_SIZE, n)
+    return np.arange(offset + start + 1, offset + end + 1)
 
 
-def get_company_type(companies_df: pl.DataFrame, company_id: int) -> str:
-    return companies_df.filter(pl.col("company_id") == company_id).get_column("type").to_list()[0]
+def get_output_path(
+    directory: str, name: str, extension: str, shard: int = 0, num_shards: int = 1
+) -> Path:
+    "A single file, or a part file in a directory named after the file when there are shards"
+    if num_shards == 1:
+        return Path(directory) / f"{name}.{extension}"
+    return Path(directory) / name / f"part-{shard:05d}.{extension}"
 
 
-def write_client_csv(n: int = 1000) -> pl.DataFrame:
+def prepare_output(directory: str, name: str, extension: str, num_shards: int) -> None:
     """
-    Write node file client.csv
+    Remove the output of an earlier run, so that a single file and part files are never both
+    present, and no stale part files are left behind by a run with more shards
     """
+    path = Path(directory) / name
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    shutil.rmtree(path, ignore_errors=True)
+    path.with_name(f"{name}.{extension}").unlink(missing_ok=True)
+    if num_shards > 1:
+        path.mkdir(parents=True)
+
+
+def write_node_chunks(chunks: Iterable[pl.DataFrame], path: Path) -> None:
+    with open(path, "wb") as f:
+        for i, chunk in enumerate(chunks):
+            chunk.write_csv(f, include_header=i == 0)
+
 
-    def generate_client(id: int) -> Record:
-        full_name = f"{fake.first_name()} {fake.random_letter().upper()}."
-        record = {
-            "id": int(id),
-            "name": full_name,
-            "age": random.randint(18, 65),
+def write_edge_chunks(chunks: Iterable[pl.DataFrame], path: Path, name: str) -> int:
+    """
+    Stream chunks to an edge file without headers (CSV), or as typed, row-group-partitioned
+    Parquet. Returns the number of rows written
+    """
+    num_rows = 0
+    if path.suffix == ".parquet":
+        schema = pl.DataFrame(schema=EDGE_SCHEMAS[name]).to_arrow().schema
+        # pyarrow's writer annotates timestamps in a way that Kùzu reads back as TIMESTAMP
+        with pq.ParquetWriter(path, schema) as writer:
+            for chunk in chunks:
+                table = chunk.cast(EDGE_SCHEMAS[name]).to_arrow()
+                writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+                num_rows += len(chunk)
+    else:
+        with open(path, "wb") as f:
+            for chunk in chunks:
+                chunk.write_csv(f, include_header=False, datetime_format="%Y-%m-%d %H:%M:%S")
+                num_rows += len(chunk)
+    return num_rows
+
+
+def generate_clients(rng: np.random.Generator, client_ids: np.ndarray) -> pl.DataFrame:
+    n = len(client_ids)
+    # Same first names and frequencies as Faker's en_US locale
+    first_names = pl.Series(list(PersonProvider.first_names))
+    weights = np.array(list(PersonProvider.first_names.values()))
+    letters = pl.Series(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+    return pl.DataFrame(
+        {
+            "id": client_ids,
+            "name": first_names.gather(rng.choice(len(weights), n, p=weights / weights.sum()))
+            + " "
+            + letters.gather(rng.integers(0, 26, n))
+            + ".",
+            "age": rng.integers(18, 66, n),
         }
-        return record
+    )
 
-    clients = [generate_client(i) for i in range(1, n + 1)]
-    df = pl.DataFrame(clients)
-    df.write_csv(f"{NODE_PATH}/client.csv")
-    return df
+
+def write_client_csv(n: int = 1000, shard: int = 0, num_shards: int = 1) -> None:
+    """
+    Write node file client.csv (or one of its part files)
+    """
+    chunks = (
+        generate_clients(get_rng(CLIENT_STREAM, chunk), get_chunk_ids(chunk, n))
+        for chunk in get_shards(get_num_chunks(n), num_shards)[shard]
+    )
+    write_node_chunks(chunks, get_output_path(NODE_PATH, "client", "csv", shard, num_shards))
 
 
-def write_merchant_and_location_csv(max_companies: int, n: int = 100) -> pl.DataFrame:
+def write_merchant_and_location_csv(
+    max_companies: int,
+    n: int = 100,
+    file_format: str = "csv",
+    shard: int = 0,
+    num_shards: int = 1,
+) -> np.ndarray:
     """
     Write node file merchant.csv
-    Write edge file belongs_to.csv
-    Write edge file located_in.csv
+    Write edge file belongs_to.csv (or .parquet)
+    Write edge file located_in.csv (or .parquet)
+    (or one of their part files). Returns the company id of each merchant
     """
-    # Set max_companies to the number of companies in company.csv
-    merchants = []
-    for i in range(1, n + 1):
+    dfs = []
+    for chunk in get_shards(get_num_chunks(n), num_shards)[shard]:
+        rng = get_rng(MERCHANT_STREAM, chunk)
+        merchant_ids = get_chunk_ids(chunk, n)
+        # Set max_companies to the number of companies in company.csv
+        company_ids = rng.integers(1, max_companies + 1, len(merchant_ids))
         # Assume a maximum of 15 cities
-        city_id = random.choice(range(1, 16))
-        merchant_id = random.randint(1, max_companies)
-        tuples = (i, merchant_id, city_id)
-        merchants.append(tuples)
-    df = pl.DataFrame(merchants, schema=["merchant_id", "company_id", "city_id"]).sort(
-        ["merchant_id", "company_id"]
-    )
-    df.write_csv(f"{NODE_PATH}/merchant.csv")
-    df.select("merchant_id", "company_id").write_csv(
-        f"{REL_PATH}/belongs_to.csv", include_header=False
-    )
-    df.select("merchant_id", "city_id").write_csv(
-        f"{REL_PATH}/located_in.csv", include_header=False
+        city_ids = rng.integers(1, 16, len(merchant_ids))
+        dfs.append(
+            pl.DataFrame(
+                {"merchant_id": merchant_ids, "company_id": company_ids, "city_id": city_ids}
+            )
+        )
+    write_node_chunks(dfs, get_output_path(NODE_PATH, "merchant", "csv", shard, num_shards))
+    for name, column in [("belongs_to", "company_id"), ("located_in", "city_id")]:
+        write_edge_chunks(
+            (df.select("merchant_id", column) for df in dfs),
+            get_output_path(REL_PATH, name, file_format, shard, num_shards),
+            name,
+        )
+    return np.concatenate([df.get_column("company_id").to_numpy() for df in dfs])
+
+
+def generate_transactions(
+    rng: np.random.Generator,
+    transaction_ids: np.ndarray,
+    client_ids: np.ndarray,
+    is_high_value: np.ndarray,
+    start: np.datetime64,
+    num_seconds: int,
+) -> pl.DataFrame:
+    """
+    Transactions of the given clients with uniformly chosen merchants. Amounts are uniform in
+    [100, 2500] USD for hotels and telecoms and in [5, 500] USD otherwise, and timestamps are
+    uniform in the year before the end date
+    """
+    n = len(transaction_ids)
+    # Merchant ids run from 1 to the number of merchants
+    merchants = rng.integers(0, len(is_high_value), n)
+    high_value = is_high_value[merchants]
+    amounts = rng.uniform(np.where(high_value, 100.0, 5.0), np.where(high_value, 2500.0, 500.0))
+    timestamps = start + rng.integers(0, num_seconds, n).astype("timedelta64[s]")
+    return pl.DataFrame(
+        {
+            "client_id": client_ids,
+            "merchant_id": merchants + 1,
+            "transaction_id": transaction_ids,
+            "amount_usd": np.round(amounts, 2),
+            "timestamp": timestamps.astype("datetime64[us]"),
+            "is_disputed": np.zeros(n, dtype=bool),
+        }
     )
-    return df
+
+
+def get_prolific_clients(num_clients: int) -> np.ndarray:
+    "Randomly sample 2% of clients to have 5 more transactions each, in order of client id"
+    rng = get_rng(PROLIFIC_SAMPLE_STREAM)
+    # With an int population of which at most 1/50 is sampled, numpy uses Floyd's algorithm, whose
+    # memory use is proportional to the sample rather than to the number of clients. It draws the
+    # same sample as from an array of the client ids
+    return np.sort(rng.choice(num_clients, int(num_clients * 0.02), replace=False)) + 1
+
+
+def get_transaction_chunks(n: int, num_prolific_clients: int) -> list[tuple[int, int]]:
+    """
+    Random stream and chunk number of the chunks of transactions: those of random clients,
+    followed by the 5 extra transactions of each prolific client
+    """
+    return [(TRANSACTION_STREAM, chunk) for chunk in range(get_num_chunks(n))] + [
+        (PROLIFIC_STREAM, chunk) for chunk in range(get_num_chunks(num_prolific_clients * 5))
+    ]
 
 
 def write_transaction_csv(
-    client_df: pl.DataFrame, merchant_df: pl.DataFrame, n: int = 1000
-) -> None:
+    num_clients: int,
+    is_high_value: np.ndarray,
+    prolific_clients: np.ndarray,
+    n: int = 1000,
+    file_format: str = "csv",
+    end_date: datetime.date | None = None,
+    shard: int = 0,
+    num_shards: int = 1,
+) -> int:
     """
-    Write edge file transacted_with.csv
+    Write edge file transacted_with.csv (or .parquet, or one of their part files), with
+    transaction_id as an edge property. Returns the number of transactions written
     """
-    client_ids = client_df.get_column("id").to_list()
-    merchant_ids = merchant_df.get_column("merchant_id").to_list()
-    company_ids = merchant_df.get_column("company_id").to_list()
-    merchant_lookup = {merchant_ids[i]: company_ids[i] for i in range(len(merchant_ids))}
+    end_date = end_date or datetime.date.today()
+    # From midnight a year before the end date, to the end of the end date
+    start = np.datetime64(end_date - datetime.timedelta(days=365), "s")
+    args = (is_high_value, start, 366 * 24 * 3600)
+
+    def generate_chunks() -> Iterator[pl.DataFrame]:
+        chunks = get_transaction_chunks(n, len(prolific_clients))
+        for i in get_shards(len(chunks), num_shards)[shard]:
+            stream, chunk = chunks[i]
+            rng = get_rng(stream, chunk)
+            if stream == TRANSACTION_STREAM:
+                transaction_ids = get_chunk_ids(chunk, n)
+                client_ids = rng.integers(1, num_clients + 1, len(transaction_ids))
+            else:
+                # Transaction ids must be unique, since they are the primary key of the
+                # TransactionIndex, so these follow the ids of the other transactions
+                transaction_ids = get_chunk_ids(chunk, len(prolific_clients) * 5, offset=n)
+                client_ids = prolific_clients[(transaction_ids - n - 1) // 5]
+            yield generate_transactions(rng, transaction_ids, client_ids, *args)
+
+    path = get_output_path(REL_PATH, "transacted_with", file_format, shard, num_shards)
+    return write_edge_chunks(generate_chunks(), path, "transacted_with")
+
+
+def run_shards(starmap: Callable, func: Callable, num_chunks: int, num_shards: int) -> list:
+    "Call `func(shard=...)` for every shard of num_chunks chunks, and return the results in order"
+    shards = range(len(get_shards(num_chunks, num_shards)))
+    return starmap(call_shard, [(func, shard) for shard in shards])
+
+
+def call_shard(func: Callable, shard: int):
+    return func(shard=shard)
+
+
+def main(
+    file_format: str = "csv",
+    num_clients: int = 1000,
+    num_merchants: int = 100,
+    num_transactions: int = 1000,
+    end_date: datetime.date | None = None,
+    num_shards: int = 1,
+    workers: int | None = None,
+) -> None:
+    for directory, name, extension in [
+        (NODE_PATH, "client", "csv"),
+        (NODE_PATH, "merchant", "csv"),
+        (REL_PATH, "belongs_to", file_format),
+        (REL_PATH, "located_in", file_format),
+        (REL_PATH, "transacted_with", file_format),
+    ]:
+        prepare_output(directory, name, extension, num_shards)
     companies_df = pl.read_csv(f"{NODE_PATH}/company.csv")
-    transactions = []
-    for i in range(1, n + 1):
-        client_id = random.choice(client_ids)
-        merchant_id = random.choice(merchant_ids)
-        amount = get_random_amount_usd(get_company_type(companies_df, merchant_lookup[merchant_id]))
-        timestamp = f"{fake.date_between(start_date='-1y', end_date='now')} {fake.time()}"
-        tuples = (i, client_id, merchant_id, amount, timestamp, False)
-        transactions.append(tuples)
-
-    # Randomly sample 2% of clients to have more transactions than others
-    prolific_clients = random.sample(client_ids, int(n * 0.02))
-    print(f"Randomly selected {len(prolific_clients)} prolific clients out of {n} clients.")
-    for i in range(1, n + 1):
-        if i in prolific_clients:
-            for _ in range(5):
-                client_id = i
-                merchant_id = random.choice(merchant_ids)
-                amount = get_random_amount_usd(
-                    get_company_type(companies_df, merchant_lookup[merchant_id])
-                )
-                timestamp = f"{fake.date_between(start_date='-1y', end_date='now')} {fake.time()}"
-                tuples = (i + n, client_id, merchant_id, amount, timestamp, False)
-                transactions.append(tuples)
-
-    df = pl.DataFrame(
-        transactions,
-        schema=[
-            "transaction_id",
-            "client_id",
-            "merchant_id",
-            "amount_usd",
-            "timestamp",
-            "is_disputed",
-        ],
+    high_value_companies = companies_df.filter(
+        pl.col("type").str.to_lowercase().is_in(HIGH_VALUE_TYPES)
+    ).get_column("company_id")
+    prolific_clients = get_prolific_clients(num_clients)
+    print(
+        f"Randomly selected {len(prolific_clients)} prolific clients out of {num_clients} clients."
     )
-    # Write `transacted_with.csv` edge file with transaction_id as an edge property
-    df.select(
-        "client_id", "merchant_id", "transaction_id", "amount_usd", "timestamp", "is_disputed"
-    ).write_csv(f"{REL_PATH}/transacted_with.csv", include_header=False)
-    print(f"Wrote {len(df)} transactions to transacted_with.csv")
-
 
-def main() -> None:
-    client_df = write_client_csv(n=1000)
-    merchant_df = write_merchant_and_location_csv(max_companies=15, n=100)
-    write_transaction_csv(client_df, merchant_df, n=1000)
+    workers = workers or min(num_shards, os.cpu_count() or 1)
+    # Forked children can deadlock on locks held by polars' thread pool, so workers are spawned
+    with get_context("spawn").Pool(workers) if workers > 1 else nullcontext() as pool:
+        starmap = pool.starmap if pool else lambda func, tasks: list(itertools.starmap(func, tasks))
+        write_clients = partial(write_client_csv, num_clients, num_shards=num_shards)
+        run_shards(starmap, write_clients, get_num_chunks(num_clients), num_shards)
+        write_merchants = partial(
+            write_merchant_and_location_csv,
+            max_companies=15,
+            n=num_merchants,
+            file_format=file_format,
+            num_shards=num_shards,
+        )
+        company_ids = run_shards(
+            starmap, write_merchants, get_num_chunks(num_merchants), num_shards
+        )
+        is_high_value = np.isin(np.concatenate(company_ids), high_value_companies)
+        write_transactions = partial(
+            write_transaction_csv,
+            num_clients,
+            is_high_value,
+            prolific_clients,
+            n=num_transactions,
+            file_format=file_format,
+            end_date=end_date,
+            num_shards=num_shards,
+        )
+        num_chunks = len(get_transaction_chunks(num_transactions, len(prolific_clients)))
+        num_rows = run_shards(starmap, write_transactions, num_chunks, num_shards)
+    print(f"Wrote {sum(num_rows)} transactions to transacted_with.{file_format}")
 
 
 if __name__ == "__main__":
-    SEED = 1
-    random.seed(SEED)
-    Faker.seed(SEED)
-    fake = Faker(locale="en_US")
-
-    NODE_PATH = "./node"
-    REL_PATH = "./rel"
-    Path.mkdir(Path(NODE_PATH), exist_ok=True, parents=True)
-    Path.mkdir(Path(REL_PATH), exist_ok=True, parents=True)
+    parser = argparse.ArgumentParser(description="Generate node and edge data files")
+    parser.add_argument(
+        "--format",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="File format for the edge files",
+    )
+    parser.add_argument("--num-clients", type=int, default=1000)
+    parser.add_argument("--num-merchants", type=int, default=100)
+    parser.add_argument("--num-transactions", type=int, default=1000)
+    parser.add_argument(
+        "--end-date",
+        type=datetime.date.fromisoformat,
+        default=None,
+        help="Last day of the year of transactions, as YYYY-MM-DD (default: today)",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Split each file into this many part files, generated in parallel",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Processes (default: one per shard, up to #CPUs)"
+    )
+    args = parser.parse_args()
 
-    main()
+    main(
+        file_format=args.format,
+        num_clients=args.num_clients,
+        num_merchants=args.num_merchants,
+        num_transactions=args.num_transactions,
+        end_date=args.end_date,
+        num_shards=args.shards,
+        workers=args.workers,
+    )
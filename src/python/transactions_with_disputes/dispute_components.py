@@ -0,0 +1,230 @@
+"""
+Weakly connected components of the disputed-transaction vicinity, maintained incrementally.
+
+The vicinity is the graph matched by `analyze.get_weakly_connected_components`: each merchant with
+a disputed transaction, together with every client that transacted with it. A merchant therefore
+joins the vicinity as a star of its clients, and stars that share a client fall into the same
+component.
+
+The components are stored as a union-find in the `DisputeComponent` node table, with each node
+pointing straight at the root of its component, so that membership and sizes can be read with a
+single query. When newly disputed transactions bring new merchants into the vicinity, or new
+transactions bring new clients to merchants that are already in it, only the components they
+touch are loaded and merged (by size, relabeling the members of the smaller component), so each
+node is relabeled at most a logarithmic number of times.
+"""
+from __future__ import annotations
+
+from collections.abc import Iterable
+from typing import Any
+
+import kuzu
+import pandas as pd
+import pyarrow as pa
+
+
+def create_dispute_component_table(conn: kuzu.Connection) -> None:
+    conn.execute(
+        """
+        CREATE NODE TABLE IF NOT EXISTS
+            DisputeComponent(
+                node_id STRING,
+                component STRING,
+                PRIMARY KEY (node_id)
+            )
+        """
+    )
+
+
+def get_new_disputed_merchants(conn: kuzu.Connection, transaction_ids: Iterable[int]) -> list[int]:
+    """
+    Merchants of the given transactions that are not in the vicinity yet, looked up through the
+    TransactionIndex rather than the edge table
+    """
+    response = conn.execute(
+        """
+        LOAD FROM $disputes
+        MATCH (i:TransactionIndex)
+        WHERE i.transaction_id = transaction_id
+        RETURN DISTINCT i.merchant_id;
+        """,
+        parameters={"disputes": pa.table({"transaction_id": pa.array(transaction_ids, pa.int64())})},
+    )
+    merchant_ids = [row[0] for row in response.get_all()]
+    if not merchant_ids:
+        return []
+    response = conn.execute(
+        """
+        UNWIND $node_ids AS node_id
+        MATCH (d:DisputeComponent {node_id: node_id})
+        RETURN d.node_id;
+        """,
+        parameters={"node_ids": [f"Merchant_{merchant_id}" for merchant_id in merchant_ids]},
+    )
+    known = {row[0] for row in response.get_all()}
+    return [merchant_id for merchant_id in merchant_ids if f"Merchant_{merchant_id}" not in known]
+
+
+def get_stars(conn: kuzu.Connection, merchant_ids: list[int]) -> dict[str, list[str]]:
+    "The clients of each merchant, keyed by the merchant's node id"
+    response = conn.execute(
+        """
+        MATCH (c:Client)-[:TransactedWith]->(m:Merchant)
+        WHERE m.merchant_id IN $merchant_ids
+        RETURN DISTINCT m.merchant_id, c.client_id;
+        """,
+        parameters={"merchant_ids": merchant_ids},
+    )
+    stars: dict[str, list[str]] = {f"Merchant_{merchant_id}": [] for merchant_id in merchant_ids}
+    for merchant_id, client_id in response.get_all():
+        stars[f"Merchant_{merchant_id}"].append(f"Client_{client_id}")
+    return stars
+
+
+def get_components_of(conn: kuzu.Connection, node_ids: list[str]) -> dict[str, list[str]]:
+    "The members of every stored component that contains one of the given nodes"
+    response = conn.execute(
+        """
+        UNWIND $node_ids AS node_id
+        MATCH (d:DisputeComponent {node_id: node_id})
+        WITH DISTINCT d.component AS component
+        MATCH (member:DisputeComponent {component: component})
+        RETURN component, collect(member.node_id);
+        """,
+        parameters={"node_ids": node_ids},
+    )
+    return dict(response.get_all())
+
+
+def merge_stars(conn: kuzu.Connection, stars: dict[str, list[str]]) -> int:
+    """
+    Merge stars of a merchant and some of its clients into the stored components. Returns the
+    number of nodes whose component was added or changed
+    """
+    touched = list(stars) + sorted({client for clients in stars.values() for client in clients})
+    components = get_components_of(conn, touched)
+
+    # Union by size over the touched components, relabeling the members of the smaller side,
+    # so that every node keeps pointing straight at its root
+    root: dict[str, str] = {}
+    members: dict[str, list[str]] = {}
+    for component, nodes in components.items():
+        members[component] = list(nodes)
+        root.update((node, component) for node in nodes)
+    changed: dict[str, str] = {}
+
+    def find(node: str) -> str:
+        if node not in root:
+            root[node] = changed[node] = node
+            members[node] = [node]
+        return root[node]
+
+    for merchant, clients in stars.items():
+        find(merchant)
+        for client in clients:
+            a, b = find(merchant), find(client)
+            if a == b:
+                continue
+            if len(members[a]) < len(members[b]):
+                a, b = b, a
+            for node in members[b]:
+                root[node] = changed[node] = a
+            members[a].extend(members.pop(b))
+
+    if changed:
+        conn.execute(
+            """
+            LOAD FROM $updates
+            MERGE (d:DisputeComponent {node_id: node_id})
+            SET d.component = component;
+            """,
+            parameters={
+                "updates": pa.table(
+                    {"node_id": list(changed), "component": list(changed.values())}
+                )
+            },
+        )
+    return len(changed)
+
+
+def add_disputed_transactions(conn: kuzu.Connection, transaction_ids: Iterable[int]) -> int:
+    """
+    Merge the vicinity of newly disputed transactions into the stored components. Returns the
+    number of nodes whose component was added or changed
+    """
+    create_dispute_component_table(conn)
+    merchant_ids = get_new_disputed_merchants(conn, transaction_ids)
+    if not merchant_ids:
+        return 0
+    return merge_stars(conn, get_stars(conn, merchant_ids))
+
+
+def add_new_transactions(
+    conn: kuzu.Connection, client_ids: Iterable[int], merchant_ids: Iterable[int]
+) -> int:
+    """
+    Add the clients of new (undisputed) transactions to the vicinity, when their merchant is
+    already in it because of an earlier dispute. Returns the number of nodes whose component was
+    added or changed
+    """
+    create_dispute_component_table(conn)
+    pairs = {(f"Merchant_{m}", f"Client_{c}") for c, m in zip(client_ids, merchant_ids)}
+    response = conn.execute(
+        """
+        UNWIND $node_ids AS node_id
+        MATCH (d:DisputeComponent {node_id: node_id})
+        RETURN d.node_id;
+        """,
+        parameters={"node_ids": sorted({merchant for merchant, _ in pairs})},
+    )
+    in_vicinity = {row[0] for row in response.get_all()}
+    stars: dict[str, list[str]] = {}
+    for merchant, client in sorted(pairs):
+        if merchant in in_vicinity:
+            stars.setdefault(merchant, []).append(client)
+    return merge_stars(conn, stars) if stars else 0
+
+
+def rebuild_dispute_components(conn: kuzu.Connection) -> int:
+    "Rebuild the components from all transactions that are currently marked as disputed"
+    create_dispute_component_table(conn)
+    conn.execute("MATCH (d:DisputeComponent) DELETE d;")
+    response = conn.execute(
+        "MATCH ()-[t:TransactedWith]->() WHERE t.is_disputed RETURN t.transaction_id;"
+    )
+    return add_disputed_transactions(conn, [row[0] for row in response.get_all()])
+
+
+def get_component_sizes(conn: kuzu.Connection) -> pd.DataFrame:
+    return conn.execute(
+        """
+        MATCH (d:DisputeComponent)
+        RETURN d.component AS component, count(*) AS size
+        ORDER BY size DESC, component;
+        """
+    ).get_as_df()
+
+
+def get_component(conn: kuzu.Connection, node_id: str) -> list[str]:
+    "Members of the component of a node such as 'Client_366', or [] if it is not in the vicinity"
+    response = conn.execute(
+        """
+        MATCH (d:DisputeComponent {node_id: $node_id}), (member:DisputeComponent)
+        WHERE member.component = d.component
+        RETURN member.node_id;
+        """,
+        parameters={"node_id": node_id},
+    )
+    return [row[0] for row in response.get_all()]
+
+
+def get_components(conn: kuzu.Connection) -> list[set[Any]]:
+    "All components, largest first, in the shape returned by `nx.weakly_connected_components`"
+    response = conn.execute(
+        """
+        MATCH (d:DisputeComponent)
+        RETURN d.component, collect(d.node_id) AS members
+        ORDER BY size(members) DESC;
+        """
+    )
+    return [set(members) for _, members in response.get_all()]
@@ -1,9 +1,53 @@
 from __future__ import annotations
 
-import os
-import shutil
+import argparse
+from collections.abc import Iterator
+from pathlib import Path
 
 import kuzu
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+from demo_utils.database import remove_database
+from demo_utils.ingest_report import InstrumentedConnection
+from demo_utils.query_cache import bump_table_versions
+from demo_utils.transaction_partitions import copy_to_partitions
+from dispute_components import rebuild_dispute_components
+
+# Columns of the TransactedWith edge file, in the order of a COPY into TransactedWith
+TRANSACTED_WITH_SCHEMA = pa.schema(
+    [
+        ("client_id", pa.int64()),
+        ("merchant_id", pa.int64()),
+        ("transaction_id", pa.int64()),
+        ("amount_usd", pa.float32()),
+        ("timestamp", pa.timestamp("us")),
+        ("is_disputed", pa.bool_()),
+    ]
+)
+
+
+def get_copy_source(directory: str, name: str, extension: str) -> str:
+    "A file written by data/main.py, or a glob over its part files when it was generated in shards"
+    path = Path(directory) / name
+    return f"{path}/*.{extension}" if path.is_dir() else f"{path}.{extension}"
+
+
+def read_transaction_batches(file_format: str) -> Iterator[pa.RecordBatch]:
+    """
+    Stream the transactions of the edge file written by data/main.py, or of its part files, with
+    the columns of TransactedWith. The CSV files have no header
+    """
+    if file_format == "parquet":
+        dataset_format = ds.ParquetFileFormat()
+    else:
+        dataset_format = ds.CsvFileFormat(
+            read_options=pv.ReadOptions(column_names=TRANSACTED_WITH_SCHEMA.names),
+            convert_options=pv.ConvertOptions(column_types=TRANSACTED_WITH_SCHEMA),
+        )
+    path = Path(REL_PATH) / "transacted_with"
+    source = path if path.is_dir() else path.with_suffix(f".{file_format}")
+    return ds.dataset(source, schema=TRANSACTED_WITH_SCHEMA, format=dataset_format).to_batches()
 
 
 def create_client_node_table(conn: kuzu.Connection) -> None:
@@ -85,33 +129,98 @@ def create_edge_tables(conn: kuzu.Connection) -> None:
     conn.execute("CREATE REL TABLE BelongsTo(FROM Merchant TO Company)")
 
 
-def main(conn: kuzu.Connection) -> None:
+def create_transaction_index(conn: kuzu.Connection) -> None:
+    """
+    Side index from each transaction id to the endpoints of its TransactedWith edge. Its primary
+    key gives O(1) lookups by transaction id, and the endpoints narrow the edge lookup down to the
+    adjacency list of one client, instead of a scan of the whole edge table
+    """
+    conn.execute(
+        """
+        CREATE NODE TABLE
+            TransactionIndex(
+                transaction_id INT64,
+                client_id INT64,
+                merchant_id INT64,
+                PRIMARY KEY (transaction_id)
+            )
+        """
+    )
+    conn.execute(
+        """
+        COPY TransactionIndex FROM (
+            MATCH (c:Client)-[t:TransactedWith]->(m:Merchant)
+            RETURN t.transaction_id, c.client_id, m.merchant_id
+        )
+        """
+    )
+
+
+def main(conn: kuzu.Connection, file_format: str = "csv") -> None:
     # Ingest nodes
     create_node_tables(conn)
-    conn.execute(f"COPY Client FROM '{NODE_PATH}/client.csv' (header=true);")
+    conn.execute(f"COPY Client FROM '{get_copy_source(NODE_PATH, 'client', 'csv')}' (header=true);")
     conn.execute(f"COPY City FROM '{NODE_PATH}/city.csv' (header=true);")
     conn.execute(f"COPY Company FROM '{NODE_PATH}/company.csv' (header=true);")
-    conn.execute(f"COPY Merchant FROM '{NODE_PATH}/merchant.csv' (header=true);")
+    conn.execute(
+        f"COPY Merchant FROM '{get_copy_source(NODE_PATH, 'merchant', 'csv')}' (header=true);"
+    )
     print("Loaded nodes into KùzuDB")
 
     # Ingest edges
     create_edge_tables(conn)
-    conn.execute(f"COPY TransactedWith FROM '{REL_PATH}/transacted_with.csv';")
-    conn.execute(f"COPY BelongsTo FROM '{REL_PATH}/belongs_to.csv';")
-    conn.execute(f"COPY LocatedIn FROM '{REL_PATH}/located_in.csv';")
+    for table, name in [
+        ("TransactedWith", "transacted_with"),
+        ("BelongsTo", "belongs_to"),
+        ("LocatedIn", "located_in"),
+    ]:
+        conn.execute(f"COPY {table} FROM '{get_copy_source(REL_PATH, name, file_format)}';")
     print("Loaded edges into KùzuDB")
+    partitions = copy_to_partitions(conn, read_transaction_batches(file_format))
+    print(f"Partitioned transactions into {len(partitions)} monthly rel tables")
+
+    create_transaction_index(conn)
+    print("Built the transaction id index")
+    # Edge files may already contain disputed transactions
+    rebuild_dispute_components(conn)
+
+    # Invalidate cached query results
+    bump_table_versions(
+        conn,
+        [
+            "Client",
+            "City",
+            "Company",
+            "Merchant",
+            "TransactedWith",
+            "BelongsTo",
+            "LocatedIn",
+            "TransactionIndex",
+            "DisputeComponent",
+            *partitions,
+        ],
+    )
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the transactions dataset into KùzuDB")
+    parser.add_argument(
+        "--format",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="File format of the edge files written by data/main.py",
+    )
+    args = parser.parse_args()
+
     DB_NAME = "transaction_db"
-    # Delete directory each time till we have MERGE FROM available in kuzu
-    if os.path.exists(DB_NAME):
-        shutil.rmtree(DB_NAME)
+    # Delete the database each time till we have MERGE FROM available in kuzu
+    remove_database(DB_NAME)
     # Create database
     db = kuzu.Database(f"./{DB_NAME}")
-    conn = kuzu.Connection(db)
+    conn = InstrumentedConnection(kuzu.Connection(db))
 
     NODE_PATH = "./data/node"
     REL_PATH = "./data/rel"
 
-    main(conn)
+    main(conn, file_format=args.format)
+    conn.write_report("load_data")
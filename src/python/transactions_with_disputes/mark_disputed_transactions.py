@@ -1,38 +1,173 @@
-import csv
+import argparse
+import datetime
 from pathlib import Path
 from typing import Any
 
 import kuzu
+import pandas as pd
+import pyarrow as pa
+from demo_utils.query_cache import bump_table_versions
+from demo_utils.transaction_partitions import get_partitions, split_by_month
+from dispute_components import add_disputed_transactions
 
 
-def read_csv(file_path: Path) -> list[dict[str, Any]]:
-    with open(file_path) as file:
-        reader = csv.DictReader(file)
-        return list(reader)
+def get_transaction_endpoints(
+    conn: kuzu.Connection, transaction_id: int
+) -> tuple[int, int] | None:
+    """
+    Look up the client and merchant of a transaction in the TransactionIndex built by
+    `load_data.py`. The id is inlined rather than passed as a parameter, because Kùzu only
+    plans a primary key lookup for literal keys (a parameter is compared against every node)
+    """
+    response = conn.execute(
+        f"""
+        MATCH (i:TransactionIndex {{transaction_id: {int(transaction_id)}}})
+        RETURN i.client_id, i.merchant_id;
+        """
+    )
+    if not response.has_next():
+        return None
+    client_id, merchant_id = response.get_next()
+    return client_id, merchant_id
 
 
-def mark_disputed_transactions(conn: kuzu.Connection, params: list[dict[str, Any]]) -> None:
-    query = """
-        MATCH (c:Client)-[t:TransactedWith]->(m:Merchant)
-        WHERE t.transaction_id = $transaction_id
-        SET t.is_disputed = TRUE
-        RETURN *;
+def match_transaction(transaction_id: int, client_id: int, merchant_id: int) -> str:
+    "MATCH clause for a single transaction, through the primary keys of its endpoints"
+    return f"""
+        MATCH (c:Client {{client_id: {int(client_id)}}})-[t:TransactedWith]->
+            (m:Merchant {{merchant_id: {int(merchant_id)}}})
+        WHERE t.transaction_id = {int(transaction_id)}
+    """
+
+
+def get_transaction(conn: kuzu.Connection, transaction_id: int) -> dict[str, Any] | None:
     """
-    conn.execute(query, parameters=params)
+    Case lookup of a single transaction by id, without scanning the whole edge table
+    """
+    endpoints = get_transaction_endpoints(conn, transaction_id)
+    if endpoints is None:
+        return None
+    response = conn.execute(
+        match_transaction(transaction_id, *endpoints)
+        + """
+        RETURN c.client_id AS client_id, c.name AS client_name, m.merchant_id AS merchant_id,
+            t.amount_usd AS amount_usd, t.timestamp AS timestamp, t.is_disputed AS is_disputed;
+        """
+    )
+    if not response.has_next():
+        return None
+    return dict(zip(response.get_column_names(), response.get_next()))
+
+
+def mark_disputed_transactions(
+    conn: kuzu.Connection, params: dict[str, Any]
+) -> datetime.datetime | None:
+    "Mark a single transaction as disputed. Returns its timestamp, or None if it was not found"
+    endpoints = get_transaction_endpoints(conn, params["transaction_id"])
+    if endpoints is None:
+        print(f"Transaction {params['transaction_id']} not found.")
+        return None
+    response = conn.execute(
+        match_transaction(params["transaction_id"], *endpoints)
+        + "SET t.is_disputed = TRUE RETURN t.timestamp;"
+    )
     print(f"Transaction {params['transaction_id']} marked as disputed.")
+    return response.get_next()[0]
 
 
-def main() -> None:
-    db = kuzu.Database(DB_NAME)
-    conn = kuzu.Connection(db)
-    # Read from CSV
-    disputed_ids = read_csv(FILE_PATH / "disputed_transactions.csv")
-    for record in disputed_ids:
-        transaction_id = int(record["transaction_id"])
-        mark_disputed_transactions(conn, {"transaction_id": transaction_id})
+def mark_disputed_transactions_bulk(conn: kuzu.Connection, disputes: pd.DataFrame) -> pa.Table:
+    """
+    Mark every transaction in the `transaction_id` column of `disputes` as disputed, in a single
+    statement. The ids are hash joined with one scan of TransactedWith instead of scanning it once
+    per id. Returns the ids and timestamps of the transactions marked
+    """
+    disputes = disputes[["transaction_id"]].astype("int64")
+    response = conn.execute(
+        """
+        LOAD FROM disputes
+        MATCH (:Client)-[t:TransactedWith]->(:Merchant)
+        WHERE t.transaction_id = transaction_id
+        SET t.is_disputed = TRUE
+        RETURN t.transaction_id AS transaction_id, t.timestamp AS timestamp;
+        """
+    )
+    return response.get_as_arrow()
+
+
+def mark_disputed_partitions(conn: kuzu.Connection, marked: pa.Table) -> list[str]:
+    """
+    Mark the same transactions as disputed in the monthly partitions of TransactedWith, given their
+    ids and timestamps. Only the partitions of their months are scanned. Returns the partitions
+    written to
+    """
+    partitions = set(get_partitions(conn).values())
+    names = []
+    for name, rows in split_by_month(marked):
+        # Databases built before the partitions existed are not partitioned
+        if name not in partitions:
+            continue
+        conn.execute(
+            f"""
+            LOAD FROM $rows
+            MATCH (:Client)-[t:{name}]->(:Merchant)
+            WHERE t.transaction_id = transaction_id
+            SET t.is_disputed = TRUE;
+            """,
+            parameters={"rows": rows.select(["transaction_id"])},
+        )
+        names.append(name)
+    return names
 
 
+def main(conn: kuzu.Connection, bulk: bool = True) -> None:
+    """
+    Mark the disputed transactions, in TransactedWith and in its partitions, update the dispute
+    components and bump the table versions, all in one transaction, so that a failure part of the
+    way leaves none of them changed
+    """
+    disputes = pd.read_csv(FILE_PATH / "disputed_transactions.csv", usecols=["transaction_id"])
+    conn.execute("BEGIN TRANSACTION;")
+    try:
+        if bulk:
+            marked = mark_disputed_transactions_bulk(conn, disputes)
+        else:
+            timestamps = {
+                int(transaction_id): mark_disputed_transactions(
+                    conn, {"transaction_id": int(transaction_id)}
+                )
+                for transaction_id in disputes["transaction_id"]
+            }
+            found = {key: value for key, value in timestamps.items() if value is not None}
+            marked = pa.table(
+                {
+                    "transaction_id": pa.array(list(found), pa.int64()),
+                    "timestamp": pa.array(list(found.values()), pa.timestamp("us")),
+                }
+            )
+        partitions = mark_disputed_partitions(conn, marked)
+        # Merge the vicinity of the new disputes into the stored connected components
+        num_updated = add_disputed_transactions(conn, disputes["transaction_id"])
+        # Invalidate cached query results that read the disputed flag or the components
+        bump_table_versions(conn, ["TransactedWith", "DisputeComponent"] + partitions)
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+    conn.execute("COMMIT;")
+    print(f"{marked.num_rows} of {len(disputes)} disputed transactions marked as disputed.")
+    print(f"Updated the dispute component of {num_updated} nodes.")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mark the disputed transactions in KùzuDB")
+    parser.add_argument(
+        "--per-row",
+        action="store_true",
+        help="Mark the transactions one at a time through the transaction id index, "
+        "instead of with a single bulk statement",
+    )
+    args = parser.parse_args()
+
     DB_NAME = "./transaction_db"
     FILE_PATH = Path("./data/node")
-    main()
+    db = kuzu.Database(DB_NAME)
+    conn = kuzu.Connection(db)
+    main(conn, bulk=not args.per_row)
@@ -0,0 +1,486 @@
+"""
+Score incoming transactions for dispute risk as they stream in, and insert them into KùzuDB.
+
+The pipeline has three asyncio stages connected by bounded queues:
+
+- read: parse transactions from a CSV file (a stand-in for a queue), optionally paced at a fixed
+  rate, or following the file as new lines are appended to it
+- score: compute graph features of each transaction from neighborhoods cached in memory, and emit
+  a risk score right away
+- write: insert the scored transactions into TransactedWith and the TransactionIndex in batches,
+  in a worker thread, so that scoring never waits for the database
+
+The features are the dispute ratio of the merchant, the client's exposure to disputed merchants
+(the share of the merchants it has transacted with that have a disputed transaction, two hops
+away from the client), whether the client has never transacted with the merchant before, and the
+amount relative to the merchant's mean amount. They are read from the memory-mapped projection of
+TransactedWith, so that scoring does not query the database, and the cached neighborhoods are
+updated with every scored transaction, so that they never wait for the inserts.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import csv
+import datetime
+import math
+import time
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+import kuzu
+import numpy as np
+import pyarrow as pa
+from demo_utils.graph_projection import get_projection
+from demo_utils.query_cache import bump_table_versions
+from demo_utils.transaction_partitions import get_partitions, insert_into_partitions
+from dispute_components import add_new_transactions
+
+# Hand-picked weights of the features in the logistic risk score, not fitted to labeled data
+RISK_BIAS = -4.0
+RISK_WEIGHTS = {
+    "merchant_dispute_ratio": 40.0,
+    "client_exposure": 2.0,
+    "new_merchant": 0.5,
+    "log_amount_ratio": 1.0,
+}
+INCOMING_COLUMNS = ["transaction_id", "client_id", "merchant_id", "amount_usd", "timestamp"]
+
+
+@dataclass
+class IncomingTransaction:
+    transaction_id: int
+    client_id: int
+    merchant_id: int
+    amount_usd: float
+    timestamp: datetime.datetime
+    # time.perf_counter() when the transaction was read, and when it was scored
+    received_at: float = 0.0
+    scored_at: float = 0.0
+
+
+@dataclass
+class MerchantStats:
+    num_transactions: int = 0
+    num_disputed: int = 0
+    total_amount_usd: float = 0.0
+
+
+@dataclass
+class PipelineStats:
+    "Latencies in seconds of each transaction, from being read to being scored and written"
+
+    score_latencies: list[float] = field(default_factory=list)
+    write_latencies: list[float] = field(default_factory=list)
+    batch_sizes: list[int] = field(default_factory=list)
+    num_high_risk: int = 0
+    started_at: float = field(default_factory=time.perf_counter)
+    finished_at: float = 0.0
+
+    def report(self) -> None:
+        num_transactions = len(self.score_latencies)
+        elapsed = self.finished_at - self.started_at
+        print(
+            f"\n---\nScored {num_transactions} transactions in {elapsed:.2f}s "
+            f"({num_transactions / elapsed:.0f} transactions/s), {self.num_high_risk} high risk"
+        )
+        print(
+            f"Inserted them in {len(self.batch_sizes)} batches "
+            f"(mean size {np.mean(self.batch_sizes or [0]):.1f})"
+        )
+        for name, latencies in [
+            ("read -> scored", self.score_latencies),
+            ("read -> inserted", self.write_latencies),
+        ]:
+            if latencies:
+                p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+                print(
+                    f"Latency {name:<16} p50 {p50:.3f} ms, p95 {p95:.3f} ms, p99 {p99:.3f} ms, "
+                    f"max {max(latencies) * 1000:.3f} ms"
+                )
+
+
+class NeighborhoodCache:
+    """
+    Merchant statistics and the merchants of each client, read from the memory-mapped projection
+    of TransactedWith (see `demo_utils.graph_projection`) and kept up to date with the transactions
+    that are scored
+    """
+
+    def __init__(self, conn: kuzu.Connection):
+        self.projection = get_projection(conn, "TransactedWith", ["amount_usd", "is_disputed"])
+        self.client_ids = self.projection.node_ids["Client"]
+        self.merchant_ids = self.projection.node_ids["Merchant"]
+        merchant_nodes = self.projection.node_range("Merchant")
+        # In-edges of the merchants, and the positions of the same edges among the out-edges,
+        # which the weights follow
+        in_offsets = self.projection.in_offsets[merchant_nodes.start :]
+        edges = self.projection.in_edges[in_offsets[0] :]
+        starts = in_offsets[:-1] - in_offsets[0]
+        num_transactions = np.diff(in_offsets)
+        amounts = np.asarray(self.projection.weights["amount_usd"], dtype=np.float64)[edges]
+        disputed = np.asarray(self.projection.weights["is_disputed"], dtype=np.int64)[edges]
+        has_edges = num_transactions > 0
+        totals, num_disputed = np.zeros(len(starts)), np.zeros(len(starts), dtype=np.int64)
+        totals[has_edges] = np.add.reduceat(amounts, starts[has_edges])
+        num_disputed[has_edges] = np.add.reduceat(disputed, starts[has_edges])
+        self.merchants: dict[int, MerchantStats] = {
+            int(merchant_id): MerchantStats(int(count), int(disputes), float(total))
+            for merchant_id, count, disputes, total in zip(
+                self.merchant_ids, num_transactions, num_disputed, totals
+            )
+        }
+        self.disputed_merchants = {
+            merchant_id for merchant_id, stats in self.merchants.items() if stats.num_disputed
+        }
+        self.clients: dict[int, set[int]] = {}
+
+    def get_client_merchants(self, client_id: int) -> set[int]:
+        """
+        Read a client's merchants the first time it is seen. Every later transaction of the client
+        goes through `add`, so the cached set stays complete even before the inserts are committed
+        """
+        if client_id not in self.clients:
+            merchants: set[int] = set()
+            position = np.searchsorted(self.client_ids, client_id)
+            if position < len(self.client_ids) and self.client_ids[position] == client_id:
+                targets = self.projection.targets[
+                    self.projection.offsets[position] : self.projection.offsets[position + 1]
+                ]
+                merchants.update(self.merchant_ids[targets - len(self.client_ids)].tolist())
+            self.clients[client_id] = merchants
+        return self.clients[client_id]
+
+    def get_features(self, transaction: IncomingTransaction) -> dict[str, float]:
+        merchant = self.merchants.get(transaction.merchant_id, MerchantStats())
+        client_merchants = self.get_client_merchants(transaction.client_id)
+        mean_amount = merchant.total_amount_usd / max(merchant.num_transactions, 1)
+        return {
+            "merchant_dispute_ratio": merchant.num_disputed / max(merchant.num_transactions, 1),
+            "client_exposure": (
+                len(client_merchants & self.disputed_merchants) / len(client_merchants)
+                if client_merchants
+                else 0.0
+            ),
+            "new_merchant": float(transaction.merchant_id not in client_merchants),
+            "log_amount_ratio": (
+                max(0.0, math.log(transaction.amount_usd / mean_amount)) if mean_amount > 0 else 0.0
+            ),
+        }
+
+    def add(self, transaction: IncomingTransaction) -> None:
+        merchant = self.merchants.setdefault(transaction.merchant_id, MerchantStats())
+        merchant.num_transactions += 1
+        merchant.total_amount_usd += transaction.amount_usd
+        self.get_client_merchants(transaction.client_id).add(transaction.merchant_id)
+
+
+def get_risk_score(features: dict[str, float]) -> float:
+    logit = RISK_BIAS + sum(RISK_WEIGHTS[name] * value for name, value in features.items())
+    return 1 / (1 + math.exp(-logit))
+
+
+def parse_transaction(row: dict[str, str]) -> IncomingTransaction:
+    return IncomingTransaction(
+        transaction_id=int(row["transaction_id"]),
+        client_id=int(row["client_id"]),
+        merchant_id=int(row["merchant_id"]),
+        amount_usd=float(row["amount_usd"]),
+        timestamp=datetime.datetime.fromisoformat(row["timestamp"]),
+    )
+
+
+def follow_lines(path: Path, follow: bool) -> Iterator[str | None]:
+    """
+    Lines of a file, or with `follow`, also the lines appended to it afterwards, with None
+    whenever the end of the file is reached and no new line has been written yet
+    """
+    with open(path, "rb") as f:
+        while True:
+            line = f.readline()
+            if line.endswith(b"\n"):
+                yield line.decode()
+            elif not follow:
+                if line:
+                    yield line.decode()
+                return
+            else:
+                # Wait for the rest of a partially written line
+                f.seek(-len(line), 1)
+                yield None
+
+
+async def read_transactions(
+    path: Path,
+    queue: asyncio.Queue,
+    rate: float | None = None,
+    follow: bool = False,
+    idle_timeout: float = 5.0,
+) -> None:
+    """
+    Put the transactions of a CSV file on the queue, at `rate` transactions per second if given.
+    With `follow`, wait for new lines until none have been appended for `idle_timeout` seconds
+    """
+    lines = follow_lines(path, follow)
+    fields = None
+    start, count, idle_since = time.perf_counter(), 0, None
+    for line in lines:
+        if line is None:
+            idle_since = idle_since or time.perf_counter()
+            if time.perf_counter() - idle_since > idle_timeout:
+                break
+            await asyncio.sleep(0.01)
+            continue
+        idle_since = None
+        if fields is None:
+            fields = next(csv.reader([line]))
+            continue
+        if rate:
+            delay = start + count / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        transaction = parse_transaction(dict(zip(fields, next(csv.reader([line])))))
+        transaction.received_at = time.perf_counter()
+        await queue.put(transaction)
+        count += 1
+    await queue.put(None)
+
+
+async def score_transactions(
+    cache: NeighborhoodCache,
+    in_queue: asyncio.Queue,
+    out_queue: asyncio.Queue,
+    writer: Any,
+    stats: PipelineStats,
+    threshold: float,
+) -> None:
+    while (transaction := await in_queue.get()) is not None:
+        features = cache.get_features(transaction)
+        risk_score = get_risk_score(features)
+        cache.add(transaction)
+        transaction.scored_at = time.perf_counter()
+        stats.score_latencies.append(transaction.scored_at - transaction.received_at)
+        writer.writerow(
+            {
+                "transaction_id": transaction.transaction_id,
+                "client_id": transaction.client_id,
+                "merchant_id": transaction.merchant_id,
+                **{name: round(value, 6) for name, value in features.items()},
+                "risk_score": round(risk_score, 6),
+            }
+        )
+        if risk_score >= threshold:
+            stats.num_high_risk += 1
+            print(
+                f"High risk transaction {transaction.transaction_id} (client "
+                f"{transaction.client_id}, merchant {transaction.merchant_id}): {risk_score:.3f}"
+            )
+        await out_queue.put(transaction)
+    await out_queue.put(None)
+
+
+def insert_transactions(
+    conn: kuzu.Connection, batch: list[IncomingTransaction], partitioned: bool = True
+) -> None:
+    """
+    Insert a batch of transactions into TransactedWith, its monthly partitions if it is
+    `partitioned`, and the TransactionIndex, in a single transaction, and add their clients to the
+    dispute vicinity where needed
+    """
+    rows = pa.table(
+        {
+            "transaction_id": pa.array([t.transaction_id for t in batch], pa.int64()),
+            "client_id": pa.array([t.client_id for t in batch], pa.int64()),
+            "merchant_id": pa.array([t.merchant_id for t in batch], pa.int64()),
+            "amount_usd": pa.array([t.amount_usd for t in batch], pa.float32()),
+            "timestamp": pa.array([t.timestamp for t in batch], pa.timestamp("us")),
+        }
+    )
+    conn.execute("BEGIN TRANSACTION;")
+    try:
+        conn.execute(
+            """
+            LOAD FROM $rows
+            MATCH (c:Client {client_id: client_id}), (m:Merchant {merchant_id: merchant_id})
+            CREATE (c)-[:TransactedWith {
+                transaction_id: transaction_id,
+                amount_usd: amount_usd,
+                timestamp: timestamp,
+                is_disputed: false
+            }]->(m);
+            """,
+            parameters={"rows": rows},
+        )
+        conn.execute(
+            """
+            LOAD FROM $rows
+            CREATE (:TransactionIndex {
+                transaction_id: transaction_id, client_id: client_id, merchant_id: merchant_id
+            });
+            """,
+            parameters={"rows": rows},
+        )
+        partitions = []
+        if partitioned:
+            edges = rows.select(
+                ["client_id", "merchant_id", "transaction_id", "amount_usd", "timestamp"]
+            ).append_column("is_disputed", pa.array([False] * rows.num_rows))
+            partitions = insert_into_partitions(conn, edges, copy=False)
+        add_new_transactions(conn, rows["client_id"].to_pylist(), rows["merchant_id"].to_pylist())
+        # Invalidate cached query results and graph projections
+        bump_table_versions(
+            conn, ["TransactedWith", "TransactionIndex", "DisputeComponent", *partitions]
+        )
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+    conn.execute("COMMIT;")
+
+
+async def write_transactions(
+    conn: kuzu.Connection,
+    queue: asyncio.Queue,
+    stats: PipelineStats,
+    batch_size: int = 1000,
+    max_delay: float = 0.05,
+) -> None:
+    """
+    Insert the scored transactions in batches of up to `batch_size`, or of whatever has arrived
+    within `max_delay` seconds of the first transaction of the batch
+    """
+    # Databases built before the partitions existed are not partitioned
+    partitioned = bool(get_partitions(conn))
+    done = False
+    while not done:
+        transaction = await queue.get()
+        if transaction is None:
+            break
+        batch = [transaction]
+        deadline = time.perf_counter() + max_delay
+        while len(batch) < batch_size:
+            try:
+                timeout = max(0.0, deadline - time.perf_counter())
+                transaction = await asyncio.wait_for(queue.get(), timeout)
+            except TimeoutError:
+                break
+            if transaction is None:
+                done = True
+                break
+            batch.append(transaction)
+        await asyncio.to_thread(insert_transactions, conn, batch, partitioned)
+        inserted_at = time.perf_counter()
+        stats.write_latencies.extend(inserted_at - t.received_at for t in batch)
+        stats.batch_sizes.append(len(batch))
+
+
+async def run_pipeline(
+    db: kuzu.Database,
+    input_path: Path,
+    output_path: Path,
+    rate: float | None = None,
+    follow: bool = False,
+    idle_timeout: float = 5.0,
+    batch_size: int = 1000,
+    threshold: float = 0.5,
+) -> PipelineStats:
+    start = time.perf_counter()
+    cache = NeighborhoodCache(kuzu.Connection(db))
+    print(
+        f"Loaded the neighborhoods of {len(cache.merchants)} merchants in "
+        f"{time.perf_counter() - start:.3f}s"
+    )
+    # Inserts run in a worker thread, on a connection of their own, with a single thread so that
+    # they leave CPU time for scoring
+    write_conn = kuzu.Connection(db)
+    write_conn.set_max_threads_for_exec(1)
+    stats = PipelineStats()
+    in_queue: asyncio.Queue = asyncio.Queue(maxsize=10_000)
+    out_queue: asyncio.Queue = asyncio.Queue(maxsize=10_000)
+    with open(output_path, "w", newline="") as f:
+        writer = csv.DictWriter(
+            f, fieldnames=["transaction_id", "client_id", "merchant_id", *RISK_WEIGHTS, "risk_score"]
+        )
+        writer.writeheader()
+        await asyncio.gather(
+            read_transactions(input_path, in_queue, rate, follow, idle_timeout),
+            score_transactions(cache, in_queue, out_queue, writer, stats, threshold),
+            write_transactions(write_conn, out_queue, stats, batch_size),
+        )
+    stats.finished_at = time.perf_counter()
+    return stats
+
+
+def write_incoming_transactions(
+    conn: kuzu.Connection, path: Path, n: int, seed: int = 1
+) -> None:
+    """
+    Write a stand-in stream of n new transactions between existing clients and merchants, with
+    transaction ids following the largest existing one
+    """
+    rng = np.random.default_rng(seed)
+    client_ids = conn.execute("MATCH (c:Client) RETURN c.client_id").get_as_arrow()
+    merchant_ids = conn.execute("MATCH (m:Merchant) RETURN m.merchant_id").get_as_arrow()
+    client_ids, merchant_ids = client_ids.column(0).to_numpy(), merchant_ids.column(0).to_numpy()
+    max_id = conn.execute("MATCH (i:TransactionIndex) RETURN max(i.transaction_id)").get_next()[0]
+    now = datetime.datetime.now().replace(microsecond=0)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(INCOMING_COLUMNS)
+        for i in range(n):
+            writer.writerow(
+                [
+                    (max_id or 0) + i + 1,
+                    rng.choice(client_ids),
+                    rng.choice(merchant_ids),
+                    round(rng.uniform(5.0, 2500.0), 2),
+                    now + datetime.timedelta(seconds=i),
+                ]
+            )
+    print(f"Wrote {n} incoming transactions to {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", type=Path, default=Path("incoming_transactions.csv"))
+    parser.add_argument("--output", type=Path, default=Path("risk_scores.csv"))
+    parser.add_argument(
+        "--generate",
+        type=int,
+        default=0,
+        help="First write this many synthetic incoming transactions to the input file",
+    )
+    parser.add_argument("--rate", type=float, default=None, help="Transactions per second")
+    parser.add_argument(
+        "--follow", action="store_true", help="Keep reading lines appended to the input file"
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=5.0,
+        help="With --follow, stop after this many seconds without new lines",
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--threshold", type=float, default=0.5, help="Risk score of transactions to print"
+    )
+    args = parser.parse_args()
+
+    db = kuzu.Database("./transaction_db")
+    if args.generate:
+        write_incoming_transactions(kuzu.Connection(db), args.input, args.generate)
+    stats = asyncio.run(
+        run_pipeline(
+            db,
+            args.input,
+            args.output,
+            rate=args.rate,
+            follow=args.follow,
+            idle_timeout=args.idle_timeout,
+            batch_size=args.batch_size,
+            threshold=args.threshold,
+        )
+    )
+    stats.report()
+    print(f"Wrote the risk scores to {args.output}")